@@ -28,11 +28,17 @@ const ChartComponent = ({
   };
 
   useEffect(() => {
-    let intervalId;
+    let eventSource;
 
     const fetchData = async () => {
       try {
-        const response = await axios.post(fetchDataEndpoint, { selection });
+        // Only the selected sites (and date range for daily data) are requested from the server
+        const request = { selection, sites: selectedSites };
+        if (!fifteenData) {
+          request.start = moment(startDate).format("YYYY-MM-DD");
+          request.end = moment(endDate).format("YYYY-MM-DD");
+        }
+        const response = await axios.post(fetchDataEndpoint, request);
         setData(response.data || []);
       } catch (error) {
         console.error("Error:", error);
@@ -42,19 +48,47 @@ const ChartComponent = ({
     if (fifteenData) {
       // Fetch data initially
       fetchData();
-      // Set up the interval for periodic data fetch only if fifteenData is true
-      intervalId = setInterval(fetchData, 15 * 60 * 1000); // 15 minutes in milliseconds
+      if (selectedSites.length === 0) {
+        // Nothing to update until sites are selected
+        return undefined;
+      }
+      // The server pushes the new 15 minute intervals of the selected sites as soon as they are stored
+      const params = new URLSearchParams();
+      selectedSites.forEach((site) => params.append("sites", site));
+      eventSource = new EventSource(`/api/15min/stream?${params.toString()}`);
+      eventSource.addEventListener("intervals", (event) => {
+        if (selection !== "15T") {
+          // Hourly and 12 hourly sums are recomputed by the server
+          fetchData();
+          return;
+        }
+        const appended = JSON.parse(event.data);
+        // Same 7 day window as the server's 15 minute data, older intervals are dropped as new ones arrive
+        const windowStart = moment().subtract(7, "days").startOf("day");
+        setData((currentData) => {
+          const mergedData = { ...(currentData || {}) };
+          Object.entries(appended).forEach(([site, records]) => {
+            mergedData[site] = [...(mergedData[site] || []), ...records];
+          });
+          Object.keys(mergedData).forEach((site) => {
+            mergedData[site] = mergedData[site].filter((record) =>
+              moment(record.Date, "YYYY-MM-DD HH:mm:ss").isSameOrAfter(windowStart)
+            );
+          });
+          return mergedData;
+        });
+      });
     } else {
       fetchData();
     }
 
-    // Cleanup function to clear the interval
+    // Cleanup function to close the update stream
     return () => {
-      if (intervalId) {
-        clearInterval(intervalId);
+      if (eventSource) {
+        eventSource.close();
       }
     };
-  }, [selection, fetchDataEndpoint, fifteenData]); // Include fifteenData in dependencies
+  }, [selection, fetchDataEndpoint, fifteenData, selectedSites, startDate, endDate]); // Refetch, and reopen the update stream, whenever the request changes
 
   const chartOptions = {
     responsive: true,
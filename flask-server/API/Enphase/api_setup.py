@@ -1,36 +1,160 @@
+import os
+import time
+import threading
 import requests
 from base64 import b64encode
 from requests.auth import HTTPBasicAuth
 import json
 import pathlib
+from API import http_client
+from API.config_paths import get_config_path
 
+VENDOR = 'Enphase'
+# Credential sets are stored in run_params_1.json ... run_params_4.json
+APIS = [1, 2, 3, 4]
+# Quota of every credential set, calls per rolling minute and per month (reset by reset_api_count)
+REQUESTS_PER_MINUTE = 10
+REQUESTS_PER_MONTH = 960
+MAX_CONSECUTIVE_FAILURES = 9
+# Seconds a credential set is left alone after a 429 without a Retry-After header, doubling on each repeated 429
+BACKOFF_SECONDS = 60
+MAX_BACKOFF_SECONDS = 900
+MAX_REQUEST_ATTEMPTS = 5
+TOKEN_ENDPOINT = 'https://api.enphaseenergy.com/oauth/token'
 
-def get_params(api=1):
-    json_file = f'run_params_{api}.json'
-    json_path = pathlib.Path(__file__).parents[0] / pathlib.Path(json_file)
+_lock = threading.Lock()
+_tokens = {}
+_refill_times = {}
+_backoff = {}
+_refresh_locks = {}
+
+
+def get_params_path(api):
+    return pathlib.Path(get_config_path(VENDOR, f'run_params_{api}.json'))
+
+
+def load_params(api):
+    return load_params_file(get_params_path(api))
+
+
+def load_params_file(json_path):
     with open(json_path, 'r') as json_file:
         params = json.load(json_file)
+    return params, json_path
+
+
+def save_params(params, json_path):
+    """Writes the parameters to a temporary file first, so an interrupted write never leaves a truncated file"""
+    tmp_path = f'{json_path}.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(params, json_file, indent=4)
+    os.replace(tmp_path, json_path)
+
 
-    if params['API_Count'] > 960 or params['Operational'] is False or params['Consecutive_Failures'] > 9:
+def is_usable(params):
+    return params['API_Count'] <= REQUESTS_PER_MONTH and params['Operational'] is not False and \
+        params['Consecutive_Failures'] <= MAX_CONSECUTIVE_FAILURES
+
+
+def get_params(api=1):
+    params, json_path = load_params(api)
+    json_file = json_path.name
+
+    if not is_usable(params):
         params, json_path, json_file = get_params(api=api + 1)
 
     return params, json_path, json_file
 
 
+def seconds_until_available(api, now):
+    """Refills the credential set's per-minute bucket and returns how long until it can make a call"""
+    tokens = _tokens.get(api, REQUESTS_PER_MINUTE)
+    tokens = min(REQUESTS_PER_MINUTE, tokens + (now - _refill_times.get(api, now)) * REQUESTS_PER_MINUTE / 60)
+    _tokens[api], _refill_times[api] = tokens, now
+    wait = 0 if tokens >= 1 else (1 - tokens) * 60 / REQUESTS_PER_MINUTE
+    backoff_until = _backoff.get(api, (0, 0))[0]
+    return max(wait, backoff_until - now)
+
+
+def acquire_credentials():
+    """Picks the credential set that can make a call the soonest, preferring the one with the most monthly quota
+    left, waits for it and counts the call against it. Returns (api, params)."""
+    while True:
+        with _lock:
+            now = time.monotonic()
+            candidates = []
+            for api in APIS:
+                if not get_params_path(api).exists():
+                    continue
+                params, json_path = load_params(api)
+                if is_usable(params):
+                    candidates.append((seconds_until_available(api, now), params['API_Count'], api, params, json_path))
+            if not candidates:
+                raise RuntimeError('No Enphase credential set has quota left this month')
+
+            wait, api_count, api, params, json_path = min(candidates, key=lambda candidate: candidate[:3])
+            if wait <= 0:
+                _tokens[api] -= 1
+                params['API_Count'] += 1
+                save_params(params, json_path)
+                return api, params
+        time.sleep(wait)
+
+
+def record_response(api, response):
+    """Updates the credential set's failure counters after a call and backs it off alone on a 429"""
+    with _lock:
+        params, json_path = load_params(api)
+        if response.status_code == 200:
+            params['Operational'] = True
+            params['Consecutive_Failures'] = 0
+            _backoff.pop(api, None)
+        else:
+            print(f"Error: {response.status_code} - {response.text}")
+            # 401: not authorized, 429: too many requests
+            if response.status_code != 401 and response.status_code != 429:
+                params['Operational'] = False
+            params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
+            if response.status_code == 429:
+                retry_after = response.headers.get('Retry-After')
+                previous_backoff = _backoff.get(api, (0, 0))[1]
+                backoff = float(retry_after) if retry_after and retry_after.isdigit() else \
+                    min(MAX_BACKOFF_SECONDS, previous_backoff * 2 or BACKOFF_SECONDS)
+                _backoff[api] = (time.monotonic() + backoff, backoff)
+                print(f'Enphase credential set {api} rate limited, leaving it alone for {backoff:.0f}s')
+        save_params(params, json_path)
+
+
+def enphase_get(path='', params=None):
+    """GET api_endpoint + path with the credential set acquire_credentials picks. 401s refresh that set's tokens and
+    429s move on to another set, up to MAX_REQUEST_ATTEMPTS calls. Returns the last response."""
+    for attempt in range(MAX_REQUEST_ATTEMPTS):
+        api, credentials = acquire_credentials()
+        headers = {
+            'Authorization': f"Bearer {credentials.get('access_token')}",
+            'key': credentials.get('api_key'),
+            'Accept': 'application/json',
+        }
+        response = http_client.get(VENDOR, credentials.get('api_endpoint') + path, headers=headers, params=params)
+        record_response(api, response)
+        if response.status_code == 401:
+            Generate_New_Access_Token_From_Refresh_Token(api=api)
+        elif response.status_code != 429:
+            break
+    return response
+
+
 def reset_api_count():
-    apis = [1, 2, 3, 4]
-    for api in apis:
-        json_file = f'run_params_{api}.json'
-        json_path = pathlib.Path(__file__).parents[0] / pathlib.Path(json_file)
-        with open(json_path, 'r') as json_file:
-            params = json.load(json_file)
-
-        params['API_Count'] = 0
-        params['Operational'] = True
-        params['Consecutive_Failures'] = 0
+    with _lock:
+        for api in APIS:
+            params, json_path = load_params(api)
 
-        with open(json_path, 'w') as json_file:
-            json.dump(params, json_file, indent=4)
+            params['API_Count'] = 0
+            params['Operational'] = True
+            params['Consecutive_Failures'] = 0
+
+            save_params(params, json_path)
+        _backoff.clear()
 
 
 def Website_For_Authentication_Code():
@@ -46,8 +170,7 @@ def Website_For_Authentication_Code():
     print(f"Please authorize the application by visiting the following URL:\n{authorization_url}")
 
     params['authorization_url'] = authorization_url
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
+    save_params(params, json_path)
 
 
 def get_Access_Refresh_Token_From_Authorization_Code():
@@ -102,50 +225,68 @@ def get_Access_Refresh_Token_From_Authorization_Code():
             params['Operational'] = False
         params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
 
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
+    save_params(params, json_path)
 
 
-def Generate_New_Access_Token_From_Refresh_Token():
-    params, json_path, json_file = get_params()
+def get_refresh_lock(json_path):
+    with _lock:
+        return _refresh_locks.setdefault(str(json_path), threading.Lock())
 
-    client_id = params['client_id']
-    client_secret = params['client_secret']
-    refresh_token = params['refresh_token']
 
-    auth_header = b64encode(f"{client_id}:{client_secret}".encode()).decode()
+def Generate_New_Access_Token_From_Refresh_Token(api=None):
+    """Refreshes the tokens of the given credential set, by default of the first usable one. Refreshes of the same
+    set take turns, each using the refresh token the previous one stored. The scheduler lock is only held to read and
+    update the parameters, not during the request, so the other Enphase calls keep going meanwhile."""
+    with _lock:
+        if api is None:
+            params, json_path, json_file = get_params()
+        else:
+            params, json_path = load_params(api)
 
-    token_endpoint = "https://api.enphaseenergy.com/oauth/token"
-    payload = {
-        "grant_type": "refresh_token",
-        "refresh_token": refresh_token,
-    }
-    headers = {
-        "Authorization": f"Basic {auth_header}",
-        "Content-Type": "application/x-www-form-urlencoded",
-    }
+    with get_refresh_lock(json_path):
+        with _lock:
+            params, json_path = load_params_file(json_path)
 
-    response = requests.post(token_endpoint, data=payload, headers=headers)
+        client_id = params['client_id']
+        client_secret = params['client_secret']
+        refresh_token = params['refresh_token']
 
-    params['API_Count'] += 1
+        auth_header = b64encode(f"{client_id}:{client_secret}".encode()).decode()
 
-    if response.status_code == 200:
-        token_data = response.json()
-        params['access_token'] = token_data.get("access_token")
-        params['refresh_token'] = token_data.get("refresh_token")
+        token_endpoint = params.get('token_endpoint', TOKEN_ENDPOINT)
+        payload = {
+            "grant_type": "refresh_token",
+            "refresh_token": refresh_token,
+        }
+        headers = {
+            "Authorization": f"Basic {auth_header}",
+            "Content-Type": "application/x-www-form-urlencoded",
+        }
 
-        print("Updated New Access and Refresh Tokens")
+        response = requests.post(token_endpoint, data=payload, headers=headers)
 
-        params['Operational'] = True
-        # not putting consecutive failures since this works even when api limit has been reached
+        with _lock:
+            # Re-read so that the counters acquire_credentials wrote during the request are kept
+            params, json_path = load_params_file(json_path)
+            params['API_Count'] += 1
 
-    else:
-        print(f"Error Refresh and Access: {response.status_code} - {response.text}")
-        if response.status_code != 401 and response.status_code != 429: # 401: not authorized, 429: too many requests
-            params['Operational'] = False
+            if response.status_code == 200:
+                token_data = response.json()
+                params['access_token'] = token_data.get("access_token")
+                params['refresh_token'] = token_data.get("refresh_token")
 
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
+                print("Updated New Access and Refresh Tokens")
+
+                params['Operational'] = True
+                # not putting consecutive failures since this works even when api limit has been reached
+
+            else:
+                print(f"Error Refresh and Access: {response.status_code} - {response.text}")
+                # 401: not authorized, 429: too many requests
+                if response.status_code != 401 and response.status_code != 429:
+                    params['Operational'] = False
+
+            save_params(params, json_path)
 
 
 if __name__ == "__main__":
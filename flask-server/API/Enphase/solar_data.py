@@ -1,123 +1,142 @@
 import time
-
 import numpy as np
-import requests
 import pandas as pd
 import pathlib
 import json
-from API.Enphase.api_setup import Generate_New_Access_Token_From_Refresh_Token, get_params
-from Database.Site_Details_DB.setup_update_read import read_site_db
-from API.Fronius.solar_data import import_config_json as import_config_json_fr, get_site_details as get_site_details_fr
+from API import http_client, response_archive
+from API.backfill_checkpoint import load_checkpoint, record_checkpoint, clear_checkpoint
+from API.Enphase.api_setup import Generate_New_Access_Token_From_Refresh_Token, enphase_get
+from Database.Site_Details_DB.setup_update_read import read_db
+from Database.production_store import get_max_dates, get_write_lock
+from API.Fronius.solar_data import import_config_json as import_config_json_fr, \
+    cached_site_details as cached_site_details_fr
 from API.SolarEdge.solar_data import import_config_json as import_config_json_sol, \
-    get_site_details as get_site_details_sol
+    cached_site_details as cached_site_details_sol
+
+VENDOR = 'Enphase'
+SYSTEMS_PAGE_SIZE = 100
+# Calls that fail are retried with new tokens after 2, 4, 8... seconds, MAX_ATTEMPTS calls in all
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF_SECONDS = 2
+MAX_RETRY_BACKOFF_SECONDS = 30
+
+
+def call_with_new_tokens(function, *args, **kwargs):
+    """function(*args, **kwargs), called again with regenerated tokens and a doubling backoff while it returns None,
+    at most MAX_ATTEMPTS times. Raises RuntimeError once every attempt failed."""
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            print('Regenerating access and refresh tokens and trying again')
+            Generate_New_Access_Token_From_Refresh_Token()
+            time.sleep(min(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_RETRY_BACKOFF_SECONDS))
+        result = function(*args, **kwargs)
+        if result is not None:
+            return result
+    raise RuntimeError(f'{function.__name__} failed {MAX_ATTEMPTS} times')
 
 
 def list_all_sites():
-    params, json_path, json_file = get_params()
-
-    # Extract required parameters
-    oauth_access_token = params.get('access_token')
-    api_key = params.get('api_key')
-    endpoint = params.get('api_endpoint')
-
-    headers = {
-        'Authorization': f'Bearer {oauth_access_token}',
-        'key': api_key,
-        'Accept': 'application/json',
-    }
-
-    parameters = {
-        'page': 1,
-        'size': 100,
-        'sort_by': 'id',
-    }
-    response = requests.get(endpoint, headers=headers, params=parameters)
+    # Systems are listed SYSTEMS_PAGE_SIZE at a time
+    systems = []
+    page = 1
+    while True:
+        parameters = {
+            'page': page,
+            'size': SYSTEMS_PAGE_SIZE,
+            'sort_by': 'id',
+        }
+        response = enphase_get(params=parameters)
 
-    params['API_Count'] += 1
+        if response.status_code != 200:
+            print(f"Error Fetching all systems: {response.status_code} - {response.text}")
+            return None
 
-    if response.status_code == 200:
         systems_data = response.json()
-        systems_df = pd.DataFrame(systems_data['systems'])
-        params['Operational'] = True
-        params['Consecutive_Failures'] = 0
-    else:
-        print(f"Error Fetching all systems: {response.status_code} - {response.text}")
-        if response.status_code != 401 and response.status_code != 429:  # 401: not authorized, 429: too many requests
-            params['Operational'] = False
-        params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
-        systems_df = None
-
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
+        response_archive.archive_response(VENDOR, 'systems', systems_data)
+        systems.extend(systems_data['systems'])
+        if len(systems_data['systems']) < SYSTEMS_PAGE_SIZE:
+            break
+        page += 1
 
-    return systems_df
+    return pd.DataFrame(systems)
 
 
 def recursive_list_all_sites():
-    a = list_all_sites()
-    if a is not None:
-        return a
-    else:
-        print('An error occurred. Waiting for 90s, regenerating access and refresh tokens and trying again')
-        time.sleep(90)  # Sleep for 90 seconds
-        Generate_New_Access_Token_From_Refresh_Token()
-        return recursive_list_all_sites()
+    return call_with_new_tokens(list_all_sites)
+
 
+def get_fetch_start_dates(all_enphase_systems, prod_engine):
+    """{system_id: first day to fetch} for the systems already stored in prod_engine, the day after their latest
+    stored Date. Systems missing from it get their full history."""
+    max_dates = get_max_dates(prod_engine, all_enphase_systems['name'].tolist())
+    start_dates = {}
+    for system_id, name in zip(all_enphase_systems['system_id'], all_enphase_systems['name']):
+        if max_dates.get(name) is not None:
+            start_dates[system_id] = (max_dates[name].normalize() + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    return start_dates
 
-def production_for_site(engine=None):
-    params, json_path, json_file = get_params()
 
-    # Extract required parameters
-    oauth_access_token = params.get('access_token')
-    api_key = params.get('api_key')
-    api_endpoint = params.get('api_endpoint')
+def build_production_frame(start_date, production):
+    daily_production_data = np.array(production) / 1000  # converting from Wh to kWh
+    date_rng = pd.date_range(start=start_date, periods=len(daily_production_data), freq='D')
+    df = pd.DataFrame({'Date': date_rng, 'Production (kWh)': daily_production_data})
+    return df.set_index('Date')
 
+
+def production_for_site(engine=None, prod_engine=None):
+    """Daily production of every Enphase system, {site name: DataFrame}. With prod_engine only the days after each
+    system's latest stored Date are requested, without it every system's full history is, recording each one as it
+    completes so that the systems fetched before a failure or an interruption are not requested again."""
     if engine is None:
         all_enphase_systems = recursive_list_all_sites()
         print('Using API to get site data')
     else:
-        all_enphase_systems = read_site_db(engine)
-        all_enphase_systems = all_enphase_systems['Enphase']
+        all_enphase_systems = read_db(engine, 'Enphase_SD')
         print('Using database to get site data')
 
     system_id_list = all_enphase_systems['system_id'].tolist()
-
-    system_prod_data = {}
+    start_dates = {} if prod_engine is None else get_fetch_start_dates(all_enphase_systems, prod_engine)
+    completed = load_checkpoint(VENDOR, 'daily') if prod_engine is None else dict()
+    # energy_lifetime ends yesterday, systems stored up to then have nothing new
+    yesterday = (pd.Timestamp.today().normalize() - pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    up_to_date = [system_id for system_id in system_id_list if start_dates.get(system_id, '') > yesterday]
+    fetch_id_list = [system_id for system_id in system_id_list
+                     if system_id not in up_to_date and (system_id,) not in completed]
+
+    def fetch_system(system_id):
+        response = enphase_get(f'/{system_id}/energy_lifetime', params={'start_date': start_dates[system_id]}
+                               if system_id in start_dates else None)
+        if response.status_code == 200:
+            production_meter_readings_data = response.json()
+            response_archive.archive_response(VENDOR, 'energy_lifetime', production_meter_readings_data,
+                                              system_id=system_id)
+            if prod_engine is None:
+                record_checkpoint(VENDOR, 'daily', [((system_id,), {
+                    'start_date': production_meter_readings_data['start_date'],
+                    'production': production_meter_readings_data['production'],
+                })])
+        return response
+
+    # Make the GET requests, at most http_client's Enphase limit at once
+    responses = http_client.fetch_all(VENDOR, fetch_system, fetch_id_list)
+
+    system_prod_data = {system_id: pd.DataFrame({'Production (kWh)': []}, index=pd.DatetimeIndex([], name='Date'))
+                        for system_id in up_to_date}
     for system_id in system_id_list:
-        data_endpoint = api_endpoint + f'/{system_id}/energy_lifetime'
-
-        # Set up headers with OAuth 2.0 access token and API key
-        headers = {
-            'Authorization': f'Bearer {oauth_access_token}',
-            'key': api_key,
-            'Accept': 'application/json',
-        }
-
-        # Make the GET request
-        response = requests.get(data_endpoint, headers=headers)
-        params['API_Count'] += 1
-
+        if (system_id,) in completed:
+            system_prod_data[system_id] = build_production_frame(**completed[(system_id,)])
+    for system_id, response in zip(fetch_id_list, responses):
         if response.status_code == 200:
-            params['Operational'] = True
-            params['Consecutive_Failures'] = 0
             production_meter_readings_data = response.json()
 
-            start_date = production_meter_readings_data['start_date']
-            daily_production_data = production_meter_readings_data['production']
-            daily_production_data = np.array(daily_production_data) / 1000  # converting from Wh to kWh
-
-            date_rng = pd.date_range(start=start_date, periods=len(daily_production_data), freq='D')
-
-            df = pd.DataFrame({'Date': date_rng, 'Production (kWh)': daily_production_data})
+            df = build_production_frame(production_meter_readings_data['start_date'],
+                                        production_meter_readings_data['production'])
 
             if df is not None and system_prod_data is not None:
-                system_prod_data[system_id] = df.set_index('Date')
+                system_prod_data[system_id] = df
 
         else:
             print(f"Error: {response.status_code} - {response.text}")
-            if response.status_code != 401 and response.status_code != 429:  # 401: not authorized, 429: too many requests
-                params['Operational'] = False
-            params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
             system_prod_data = None
 
     system_prod_data_site_names = {}
@@ -129,56 +148,28 @@ def production_for_site(engine=None):
             system_prod_data_site_names[name] = system_prod_data.pop(id_name_map[name])
 
         system_prod_data = system_prod_data_site_names
-
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
+        if prod_engine is None:
+            clear_checkpoint(VENDOR, 'daily')
 
     return system_prod_data
 
 
-def recursive_production_for_site(engine=None):
-    a = production_for_site(engine=engine)
-    if a is not None:
-        return a
-    else:
-        print('Waiting for 90s, regenerating access and refresh tokens and trying again')
-        time.sleep(90)  # Sleep for 90 seconds
-        Generate_New_Access_Token_From_Refresh_Token()
-        return recursive_production_for_site(engine=engine)
+def recursive_production_for_site(engine=None, prod_engine=None):
+    return call_with_new_tokens(production_for_site, engine=engine, prod_engine=prod_engine)
 
 
 def production_for_site_15_min():
     """This function will not be used, no point in going further"""
-    # Load parameters from JSON file
-    params, json_path, json_file = get_params()
-
-    oauth_access_token = params.get('access_token')
-    api_key = params.get('api_key')
-    api_endpoint = params.get('api_endpoint')
-
     # Retrieve list of all Enphase systems
     all_enphase_systems = list_all_sites()
     system_id_list = all_enphase_systems['system_id'].tolist()
 
     system_prod_data = {}
     for system_id in system_id_list:
-        # Endpoint for 15-minute production data
-        data_endpoint = f"{api_endpoint}/{system_id}/telemetry/production_meter?granularity=15mins"
-
-        # Set up headers with OAuth 2.0 access token and API key
-        headers = {
-            'Authorization': f'Bearer {oauth_access_token}',
-            'key': api_key,
-            'Accept': 'application/json',
-        }
-
-        # Make the GET request
-        response = requests.get(data_endpoint, headers=headers)
-        params['API_Count'] += 1
+        # Make the GET request for 15-minute production data
+        response = enphase_get(f"/{system_id}/telemetry/production_meter", params={'granularity': '15mins'})
 
         if response.status_code == 200:
-            params['Operational'] = True
-            params['Consecutive_Failures'] = 0
             production_data = response.json()
 
             # Extract production data
@@ -190,12 +181,10 @@ def production_for_site_15_min():
             df['Timestamp'] = pd.to_datetime(df['Timestamp'], unit='s')  # Convert Unix timestamp to datetime
             df.set_index('Timestamp', inplace=True)
 
-            system_prod_data[system_id] = df
+            if system_prod_data is not None:
+                system_prod_data[system_id] = df
 
         else:
-            if response.status_code != 401 and response.status_code != 429:  # 401: not authorized, 429: too many requests
-                params['Operational'] = False
-            params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
             system_prod_data = None
 
     if system_prod_data is not None:
@@ -205,97 +194,61 @@ def production_for_site_15_min():
         for name in id_name_map.keys():
             system_prod_data[name] = system_prod_data.pop(id_name_map[name])
 
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
-
     return system_prod_data
 
 
 def recursive_15m_production_for_site():
     """This function will not be used, no point in going further"""
-    aa = production_for_site_15_min()
-    if aa is not None:
-        return aa
-    else:
-        time.sleep(90)  # Sleep for 90 seconds
-        print('Waiting for 90s, regenerating access and refresh tokens and trying again')
-        Generate_New_Access_Token_From_Refresh_Token()
-        return recursive_15m_production_for_site()
+    return call_with_new_tokens(production_for_site_15_min)
 
 
 def SiteSize_Enphase(sites_engine=None, all_enphase_systems=None):
     if all_enphase_systems is None:
         if sites_engine is None:
             all_enphase_systems = recursive_list_all_sites()
-            time.sleep(90)  # wait to not overload the Enphase API
             print('Using API to get site data')
         else:
-            all_enphase_systems = read_site_db(sites_engine)
-            all_enphase_systems = all_enphase_systems['Enphase']
+            all_enphase_systems = read_db(sites_engine, 'Enphase_SD')
             print('Using database to get site data')
     else:
         print('Using function parameter to get site data')
 
-    params, json_path, json_file = get_params()
-
-    # Extract required parameters
-    oauth_access_token = params.get('access_token')
-    api_key = params.get('api_key')
-    endpoint = params.get('api_endpoint')
-
-    headers = {
-        'Authorization': f'Bearer {oauth_access_token}',
-        'key': api_key,
-        'Accept': 'application/json',
-    }
-
     parameters = {
         'page': 1,
         'size': 100,
         'sort_by': 'id',
     }
 
+    system_id_list = all_enphase_systems['system_id'].tolist()
+    responses = http_client.fetch_all(
+        VENDOR,
+        lambda system_id: enphase_get(f"/{system_id}/summary", params=parameters),
+        system_id_list
+    )
+
     systems_df = []  # the naming is intentional even though it is an array
-    for system_id in all_enphase_systems['system_id']:
-        endpoint_site = endpoint + f"/{system_id}/summary"
-        response = requests.get(endpoint_site, headers=headers, params=parameters)
-        params['API_Count'] += 1
+    for system_id, response in zip(system_id_list, responses):
         if response.status_code == 200:
             systems_data = response.json()
+            response_archive.archive_response(VENDOR, 'summary', systems_data, system_id=system_id)
             systems_data = pd.DataFrame(systems_data, index=[system_id])
-            systems_df.append(systems_data)
-            params['Operational'] = True
-            params['Consecutive_Failures'] = 0
+            if systems_df is not None:
+                systems_df.append(systems_data)
         else:
             print(f"Error Fetching all systems: {response.status_code} - {response.text}")
-            if response.status_code != 401 and response.status_code != 429:  # 401: not authorized, 429: too many requests
-                params['Operational'] = False
-            params['Consecutive_Failures'] = params['Consecutive_Failures'] + 1
             systems_df = None
 
     if systems_df is not None:
         systems_df = pd.concat(systems_df)
 
-    with open(json_path, 'w') as json_file:
-        json.dump(params, json_file, indent=4)
-
     return systems_df
 
 
 def recursive_SiteSize_Enphase(all_enphase_systems=None):
-    aa = SiteSize_Enphase(all_enphase_systems=all_enphase_systems)
-    if aa is not None:
-        return aa
-    else:
-        time.sleep(90)  # Sleep for 90 seconds
-        print('Waiting for 90s, regenerating access and refresh tokens and trying again')
-        Generate_New_Access_Token_From_Refresh_Token()
-        return recursive_SiteSize_Enphase(all_enphase_systems=all_enphase_systems)
+    return call_with_new_tokens(SiteSize_Enphase, all_enphase_systems=all_enphase_systems)
 
 
-def update_or_initialize_site_db_setup(engine):
-    print("Creating or Updating Database...")
-
+def update_enphase_site_details(engine):
     print('Enphase Site Details')
     json_file = f'enphase_status_mapping.json'
     json_path = pathlib.Path(__file__).parents[0] / pathlib.Path(json_file)
@@ -308,25 +261,49 @@ def update_or_initialize_site_db_setup(engine):
     sites_data = sites_data.join(Site_Size['size_w'], on='system_id')
     sites_data['status'] = sites_data['status'].map(enphase_status_mapping)
     sites_data.set_index('system_id', inplace=True)
-    sites_data.to_sql('Enphase_SD', engine, if_exists='replace')
+    # The vendors' site details are written alongside each other and the Metrics / Alerts tabs
+    with get_write_lock(engine):
+        sites_data.to_sql('Enphase_SD', engine, if_exists='replace')
+
 
+def update_solaredge_site_details(engine):
     print('Solaredge Site Details')
     api_endpoint, api_key = import_config_json_sol()
-    site_ids, site_details = get_site_details_sol(api_key, api_endpoint, export_siteids=True)
+    # Refreshes the site metadata cache the production jobs read their site lists from
+    site_details = cached_site_details_sol(api_key, api_endpoint, refresh=True)
     site_df = pd.DataFrame(site_details).T.set_index('site name', drop=True)
     address_df = site_df['Location'].apply(pd.Series)
     site_df.drop(columns=['Location'], inplace=True)
     site_df.join(address_df)
-    site_df.to_sql('Solaredge_SD', engine, if_exists='replace')
+    with get_write_lock(engine):
+        site_df.to_sql('Solaredge_SD', engine, if_exists='replace')
 
+
+def update_fronius_site_details(engine):
     print('Fronius Site Details')
     api_endpoint, api_key = import_config_json_fr()
-    site_details = get_site_details_fr(api_key, api_endpoint)
+    site_details = cached_site_details_fr(api_key, api_endpoint, refresh=True)
     site_df = pd.DataFrame(site_details).T.set_index('site name', drop=True)
     address_df = site_df['Location'].apply(pd.Series)
     site_df.drop(columns=['Location', 'Devices'], inplace=True)
     site_df.join(address_df)
-    site_df.to_sql('Fronius_SD', engine, if_exists='replace')
+    with get_write_lock(engine):
+        site_df.to_sql('Fronius_SD', engine, if_exists='replace')
+
+
+# Site details table of every vendor, each written independently of the others
+SITE_DETAILS_UPDATES = {
+    'Enphase': update_enphase_site_details,
+    'SolarEdge': update_solaredge_site_details,
+    'Fronius': update_fronius_site_details,
+}
+
+
+def update_or_initialize_site_db_setup(engine):
+    print("Creating or Updating Database...")
+
+    for update_site_details in SITE_DETAILS_UPDATES.values():
+        update_site_details(engine)
 
     print("Site Details Database setup complete.")
     print()
@@ -334,6 +311,18 @@ def update_or_initialize_site_db_setup(engine):
     return
 
 
+def parse_archived_record(record):
+    """The production in an archived response, as [('daily', system_id, DataFrame)], or
+    [('sites', None, {system_id: site name})] for a systems list"""
+    response = record['body']
+    if record['kind'] == 'systems':
+        return [('sites', None, {system['system_id']: system['name'] for system in response['systems']})]
+    if record['kind'] == 'energy_lifetime':
+        return [('daily', record['context']['system_id'],
+                 build_production_frame(response['start_date'], response['production']))]
+    return []
+
+
 if __name__ == "__main__":
     # a = list_all_sites()
     # print(a)
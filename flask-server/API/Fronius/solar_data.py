@@ -1,49 +1,35 @@
 import time
 import requests
 import pandas as pd
-import os
 import json
 from datetime import datetime, timedelta
-import concurrent.futures
-from collections import defaultdict
-from math import ceil
-from calendar import monthrange
+from urllib.parse import urljoin
+from API import http_client, site_metadata, response_archive
+from API.backfill_checkpoint import load_checkpoint, record_checkpoint, clear_checkpoint
+from API.config_paths import get_config_path
+
+VENDOR = 'Fronius'
+# History is logged every 5 minutes and served at most HIST_PAGE_LIMIT entries per page. The first history window
+# spans one page at that resolution, the following ones are resized to what the previous one held, within
+# MIN_HIST_WINDOW and MAX_HIST_WINDOW.
+HIST_RESOLUTION_MINUTES = 5
+HIST_PAGE_LIMIT = 1000
+MIN_HIST_WINDOW = timedelta(hours=1)
+MAX_HIST_WINDOW = timedelta(days=14)
+# Failed requests are retried after 2, 4, 8... seconds, MAX_ATTEMPTS calls in all
+MAX_ATTEMPTS = 4
+RETRY_BACKOFF_SECONDS = 2
+MAX_RETRY_BACKOFF_SECONDS = 30
 
 
 def import_config_json():
-    configfile_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.json")
+    configfile_path = get_config_path(VENDOR, 'config.json')
     with open(configfile_path) as json_file:
         config_data = json.load(json_file)
 
     return config_data['api_endpoints'], config_data['api_key']
 
 
-def round_time(log_time):
-    rounded_minute = int(ceil(log_time.minute / 15.0)) * 15
-
-    if rounded_minute >= 60:
-        rounded_minute = 0  # Reset to 0 if it exceeds 59
-        if log_time.hour == 23:
-            # Increment day and reset hour to 0
-            next_day = log_time.day + 1
-            _, last_day_of_month = monthrange(log_time.year, log_time.month)
-            if next_day > last_day_of_month:
-                next_month = log_time.month + 1
-                if next_month > 12:
-                    next_month = 1
-                    next_year = log_time.year + 1
-                else:
-                    next_year = log_time.year
-                log_time = log_time.replace(year=next_year, month=next_month, day=1, hour=0)
-            else:
-                log_time = log_time.replace(day=next_day, hour=0)
-        else:
-            log_time = log_time.replace(hour=log_time.hour + 1)
-
-    rounded_time = datetime(log_time.year, log_time.month, log_time.day, log_time.hour, rounded_minute).strftime('%Y-%m-%dT%H:%M:%SZ')
-    return rounded_time
-
-
 def calc_start_date(site, api_endpoint, api_key, temp_startdate):
     payload = {
         'from': temp_startdate.split('T')[0],
@@ -51,13 +37,15 @@ def calc_start_date(site, api_endpoint, api_key, temp_startdate):
         'channel': 'EnergyOutput',
         'limit': 1
     }
-    response = requests.get(api_endpoint['aggr_data'].replace('{site}', site), params=payload,
-                            headers=api_key).json()
+    response = http_client.get(VENDOR, api_endpoint['aggr_data'].replace('{site}', site), params=payload,
+                               headers=api_key).json()
+    response_archive.archive_response(VENDOR, 'start_date', response, site=site)
     return response['data'][0]['logDateTime']
 
 
 def get_site_details(api_key, api_endpoints):
-    response = requests.get(api_endpoints['site_details'], headers=api_key).json()
+    response = http_client.get(VENDOR, api_endpoints['site_details'], headers=api_key).json()
+    response_archive.archive_response(VENDOR, 'site_details', response)
     site_details = dict()
     for site in response['pvSystems']:
         site_details[site['pvSystemId']] = dict()
@@ -77,7 +65,9 @@ def get_site_details(api_key, api_endpoints):
             'limit': 1000,
             'type': 'inverter'
         }
-        response = requests.get(api_endpoints["site_devices"].replace("{site}", site['pvSystemId']), headers=api_key, params=payload).json()
+        response = http_client.get(VENDOR, api_endpoints["site_devices"].replace("{site}", site['pvSystemId']),
+                                   headers=api_key, params=payload).json()
+        response_archive.archive_response(VENDOR, 'site_devices', response, site=site['pvSystemId'])
         site_details[site['pvSystemId']]["Devices"] = dict()
         for device in response['devices']:
             site_details[site['pvSystemId']]["Devices"][device['deviceId']] = dict()
@@ -92,87 +82,140 @@ def get_site_details(api_key, api_endpoints):
     return site_details
 
 
-def fetch_hist_data(site, api_key, api_endpoint, start_date):
-    end_date = (datetime.utcnow() - timedelta(hours=6))
-    delta = timedelta(days=1)
-    interval_start_date = datetime.strptime(start_date, '%Y-%m-%d')
-    interval_date = interval_start_date + delta
-    compiled_data = []
-
-    while interval_date < end_date:
-        payload = {
-            'from': interval_start_date.strftime('%Y-%m-%dT%H:%M:%S'),
-            'to': interval_date.strftime('%Y-%m-%dT%H:%M:%S'),
-            'channel': 'EnergyProductionTotal',
-            'limit': 1000,
-            'timezone': 'local'
-        }
-        response = requests.get(api_endpoint['hist_data'].replace('{site}', site), params=payload, headers=api_key)
+def cached_site_details(api_key, api_endpoints, refresh=False):
+    """get_site_details through the site metadata cache, refresh reloads it"""
+    return site_metadata.get_site_metadata(VENDOR, lambda: get_site_details(api_key, api_endpoints), refresh=refresh)
 
-        # Check if API call is successful
-        if response.status_code != 200:
-            print(
-                f"Failed to fetch data for {interval_start_date.strftime('%Y-%m-%d')}. Status Code: {response.status_code}")
-            continue
 
+def get_with_retry(url, **kwargs):
+    """http_client.get retried on connection errors, 429s and 5xx responses with a doubling backoff, at most
+    MAX_ATTEMPTS times. Returns the decoded JSON, None if every attempt failed."""
+    for attempt in range(MAX_ATTEMPTS):
+        if attempt:
+            time.sleep(min(RETRY_BACKOFF_SECONDS * 2 ** (attempt - 1), MAX_RETRY_BACKOFF_SECONDS))
         try:
-            data = response.json()['data']
-        except ValueError:
-            print("Failed to decode JSON response")
+            response = http_client.get(VENDOR, url, **kwargs)
+        except requests.RequestException as error:
+            print(f'Fronius request failed: {error}')
             continue
+        if response.status_code == 200:
+            try:
+                return response.json()
+            except ValueError:
+                print("Failed to decode JSON response")
+                continue
+        print(f'Fronius request failed. Status Code: {response.status_code}')
+        if response.status_code != 429 and response.status_code < 500:
+            break
+    return None
 
-        data_aggr = defaultdict(float)
 
-        if not data:
-            datetime_range = pd.date_range(interval_start_date, interval_date, freq='15min').strftime(
-                '%Y-%m-%dT%H:%M:%SZ')
-            for date_time in datetime_range:
-                data_aggr[date_time] = 0
-        else:
-            for entry in data:
-                log_time = datetime.strptime(entry['logDateTime'], '%Y-%m-%dT%H:%M:%S%z')
-                rounded_time = round_time(log_time)
-                data_aggr[rounded_time] += entry['channels'][0]['value']
+def fetch_hist_window(site, api_key, api_endpoint, window_start, window_end):
+    """Every history entry of the window, following the API's next links past the first page. Returns
+    (entries, item_count), None if a page could not be fetched."""
+    payload = {
+        'from': window_start.strftime('%Y-%m-%dT%H:%M:%S'),
+        'to': window_end.strftime('%Y-%m-%dT%H:%M:%S'),
+        'channel': 'EnergyProductionTotal',
+        'limit': HIST_PAGE_LIMIT,
+        'timezone': 'local'
+    }
+    url = api_endpoint['hist_data'].replace('{site}', site)
+    entries = []
+    item_count = None
+    while url is not None:
+        response = get_with_retry(url, params=payload, headers=api_key)
+        if response is None:
+            return None
+        response_archive.archive_response(VENDOR, 'hist_data', response, site=site, first_page=item_count is None,
+                                          **{'from': window_start.strftime('%Y-%m-%dT%H:%M:%S'),
+                                             'to': window_end.strftime('%Y-%m-%dT%H:%M:%S')})
+        entries.extend(response['data'] or [])
+        links = response.get('links') or {}
+        if item_count is None:
+            item_count = links.get('totalItemsCount', len(entries))
+        # next links carry the query themselves
+        url = urljoin(url, links['next']) if links.get('next') else None
+        payload = None
+    return entries, item_count
 
-        for date, data in data_aggr.items():
-            compiled_data.append({'date': date, 'value': data})
 
+def fetch_hist_data(site, api_key, api_endpoint, start_date):
+    """15 minute production (Wh) of the site by Timestamp from start_date up to the last full hour. Windows are sized
+    from the number of entries the previous one held so that each fills about one page. Windows that still fail
+    after the retries are reported and skipped."""
+    end_date = (datetime.utcnow() - timedelta(hours=6)).replace(minute=0, second=0, microsecond=0)
+    interval_start_date = datetime.strptime(start_date, '%Y-%m-%d')
+    window = timedelta(minutes=HIST_RESOLUTION_MINUTES * HIST_PAGE_LIMIT)
+    entries = dict()
+    fetched_windows = []
+    failed_windows = []
+
+    while interval_start_date < end_date:
+        interval_date = min(interval_start_date + window, end_date)
+        result = fetch_hist_window(site, api_key, api_endpoint, interval_start_date, interval_date)
+        if result is None:
+            failed_windows.append((interval_start_date, interval_date))
+        else:
+            window_entries, item_count = result
+            fetched_windows.append((interval_start_date, interval_date))
+            # Entries on the boundary of two windows are returned by both
+            for entry in window_entries:
+                entries[entry['logDateTime']] = entry['channels'][0]['value']
+            span = interval_date - interval_start_date
+            window = min(max(span * HIST_PAGE_LIMIT / item_count if item_count else span * 2, MIN_HIST_WINDOW),
+                         MAX_HIST_WINDOW)
         interval_start_date = interval_date
-        interval_date += delta
-        diff_end_interval = end_date - interval_start_date
-        if diff_end_interval.days < 1 and diff_end_interval.seconds > 3600:
-            interval_date = end_date.replace(minute=0, second=0)
 
-    return site, compiled_data
+    return site, bin_hist_entries(entries, fetched_windows), failed_windows
+
+
+def bin_hist_entries(entries, fetched_windows):
+    """15 minute production (Wh) by Timestamp out of {logDateTime: value} history entries of the fetched windows.
+    Every quarter hour of the windows falling on a day without any entry counts as zero production, as when each
+    day was requested on its own."""
+    # Entries are binned on their local wall clock time, the minute rounded up to the next quarter hour
+    log_times = pd.to_datetime(pd.Index(list(entries), dtype=object).str[:19], format='%Y-%m-%dT%H:%M:%S')
+    production = pd.Series(list(entries.values()), index=log_times.floor('min').ceil('15min'), dtype=float)
+    window_times = pd.DatetimeIndex([]).append(
+        [pd.date_range(window_start, window_end, freq='15min') for window_start, window_end in fetched_windows])
+    empty_times = window_times[~window_times.normalize().isin(log_times.normalize())]
+    zeros = pd.Series(0.0, index=empty_times)
+    return pd.concat([zeros, production]).groupby(level=0).sum()
+
+
+def build_hist_frame(production):
+    return (production.dropna() / 1000).rename('Production (kWh)').rename_axis('Date').to_frame()
 
 
 def get_aggr_15min_data(api_key, api_endpoints, site_details, fetch_everything):
-    hist_data = dict()
     site_hist_data = dict()
     two_months_ago = (datetime.utcnow() - timedelta(days=60, hours=6)).strftime('%Y-%m-%d')
     start_date_update = (datetime.utcnow() - timedelta(days=2, hours=6)).strftime('%Y-%m-%d')
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for site, site_detail in site_details.items():
-            if fetch_everything:
-                futures.append(executor.submit(fetch_hist_data, site, api_key, api_endpoints, two_months_ago))
-            else:
-                futures.append(executor.submit(fetch_hist_data, site, api_key, api_endpoints, start_date_update))
-
-        for future in concurrent.futures.as_completed(futures):
-            site, data = future.result()
-            hist_data[site] = data
-            site_df = (
-                pd.DataFrame(hist_data[site])
-                .dropna()
-                .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-            )
-            site_df['Date'] = pd.to_datetime(site_df['Date']).dt.strftime("%Y-%m-%d %H:%M:%S")
-            site_df.set_index('Date', inplace=True)
-            site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-            site_df.drop(columns=['Production (Wh)'], inplace=True)
-            site_hist_data[site_details[site]['site name']] = site_df
+    start_date = two_months_ago if fetch_everything else start_date_update
+    # A full fetch records every site fetched without failures, so that an interrupted one resumes with the others
+    completed = load_checkpoint(VENDOR, '15min') if fetch_everything else dict()
+
+    def fetch_site(site):
+        if (site,) in completed:
+            dates, values = completed[(site,)]
+            return site, pd.Series(values, index=pd.to_datetime(dates), dtype=float), []
+        site, production, failed_windows = fetch_hist_data(site, api_key, api_endpoints, start_date)
+        if fetch_everything and not failed_windows:
+            record_checkpoint(VENDOR, '15min', [((site,), [production.index.strftime('%Y-%m-%d %H:%M:%S').tolist(),
+                                                           production.tolist()])])
+        return site, production, failed_windows
+
+    results = http_client.fetch_all(VENDOR, fetch_site, site_details.keys())
+    for site, production, failed_windows in results:
+        if failed_windows:
+            print(f"Failed to fetch {len(failed_windows)} history windows of {site_details[site]['site name']} "
+                  f"between {failed_windows[0][0]} and {failed_windows[-1][1]}")
+        site_hist_data[site_details[site]['site name']] = build_hist_frame(production)
+
+    if fetch_everything:
+        clear_checkpoint(VENDOR, '15min')
     return site_hist_data
 
 
@@ -187,73 +230,117 @@ def fetch_aggr_data(site, api_key, api_endpoint, start_date):
             'channel': 'EnergyOutput',
             'limit': 1000
         }
-        response = requests.get(api_endpoint['aggr_data'].replace('{site}', site), params=payload,
-                                headers=api_key).json()
+        response = http_client.get(VENDOR, api_endpoint['aggr_data'].replace('{site}', site), params=payload,
+                                   headers=api_key).json()
+        response_archive.archive_response(VENDOR, 'aggr_data', response, site=site, **{'from': start_date,
+                                                                                        'to': end_date})
 
+        compiled_data.extend(aggr_page_data(response, start_date, end_date))
         if response['links']['totalItemsCount'] == 0:
-            date_range = pd.date_range(start_date, end_date, freq='D')
-            for date_day in date_range:
-                data_org = {'date': date_day.strftime('%Y-%m-%d'), 'value': 0}
-                compiled_data.append(data_org)
             break
 
-        for data in response['data']:
-            data_org = {'date': data['logDateTime'], 'value': data['channels'][0]['value']}
-            compiled_data.append(data_org)
-
         # print(compiled_data)
 
         if compiled_data[-1]['date'] == end_date:
             break
         else:
-            start_date = (datetime.strptime(compiled_data[-1]['date'], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+            next_day = datetime.strptime(compiled_data[-1]['date'], '%Y-%m-%d') + timedelta(days=1)
+            start_date = next_day.strftime('%Y-%m-%d')
 
     return site, compiled_data
 
 
+def aggr_page_data(response, start_date, end_date):
+    """[{'date', 'value'}, ...] out of a page of daily values requested from start_date to end_date, every day of
+    which is zero when the site logged none"""
+    if response['links']['totalItemsCount'] == 0:
+        date_range = pd.date_range(start_date, end_date, freq='D')
+        return [{'date': date_day.strftime('%Y-%m-%d'), 'value': 0} for date_day in date_range]
+
+    return [{'date': data['logDateTime'], 'value': data['channels'][0]['value']} for data in response['data']]
+
+
+def build_daily_frame(compiled_data):
+    site_df = (
+        pd.DataFrame(compiled_data)
+        .dropna()
+        .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
+        .set_index('Date')
+    )
+    site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
+    site_df.drop(columns=['Production (Wh)'], inplace=True)
+    return site_df
+
+
 def get_aggr_daily_data(api_key, api_endpoints, site_details, fetch_everything):
     aggr_data = dict()
     site_daily_data = dict()
     start_date_update = (datetime.utcnow() - timedelta(days=2, hours=6)).strftime('%Y-%m-%d')
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-
-        for site, site_detail in site_details.items():
-            if fetch_everything:
-                futures.append(executor.submit(fetch_aggr_data, site, api_key, api_endpoints, site_detail['startdate']))
-            else:
-                futures.append(executor.submit(fetch_aggr_data, site, api_key, api_endpoints, start_date_update))
-
-        for future in concurrent.futures.as_completed(futures):
-            site, data = future.result()
-            aggr_data[site] = data
-            site_df = (
-                pd.DataFrame(aggr_data[site])
-                .dropna()
-                .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-                .set_index('Date')
-            )
-            site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-            site_df.drop(columns=['Production (Wh)'], inplace=True)
-            site_daily_data[site_details[site]['site name']] = site_df
+    # A full fetch records every site as it completes, so that an interrupted one resumes with the others
+    completed = load_checkpoint(VENDOR, 'daily') if fetch_everything else dict()
+
+    def fetch_site(site):
+        if (site,) in completed:
+            return site, completed[(site,)]
+        site, data = fetch_aggr_data(site, api_key, api_endpoints,
+                                     site_details[site]['startdate'] if fetch_everything else start_date_update)
+        if fetch_everything:
+            record_checkpoint(VENDOR, 'daily', [((site,), data)])
+        return site, data
+
+    results = http_client.fetch_all(VENDOR, fetch_site, site_details.keys())
+    for site, data in results:
+        aggr_data[site] = data
+        site_daily_data[site_details[site]['site name']] = build_daily_frame(aggr_data[site])
+
+    if fetch_everything:
+        clear_checkpoint(VENDOR, 'daily')
     return site_daily_data
 
 
 def fronius_daily_data(fetch_everything=True):
     api_endpoint, api_key = import_config_json()
-    site_details = get_site_details(api_key, api_endpoint)
+    site_details = cached_site_details(api_key, api_endpoint)
     aggr_data = get_aggr_daily_data(api_key, api_endpoint, site_details, fetch_everything)
     return aggr_data
 
 
 def fronius_15min_data(fetch_everything=True):
     api_endpoint, api_key = import_config_json()
-    site_details = get_site_details(api_key, api_endpoint)
+    site_details = cached_site_details(api_key, api_endpoint)
     hist_data = get_aggr_15min_data(api_key, api_endpoint, site_details, fetch_everything)
     return hist_data
 
 
+def parse_archived_record(record):
+    """The production in an archived response, as [(table, site, data)] or [('sites', None, {site: site name})] for
+    a site list. Daily data is a DataFrame built like get_aggr_daily_data does. 15 minute data is the history
+    entries, ({logDateTime: value}, [fetched window]), to be binned with the other pages by merge_archived_hist."""
+    response, context = record['body'], record['context']
+    if record['kind'] == 'site_details':
+        return [('sites', None, {site['pvSystemId']: site['name'] for site in response['pvSystems']})]
+    if record['kind'] == 'aggr_data':
+        return [('daily', context['site'], build_daily_frame(aggr_page_data(response, context['from'],
+                                                                            context['to'])))]
+    if record['kind'] == 'hist_data':
+        entries = {entry['logDateTime']: entry['channels'][0]['value'] for entry in response['data'] or []}
+        fetched_windows = [(context['from'], context['to'])] if context['first_page'] else []
+        return [('15min', context['site'], (entries, fetched_windows))]
+    return []
+
+
+def merge_archived_hist(pieces):
+    """15 minute production frame of a site out of its parsed hist_data pages in fetch order, each entry taken
+    from the latest page holding it"""
+    entries = dict()
+    fetched_windows = []
+    for page_entries, page_fetched_windows in pieces:
+        entries.update(page_entries)
+        fetched_windows.extend(page_fetched_windows)
+    return build_hist_frame(bin_hist_entries(entries, fetched_windows))
+
+
 if __name__ == '__main__':
     start = time.perf_counter()
     prod_data = fronius_15min_data(fetch_everything=False)
@@ -263,6 +350,6 @@ if __name__ == '__main__':
     prod_data_dict = prod_data['Haskayne Legacy Park'].to_dict()
     print()
     for date, data in prod_data_dict['Production (kWh)'].items():
-        if '2024-03-26' in date:
+        if date.strftime('%Y-%m-%d') == '2024-03-26':
             final_data += data
     print(final_data)
\ No newline at end of file
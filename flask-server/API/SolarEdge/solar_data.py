@@ -1,14 +1,20 @@
-import requests
 import pandas as pd
 import json
 from datetime import datetime, timedelta
-import os
-import concurrent.futures
 import time
+from API import http_client, site_metadata, response_archive
+from API.backfill_checkpoint import load_checkpoint, record_checkpoint, clear_checkpoint
+from API.config_paths import get_config_path
+
+VENDOR = 'SolarEdge'
+# Limits of the multi-site energy endpoint (sites_aggr_data): at most 100 sites per call, and a date span of one year
+# for DAY values or one month for QUARTER_OF_AN_HOUR ones. The windows built below stay within those spans.
+# The site list and site_date_range endpoints take at most 100 sites per call as well.
+MAX_BULK_SITES = 100
 
 
 def import_config_json():
-    configfile_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config.json")
+    configfile_path = get_config_path(VENDOR, 'config.json')
     with open(configfile_path) as json_file:
         config_data = json.load(json_file)
 
@@ -52,12 +58,8 @@ def get_yearly_daterange(start_date):
     return date_range
 
 
-def get_site_details(api_key, api_endpoint, export_siteids=False):
-    payload = {
-        "searchText": "Calgary",
-        "api_key": api_key
-    }
-    response = requests.get(api_endpoint['site_list'], params=payload).json()
+def parse_site_list(response):
+    """Details of the City's sites out of a site_list response, by site ID"""
     site_details = dict()
     for site in response["sites"]["site"]:
         if site['accountId'] == 62361 and 'CoC' in site['name']:
@@ -67,14 +69,41 @@ def get_site_details(api_key, api_endpoint, export_siteids=False):
             site_details[site['id']]['Peak Power'] = site['peakPower']
             location_values = ('country', 'state', 'city', 'address', 'zip')
             site_details[site['id']]['Location'] = {x: site['location'][x] for x in location_values}
+    return site_details
+
+
+def get_site_details(api_key, api_endpoint, export_siteids=False):
+    # The site list is served in pages of at most MAX_BULK_SITES sites
+    site_details = dict()
+    start_index = 0
+    while True:
+        payload = {
+            "searchText": "Calgary",
+            "size": MAX_BULK_SITES,
+            "startIndex": start_index,
+            "api_key": api_key
+        }
+        response = http_client.get(VENDOR, api_endpoint['site_list'], params=payload).json()
+        response_archive.archive_response(VENDOR, 'site_list', response)
+        site_details.update(parse_site_list(response))
+        start_index += MAX_BULK_SITES
+        if start_index >= response['sites']['count']:
+            break
+
     payload = {
         "api_key": api_key
     }
-    site_ids = ",".join(str(site_id) for site_id in site_details.keys())
-    response = requests.get(api_endpoint['site_date_range'].replace('{site}', site_ids), params=payload).json()
+    site_id_list = list(site_details.keys())
+    for i in range(0, len(site_id_list), MAX_BULK_SITES):
+        batch_ids = ",".join(str(site_id) for site_id in site_id_list[i:i + MAX_BULK_SITES])
+        response = http_client.get(VENDOR, api_endpoint['site_date_range'].replace('{site}', batch_ids),
+                                   params=payload).json()
+        response_archive.archive_response(VENDOR, 'site_date_range', response)
 
-    for site in response['datePeriodList']['siteEnergyList']:
-        site_details[site['siteId']]['start_date'] = site['dataPeriod']['startDate']
+        for site in response['datePeriodList']['siteEnergyList']:
+            site_details[site['siteId']]['start_date'] = site['dataPeriod']['startDate']
+
+    site_ids = ",".join(str(site_id) for site_id in site_id_list)
 
     if export_siteids:
         return site_ids, site_details
@@ -82,6 +111,11 @@ def get_site_details(api_key, api_endpoint, export_siteids=False):
         return site_details
 
 
+def cached_site_details(api_key, api_endpoint, refresh=False):
+    """get_site_details through the site metadata cache, refresh reloads it"""
+    return site_metadata.get_site_metadata(VENDOR, lambda: get_site_details(api_key, api_endpoint), refresh=refresh)
+
+
 def fetch_aggr_data_day(site, api_key, api_endpoint, startdate, enddate):
     payload = {
         'api_key': api_key,
@@ -89,8 +123,8 @@ def fetch_aggr_data_day(site, api_key, api_endpoint, startdate, enddate):
         'endDate': enddate,
         'timeUnit': 'DAY'
     }
-    response = requests.get(api_endpoint['site_aggr_data'].replace('{site}', str(site)), params=payload)
-    return site, response.json()['energy']['values']
+    response = http_client.get(VENDOR, api_endpoint['site_aggr_data'].replace('{site}', str(site)), params=payload)
+    return archive_energy_response(response.json(), [site], payload)[0]
 
 
 def fetch_aggr_data_15min(site, api_key, api_endpoint, startdate, enddate):
@@ -100,62 +134,107 @@ def fetch_aggr_data_15min(site, api_key, api_endpoint, startdate, enddate):
         'endDate': enddate,
         'timeUnit': 'QUARTER_OF_AN_HOUR'
     }
-    response = requests.get(api_endpoint['site_aggr_data'].replace('{site}', str(site)), params=payload)
-    return site, response.json()['energy']['values']
-
-# Do we need parallelization? I know why we are using it but it seems unstable only because we are relying on an external api
-# def get_aggr_data(api_key, api_endpoint, site_details):
-#     aggr_data = dict()
-#     site_daily_data = dict()
-#
-#     with concurrent.futures.ThreadPoolExecutor() as executor:
-#         futures = []
-#         for site, site_detail in site_details.items():
-#             date_range = get_yearly_daterange(site_detail['start_date'])
-#             aggr_data[site] = []
-#             for startdate, enddate in zip(date_range['startdates'], date_range['enddates']):
-#                 futures.append(executor.submit(fetch_aggr_data_15min, site, api_key, api_endpoint, startdate, enddate))
-#                 time.sleep(0.1)
-#
-#         for future in concurrent.futures.as_completed(futures):
-#             site, data = future.result()
-#             aggr_data[site].extend(data)
-#
-#             site_df = (
-#                 pd.DataFrame(aggr_data[site])
-#                 .dropna()
-#                 .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-#                 .set_index('Date')
-#             )
-#             site_daily_data[site_details[site]['site name']] = site_df
-#
-#     return site_daily_data
+    response = http_client.get(VENDOR, api_endpoint['site_aggr_data'].replace('{site}', str(site)), params=payload)
+    return archive_energy_response(response.json(), [site], payload)[0]
+
+
+def fetch_bulk_aggr_data(site_ids, api_key, api_endpoint, startdate, enddate, time_unit):
+    """Energy values of up to MAX_BULK_SITES sites in one call, as [(site, values), ...]"""
+    payload = {
+        'api_key': api_key,
+        'startDate': startdate,
+        'endDate': enddate,
+        'timeUnit': time_unit
+    }
+    site_ids_str = ",".join(str(site_id) for site_id in site_ids)
+    response = http_client.get(VENDOR, api_endpoint['sites_aggr_data'].replace('{site}', site_ids_str), params=payload)
+    return archive_energy_response(response.json(), list(site_ids), payload)
+
+
+def archive_energy_response(response, site_ids, payload):
+    """Archives an energy response with the sites and dates it was requested for, returns its energy_values"""
+    response_archive.archive_response(VENDOR, 'energy', response, sites=site_ids, startDate=payload['startDate'],
+                                      endDate=payload['endDate'], timeUnit=payload['timeUnit'])
+    return energy_values(response, site_ids)
+
+
+def energy_values(response, site_ids):
+    """[(site, values), ...] out of a site_aggr_data response of site_ids[0] or a sites_aggr_data one"""
+    if 'sitesEnergy' in response:
+        return [(site['siteId'], site['energyValues']['values']) for site in response['sitesEnergy']['siteEnergyList']]
+    return [(site_ids[0], response['energy']['values'])]
+
+
+def build_site_frame(values, drop_last=False):
+    """Production (kWh) by Date out of the energy values of a site. drop_last leaves out the interval in progress."""
+    site_df = (
+        pd.DataFrame(values, columns=['date', 'value'])
+        .dropna()
+        .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
+        .set_index('Date')
+    )
+    site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
+    site_df.drop(columns=['Production (Wh)'], inplace=True)
+    if drop_last:
+        site_df = site_df.head(len(site_df) - 1)
+    return site_df
+
+
+def fetch_sites_data(time_unit, api_key, api_endpoint, site_windows, resumable=False):
+    """Fetches every (site, startdate, enddate) window, at most http_client's SolarEdge limit at once, and returns
+    {site: values} with each site's values in window order.
+    With a sites_aggr_data endpoint in config.json, sites sharing a window are fetched together in batches of
+    MAX_BULK_SITES, otherwise every window is its own call. resumable skips the windows recorded in the backfill
+    checkpoint and records the ones fetched now, except for each site's last window: it is still open, so a resumed
+    backfill fetches it again."""
+    fetched = load_checkpoint(VENDOR, time_unit) if resumable else dict()
+    last_windows = dict()
+    for window in site_windows:
+        if window[0] not in last_windows or window[2] > last_windows[window[0]][2]:
+            last_windows[window[0]] = window
+    for window in last_windows.values():
+        fetched.pop(window, None)
+    pending_windows = [window for window in site_windows if window not in fetched]
+
+    if 'sites_aggr_data' not in api_endpoint:
+        fetch = fetch_aggr_data_day if time_unit == 'DAY' else fetch_aggr_data_15min
+        tasks = [([site], startdate, enddate) for site, startdate, enddate in pending_windows]
+        fetch_task = lambda task: [fetch(task[0][0], api_key, api_endpoint, task[1], task[2])]
+    else:
+        window_sites = dict()
+        for site, startdate, enddate in pending_windows:
+            window_sites.setdefault((startdate, enddate), []).append(site)
+        tasks = [(sites[i:i + MAX_BULK_SITES], startdate, enddate)
+                 for (startdate, enddate), sites in window_sites.items()
+                 for i in range(0, len(sites), MAX_BULK_SITES)]
+        fetch_task = lambda task: fetch_bulk_aggr_data(task[0], api_key, api_endpoint, task[1], task[2], time_unit)
+
+    def run_task(task):
+        site_results = fetch_task(task)
+        if resumable:
+            record_checkpoint(VENDOR, time_unit, [((site, task[1], task[2]), data) for site, data in site_results])
+        return site_results, task[1], task[2]
+
+    for site_results, startdate, enddate in http_client.fetch_all(VENDOR, run_task, tasks):
+        for site, data in site_results:
+            fetched[(site, startdate, enddate)] = data
+
+    aggr_data = dict()
+    for window in site_windows:
+        aggr_data.setdefault(window[0], []).extend(fetched.get(window, []))
+    return aggr_data
 
 
 def get_aggr_data_day(fetch_everything=True):
     api_endpoint, api_key = import_config_json()
-    site_details = get_site_details(api_key, api_endpoint, export_siteids=False)
-    aggr_data = dict()
-    site_daily_data = dict()
+    site_details = cached_site_details(api_key, api_endpoint)
 
+    site_windows = []
     for site, site_detail in site_details.items():
-        date_range = get_yearly_daterange(site_detail['start_date'])
-        aggr_data[site] = []
         if fetch_everything is True:
+            date_range = get_yearly_daterange(site_detail['start_date'])
             for startdate, enddate in zip(date_range['startdates'], date_range['enddates']):
-                site, data = fetch_aggr_data_day(site, api_key, api_endpoint, startdate, enddate)
-                aggr_data[site].extend(data)
-
-                site_df = (
-                    pd.DataFrame(aggr_data[site])
-                    .dropna()
-                    .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-                    .set_index('Date')
-                )
-                site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-                site_df.drop(columns=['Production (Wh)'], inplace=True)
-                site_daily_data[site_details[site]['site name']] = site_df
-
+                site_windows.append((site, startdate, enddate))
         else:
             today_date = datetime.today()
             days_cushion = 5
@@ -165,54 +244,32 @@ def get_aggr_data_day(fetch_everything=True):
 
             startdate = today_date - timedelta(days=days_cushion)
             startdate = startdate.strftime('%Y-%m-%d')
+            site_windows.append((site, startdate, enddate))
 
-            site, data = fetch_aggr_data_day(site, api_key, api_endpoint, startdate, enddate)
-            aggr_data[site].extend(data)
-
-            site_df = (
-                pd.DataFrame(aggr_data[site])
-                .dropna()
-                .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-                .set_index('Date')
-            )
-            site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-            site_df.drop(columns=['Production (Wh)'], inplace=True)
-            site_daily_data[site_details[site]['site name']] = site_df
-
-    for key, value in site_daily_data.items():
-        value.index = pd.to_datetime(value.index)
-        site_daily_data[key] = value[value.index < pd.Timestamp.today().normalize()]
+    aggr_data = fetch_sites_data('DAY', api_key, api_endpoint, site_windows, resumable=fetch_everything)
+    site_daily_data = dict()
+    for site, values in aggr_data.items():
+        site_df = build_site_frame(values)
+        site_df.index = pd.to_datetime(site_df.index)
+        site_daily_data[site_details[site]['site name']] = site_df[site_df.index < pd.Timestamp.today().normalize()]
 
+    if fetch_everything is True:
+        clear_checkpoint(VENDOR, 'DAY')
     return site_daily_data
 
 
 def get_aggr_data_15min(fetch_everything=True):
     api_endpoint, api_key = import_config_json()
-    site_details = get_site_details(api_key, api_endpoint, export_siteids=False)
-    aggr_data = dict()
-    site_daily_data = dict()
+    site_details = cached_site_details(api_key, api_endpoint)
     current_date = datetime.now()
     two_months_ago = current_date - timedelta(days=60)
 
+    site_windows = []
     for site, site_detail in site_details.items():
-        date_range = get_monthly_daterange(two_months_ago)
-        aggr_data[site] = []
         if fetch_everything is True:
+            date_range = get_monthly_daterange(two_months_ago)
             for startdate, enddate in zip(date_range['startdates'], date_range['enddates']):
-                site, data = fetch_aggr_data_15min(site, api_key, api_endpoint, startdate, enddate)
-                aggr_data[site].extend(data)
-
-                site_df = (
-                    pd.DataFrame(aggr_data[site])
-                    .dropna()
-                    .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-                    .set_index('Date')
-                )
-                site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-                site_df.drop(columns=['Production (Wh)'], inplace=True)
-                site_df = site_df.head(len(site_df) - 1)
-                site_daily_data[site_details[site]['site name']] = site_df
-
+                site_windows.append((site, startdate, enddate))
         else:
             today_date = datetime.today()
             days_cushion = 2
@@ -222,24 +279,42 @@ def get_aggr_data_15min(fetch_everything=True):
 
             startdate = today_date - timedelta(days=days_cushion)
             startdate = startdate.strftime('%Y-%m-%d')
+            site_windows.append((site, startdate, enddate))
 
-            site, data = fetch_aggr_data_15min(site, api_key, api_endpoint, startdate, enddate)
-            aggr_data[site].extend(data)
-
-            site_df = (
-                pd.DataFrame(aggr_data[site])
-                .dropna()
-                .rename(columns={'date': 'Date', 'value': 'Production (Wh)'})
-                .set_index('Date')
-            )
-            site_df['Production (kWh)'] = site_df['Production (Wh)'] / 1000
-            site_df.drop(columns=['Production (Wh)'], inplace=True)
-            site_df = site_df.head(len(site_df) - 1)
-            site_daily_data[site_details[site]['site name']] = site_df
+    aggr_data = fetch_sites_data('QUARTER_OF_AN_HOUR', api_key, api_endpoint, site_windows,
+                                 resumable=fetch_everything)
+    site_daily_data = dict()
+    for site, values in aggr_data.items():
+        site_daily_data[site_details[site]['site name']] = build_site_frame(values, drop_last=True)
 
+    if fetch_everything is True:
+        clear_checkpoint(VENDOR, 'QUARTER_OF_AN_HOUR')
     return site_daily_data
 
 
+def parse_archived_record(record):
+    """The production in an archived response, as [(table, site, DataFrame)] built like the fetches above do, or
+    [('sites', None, {site: site name})] for a site list. Values of the day or interval still in progress when the
+    response was fetched are left out."""
+    response, context = record['body'], record['context']
+    if record['kind'] == 'site_list':
+        return [('sites', None, {site: details['site name'] for site, details in parse_site_list(response).items()})]
+    if record['kind'] != 'energy':
+        return []
+
+    fetched_at = datetime.fromisoformat(record['fetched_at'])
+    parsed = []
+    for site, values in energy_values(response, context['sites']):
+        if context['timeUnit'] == 'DAY':
+            site_df = build_site_frame(values)
+            site_df.index = pd.to_datetime(site_df.index)
+            parsed.append(('daily', site, site_df[site_df.index < pd.Timestamp(fetched_at.date())]))
+        else:
+            in_progress = context['endDate'] >= fetched_at.strftime('%Y-%m-%d')
+            parsed.append(('15min', site, build_site_frame(values, drop_last=in_progress)))
+    return parsed
+
+
 if __name__ == '__main__':
     start = time.time()
     prod_dict = get_aggr_data_15min(fetch_everything=False)
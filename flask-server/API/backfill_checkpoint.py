@@ -0,0 +1,44 @@
+import os
+import json
+import threading
+
+# Pieces of a full history fetch (a site, or a site and date window) are appended to
+# API/<vendor>/backfill_<name>.jsonl as they complete, so that an interrupted backfill resumes where it stopped.
+# The vendor modules remove the file once their backfill finishes.
+_lock = threading.Lock()
+
+
+def get_checkpoint_path(vendor, name):
+    return os.path.join(os.path.dirname(os.path.realpath(__file__)), vendor, f'backfill_{name}.jsonl')
+
+
+def load_checkpoint(vendor, name):
+    """{key: values} of the pieces recorded by an interrupted backfill, keys being tuples"""
+    checkpoint_path = get_checkpoint_path(vendor, name)
+    completed = dict()
+    if not os.path.exists(checkpoint_path):
+        return completed
+    with open(checkpoint_path) as checkpoint_file:
+        for line in checkpoint_file:
+            try:
+                piece = json.loads(line)
+            except ValueError:  # last line cut short by the interruption
+                continue
+            completed[tuple(piece['key'])] = piece['values']
+    print(f'Resuming {vendor} {name} backfill, {len(completed)} pieces already fetched')
+    return completed
+
+
+def record_checkpoint(vendor, name, pieces):
+    """Appends [(key, values), ...], values having to be JSON serializable"""
+    lines = [json.dumps({'key': list(key), 'values': values}) + '\n' for key, values in pieces]
+    with _lock:
+        with open(get_checkpoint_path(vendor, name), 'a') as checkpoint_file:
+            checkpoint_file.writelines(lines)
+
+
+def clear_checkpoint(vendor, name):
+    checkpoint_path = get_checkpoint_path(vendor, name)
+    with _lock:
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
@@ -0,0 +1,10 @@
+import os
+
+# The vendor configs and credentials are read from API/<vendor>/, or from $SOLAR_API_CONFIG_DIR/<vendor>/ when it is
+# set, for instance to run against the configs written by fake_vendor.py --config-dir without touching the real ones.
+CONFIG_DIR_VARIABLE = 'SOLAR_API_CONFIG_DIR'
+API_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def get_config_path(vendor, file_name):
+    return os.path.join(os.environ.get(CONFIG_DIR_VARIABLE) or API_DIR, vendor, file_name)
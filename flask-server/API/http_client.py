@@ -0,0 +1,94 @@
+import os
+import json
+import atexit
+import time
+import threading
+import concurrent.futures
+import requests
+from requests.adapters import HTTPAdapter
+
+# One pooled session per vendor so that calls reuse their TCP / TLS connections, a per-vendor limit on the number of
+# requests in flight and a minimum interval between the starts of two requests. All are set in http_config.json.
+_lock = threading.Lock()
+_sessions = {}
+_semaphores = {}
+_next_call_times = {}
+_config = None
+
+
+def import_http_config():
+    global _config
+    if _config is None:
+        configfile_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "http_config.json")
+        with open(configfile_path) as json_file:
+            _config = json.load(json_file)
+    return _config
+
+
+def get_vendor_config(vendor):
+    return import_http_config()[vendor]
+
+
+def get_session(vendor):
+    with _lock:
+        if vendor not in _sessions:
+            pool_size = get_vendor_config(vendor)['max_concurrency']
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _sessions[vendor] = session
+            _semaphores[vendor] = threading.BoundedSemaphore(pool_size)
+        return _sessions[vendor]
+
+
+def get_semaphore(vendor):
+    """The vendor's limit on requests in flight, shared by every caller of get()"""
+    get_session(vendor)
+    return _semaphores[vendor]
+
+
+def wait_turn(vendor):
+    """Blocks until min_interval seconds have passed since the previous request to the vendor started"""
+    min_interval = get_vendor_config(vendor).get('min_interval', 0)
+    if min_interval <= 0:
+        return
+    with _lock:
+        now = time.monotonic()
+        call_time = max(now, _next_call_times.get(vendor, now))
+        _next_call_times[vendor] = call_time + min_interval
+    time.sleep(call_time - now)
+
+
+def get(vendor, url, **kwargs):
+    """requests.get through the vendor's pooled session, with its configured timeouts unless given.
+    Waits while max_concurrency requests to the vendor are already in flight, from any thread."""
+    vendor_config = get_vendor_config(vendor)
+    kwargs.setdefault('timeout', (vendor_config['connect_timeout'], vendor_config['read_timeout']))
+    session = get_session(vendor)
+    with get_semaphore(vendor):
+        wait_turn(vendor)
+        return session.get(url, **kwargs)
+
+
+def fetch_all(vendor, fetch, items):
+    """Calls fetch(item) for every item with at most the vendor's max_concurrency calls running at once.
+    Results are returned in the order of items. Requests made through get() stay within the limit even when several
+    fetch_all run at the same time."""
+    items = list(items)
+    max_concurrency = get_vendor_config(vendor)['max_concurrency']
+    if max_concurrency <= 1 or len(items) <= 1:
+        return [fetch(item) for item in items]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        return list(executor.map(fetch, items))
+
+
+def close_sessions():
+    with _lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+        _semaphores.clear()
+
+
+atexit.register(close_sessions)
@@ -0,0 +1,76 @@
+import os
+import json
+import gzip
+import zlib
+import threading
+from datetime import datetime
+
+# Every vendor response the solar_data modules parse is appended, as it arrives, to
+# Response_Archive/<vendor>/<YYYY-MM-DD>/<file tag>.jsonl.gz, partitioned by vendor and day of fetching. Each record
+# is compressed as its own gzip member so appending never rewrites a file. A file is only appended to by the process
+# that created it, a new one being started after a failed write, so a crash can only cut short the last record of a
+# file.
+# Database.rebuild_from_archive regenerates the production databases from these files without the APIs.
+# Records hold the decoded response and the request context needed to parse it, never API keys or tokens.
+ARCHIVE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'Response_Archive')
+
+_lock = threading.Lock()
+_file_tag = None
+
+
+def new_file_tag():
+    global _file_tag
+    _file_tag = f'{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}'
+
+
+def get_partition_path(vendor, fetched_at, archive_dir=ARCHIVE_DIR):
+    return os.path.join(archive_dir, vendor, f'{fetched_at:%Y-%m-%d}', f'{_file_tag}.jsonl.gz')
+
+
+def archive_response(vendor, kind, body, **context):
+    """Appends the decoded response body of a kind of request to the vendor's partition of today. Failing to
+    archive is reported and leaves the ingestion running."""
+    fetched_at = datetime.now()
+    record = {'fetched_at': fetched_at.isoformat(timespec='seconds'), 'kind': kind, 'context': context, 'body': body}
+    member = gzip.compress((json.dumps(record, separators=(',', ':')) + '\n').encode())
+    with _lock:
+        if _file_tag is None:
+            new_file_tag()
+        partition_path = get_partition_path(vendor, fetched_at)
+        try:
+            os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+            with open(partition_path, 'ab') as partition_file:
+                partition_file.write(member)
+        except OSError as error:
+            print(f'Failed to archive {vendor} {kind} response: {error}')
+            new_file_tag()
+
+
+def list_partitions(archive_dir=ARCHIVE_DIR):
+    """[(vendor, file path), ...] of every archive file, oldest first within each vendor"""
+    partitions = []
+    if not os.path.isdir(archive_dir):
+        return partitions
+    for vendor in sorted(os.listdir(archive_dir)):
+        vendor_dir = os.path.join(archive_dir, vendor)
+        if not os.path.isdir(vendor_dir):
+            continue
+        for day in sorted(os.listdir(vendor_dir)):
+            day_dir = os.path.join(vendor_dir, day)
+            if os.path.isdir(day_dir):
+                partitions.extend((vendor, os.path.join(day_dir, file_name))
+                                  for file_name in sorted(os.listdir(day_dir)) if file_name.endswith('.jsonl.gz'))
+    return partitions
+
+
+def read_partition(partition_path):
+    """Yields the records of an archive file in the order they were archived, stopping at a record cut short"""
+    with gzip.open(partition_path, 'rt') as partition_file:
+        try:
+            for line in partition_file:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    print(f'Skipping a damaged record of {partition_path}')
+        except (EOFError, OSError, zlib.error):
+            print(f'{partition_path} ends with a record cut short, reading up to it')
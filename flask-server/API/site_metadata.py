@@ -0,0 +1,40 @@
+import copy
+import time
+import threading
+
+# Site metadata of every vendor (IDs, names, start dates, peak power, devices) as returned by its get_site_details,
+# kept in memory so that the ingestion jobs do not list every site again on each run. The daily site details job
+# refreshes it; entries older than TTL_SECONDS are loaded again on their next use, which keeps the jobs working if
+# that refresh fails. The TTL is a little over a day so a successful daily refresh always comes first.
+TTL_SECONDS = 26 * 3600
+
+_lock = threading.Lock()
+_vendor_locks = {}
+_entries = {}
+
+
+def get_vendor_lock(vendor):
+    with _lock:
+        return _vendor_locks.setdefault(vendor, threading.Lock())
+
+
+def get_site_metadata(vendor, load, refresh=False):
+    """Returns a copy of the vendor's cached site metadata, calling load() first if it is missing, older than
+    TTL_SECONDS or refresh is set. Concurrent callers of the same vendor wait for a single load."""
+    with get_vendor_lock(vendor):
+        entry = _entries.get(vendor)
+        if refresh or entry is None or time.monotonic() - entry[0] > TTL_SECONDS:
+            print(f'Site metadata: loading {vendor} sites')
+            entry = (time.monotonic(), load())
+            _entries[vendor] = entry
+        return copy.deepcopy(entry[1])
+
+
+def invalidate(*vendors):
+    """Drops the cached metadata of the given vendors, of every vendor if none are given"""
+    with _lock:
+        if vendors:
+            for vendor in vendors:
+                _entries.pop(vendor, None)
+        else:
+            _entries.clear()
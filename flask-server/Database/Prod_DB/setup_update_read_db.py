@@ -1,154 +1,408 @@
+import numpy as np
 import pandas as pd
 import sqlalchemy
-from sqlalchemy import inspect
+from sqlalchemy import inspect, text, bindparam
+from Database.production_store import list_sites, get_max_dates, write_sites_data, read_production, \
+    read_site_production, day_bounds, iter_production, pending_setup_steps, create_setup_progress_table, \
+    mark_setup_step, get_write_lock
 from API.Enphase.solar_data import recursive_production_for_site
 from API.SolarEdge.solar_data import get_aggr_data_day
 from API.Fronius.solar_data import fronius_daily_data
 
+# Monthly / yearly totals per site (and fleet-wide under FLEET_SITE) kept up to date at ingest time
+ROLLUP_TABLES = {'monthly': 'Rollup_Monthly', 'yearly': 'Rollup_Yearly'}
+ROLLUP_FREQ = {'monthly': 'M', 'yearly': 'Y'}
+FLEET_SITE = 'combined'
+# Fleet-wide daily totals, kept up to date at ingest time along with the rollups
+FLEET_DAILY_TABLE = 'Fleet_Daily'
+# Trailing run of zero production days per site (and fleet-wide), advanced from the newly appended rows only
+ZERO_STREAK_TABLE = 'Zero_Day_Streaks'
+# Format of the dates served by the endpoints
+DATE_FORMAT = '%Y-%m-%d'
+# Vendors providing daily production, see fetch_daily_data
+VENDORS = ('Enphase', 'SolarEdge', 'Fronius')
+# Steps of the initial setup: every vendor's full history, then the rollups and streaks built from all of them
+ROLLUPS_SETUP_STEP = 'rollups'
+SETUP_STEPS = VENDORS + (ROLLUPS_SETUP_STEP,)
 
-def initial_db_setup_daily(prod_engine, sites_engine):
-    print("Database engine does not exist. Creating...")
-
-    print('Enphase Daily Data')
-    sites_data = recursive_production_for_site(sites_engine)
-    sites = list(sites_data.keys())
-
-    for site in sites:
-        df = sites_data[site]
-        df = df[~df.index.duplicated()]  # date is index
-        df.to_sql(site, prod_engine)
-
-    print('Solaredge Daily Data')
-    sites_data = get_aggr_data_day(fetch_everything=True)
-    sites = list(sites_data.keys())
-
-    for site in sites:
-        df = sites_data[site]
-        df = df[~df.index.duplicated()]
-        df.to_sql(site, prod_engine)
-
-    print('Fronius Daily Data')
-    sites_data = fronius_daily_data(fetch_everything=True)
-    sites = list(sites_data.keys())
-    for site in sites:
-        df = sites_data[site]
-        df = df[~df.index.duplicated()]
-        df.to_sql(site, prod_engine)
-
-    print("Daily Database setup complete.")
+
+def fetch_daily_data(vendor, sites_engine, prod_engine=None):
+    """Daily production of the vendor's sites, {site: DataFrame}. Every day since each site started without
+    prod_engine, otherwise only the recent days, for Enphase the days after each site's latest stored one."""
+    fetch_everything = prod_engine is None
+    if vendor == 'Enphase':
+        return recursive_production_for_site(sites_engine, prod_engine=prod_engine)
+    if vendor == 'SolarEdge':
+        return get_aggr_data_day(fetch_everything=fetch_everything)
+    if vendor == 'Fronius':
+        return fronius_daily_data(fetch_everything=fetch_everything)
+    raise KeyError(f'Unknown vendor {vendor}')
+
+
+def store_initial_vendor_data(prod_engine, vendor, sites_data):
+    """Writes a vendor's full history and records its setup step in the same transaction"""
+    with get_write_lock(prod_engine), prod_engine.begin() as conn:
+        # date is index
+        write_sites_data(conn, {site: df[~df.index.duplicated()] for site, df in sites_data.items()})
+        mark_setup_step(conn, vendor)
+
+
+def finish_initial_daily_setup(prod_engine):
+    """Builds the rollups and streaks from every stored site. Their setup step is only recorded once every vendor's
+    is, a vendor stored later on rebuilds them."""
+    print('Monthly / Yearly Rollups')
+    update_rollups(prod_engine, dict.fromkeys(list_sites(prod_engine)))
+
+    print('Zero Production Streaks')
+    rebuild_zero_streaks(prod_engine)
+
+    if not pending_setup_steps(prod_engine, VENDORS):
+        with prod_engine.begin() as conn:
+            mark_setup_step(conn, ROLLUPS_SETUP_STEP)
+        print("Daily Database setup complete.")
     print()
 
+
+def initial_db_setup_daily(prod_engine, sites_engine):
+    """Sets up the steps of the daily database missing from it, the whole database when it is new"""
+    steps = pending_setup_steps(prod_engine, SETUP_STEPS)
+    if not steps:
+        print('Daily Database already set up')
+        return
+    print("Setting up the daily database: " + ", ".join(steps))
+    create_setup_progress_table(prod_engine)
+
+    for vendor in VENDORS:
+        if vendor in steps:
+            print(f'{vendor} Daily Data')
+            store_initial_vendor_data(prod_engine, vendor, fetch_daily_data(vendor, sites_engine))
+
+    finish_initial_daily_setup(prod_engine)
     return
 
 
-def update_prod_db(prod_engine, sites_engine):
-    # Update Enphase Data
-    sites_data = recursive_production_for_site(sites_engine)
-    sites = list(sites_data.keys())
-    insp = inspect(prod_engine)
-    for site in sites:
-        if insp.has_table(site):
-            df = sites_data[site]
-            max_date_query = f"select max(Date) from '{site}'"
-            max_date = pd.read_sql(max_date_query, prod_engine).iloc[0, 0]
-            append_df = df[df.index > max_date]
-            print(f"Just appended {len(append_df)} new rows to {site} table")
-            append_df.to_sql(site, prod_engine, if_exists='append')
-        else:
-            df = sites_data[site]
-            print(f"Created new site, appended {len(df)} new rows to {site} table")
-            df.to_sql(site, prod_engine, if_exists='append')
-
-    # Update Solaredge Data
-    sites_data = get_aggr_data_day(fetch_everything=False)
-    sites = list(sites_data.keys())
-    for site in sites:
-        if insp.has_table(site):
-            df = sites_data[site]
-            max_date_query = f"select max(Date) from '{site}'"
-            max_date = pd.read_sql(max_date_query, prod_engine).iloc[0, 0]
-            append_df = df[df.index > max_date]
+def append_sites_data(prod_engine, sites_data):
+    """Upserts the rows newer than each site's latest stored Date, every site in one transaction, and returns
+    {site: earliest appended date} (None for newly created sites)"""
+    changed_sites = {}
+    append_data = {}
+    max_dates = get_max_dates(prod_engine, sites_data.keys())
+    for site, df in sites_data.items():
+        if site in max_dates:
+            max_date = max_dates[site]
+            append_df = df if max_date is None else df[pd.to_datetime(df.index) > max_date]
             print(f"Just appended {len(append_df)} new rows to {site} table")
-            append_df.to_sql(site, prod_engine, if_exists='append')
+            if len(append_df) > 0:
+                changed_sites[site] = pd.to_datetime(append_df.index).min()
         else:
-            df = sites_data[site]
+            append_df = df
             print(f"Created new site, appended {len(df)} new rows to {site} table")
-            df.to_sql(site, prod_engine, if_exists='append')
-
-    # Update Fronius Data
-    sites_data = fronius_daily_data(fetch_everything=False)
-    sites = list(sites_data.keys())
-    for site in sites:
-        if insp.has_table(site):
-            df = sites_data[site]
-            max_date_query = f"select max(Date) from '{site}'"
-            max_date = pd.read_sql(max_date_query, prod_engine).iloc[0, 0]
-            append_df = df[df.index > max_date]
-            print(f"Just appended {len(append_df)} new rows to {site} table")
-            append_df.to_sql(site, prod_engine, if_exists='append')
-        else:
-            df = sites_data[site]
-            print(f"Created new site, appended {len(df)} new rows to {site} table")
-            df.to_sql(site, prod_engine, if_exists='append')
+            changed_sites[site] = None
+        append_data[site] = append_df
+    write_sites_data(prod_engine, append_data)
+    return changed_sites
+
+
+def store_daily_updates(prod_engine, sites_data):
+    changed_sites = append_sites_data(prod_engine, sites_data)
+
+    # Update Monthly / Yearly rollups for the periods touched by the new rows
+    update_rollups(prod_engine, changed_sites)
+    # Advance the zero production streaks with the appended rows
+    update_zero_streaks(prod_engine, changed_sites)
 
     print("Database update complete.")
     return
 
 
-def download_DB_data_daily(engine, interval='yearly'):
-    data = get_Production_Data_From_DB(engine)
+def update_prod_db(prod_engine, sites_engine):
+    sites_data = {}
+    # Enphase only requests the days after each site's latest stored one
+    for vendor in VENDORS:
+        sites_data.update(fetch_daily_data(vendor, sites_engine, prod_engine=prod_engine))
 
-    combined_df = pd.DataFrame()
-    for key, value in data.items():
-        value = value.sort_values(by='Date')
+    store_daily_updates(prod_engine, sites_data)
+    return
+
+
+def create_rollup_tables(engine):
+    with engine.begin() as conn:
+        for table_name in ROLLUP_TABLES.values():
+            conn.execute(text(
+                f'''CREATE TABLE IF NOT EXISTS "{table_name}" (
+                    site TEXT NOT NULL,
+                    Date TEXT NOT NULL,
+                    "Production (kWh)" FLOAT,
+                    PRIMARY KEY (site, Date)
+                )'''
+            ))
+        conn.execute(text(
+            f'''CREATE TABLE IF NOT EXISTS "{FLEET_DAILY_TABLE}" (
+                Date TEXT PRIMARY KEY,
+                "Production (kWh)" FLOAT
+            )'''
+        ))
+
+
+def update_rollups(engine, changed_sites):
+    """Recomputes the monthly and yearly rollup rows of every site in changed_sites ({site: earliest changed date},
+    None rebuilds the site's whole history) and then the fleet-wide rows for the same periods.
+    Only the years touched by the change are re-read from the site tables, and only the days from the earliest
+    changed date on for the fleet-wide daily rows."""
+    insp = inspect(engine)
+    if not all(insp.has_table(table_name) for table_name in list(ROLLUP_TABLES.values()) + [FLEET_DAILY_TABLE]):
+        # The first build has to cover every site, not only the ones that just changed
+        changed_sites = dict.fromkeys(list_sites(engine))
+    create_rollup_tables(engine)
+    if not changed_sites:
+        return
+
+    fleet_start = {interval: None for interval in ROLLUP_TABLES}
+    with engine.begin() as conn:
+        for site, changed_date in changed_sites.items():
+            # Re-reading from January 1st keeps both the monthly and the yearly sums complete
+            year_start = None if changed_date is None else pd.Timestamp(changed_date).strftime('%Y-01-01')
+            value = read_site_production(conn, site, start=year_start).dropna()
+            value['Date'] = pd.to_datetime(value['Date'])
+            value = value.set_index('Date').sort_index()
+
+            for interval, table_name in ROLLUP_TABLES.items():
+                rollup_df = value.resample(ROLLUP_FREQ[interval]).sum().reset_index()
+                rollup_df['Date'] = rollup_df['Date'].dt.strftime('%Y-%m-%d')
+                if changed_date is None:
+                    conn.execute(text(f'''DELETE FROM "{table_name}" WHERE site = :site'''), {'site': site})
+                    period_start = ''
+                elif len(rollup_df) > 0:
+                    period_start = rollup_df['Date'].iloc[0]
+                    conn.execute(text(f'''DELETE FROM "{table_name}" WHERE site = :site AND Date >= :start'''),
+                                 {'site': site, 'start': period_start})
+                else:
+                    continue
+                rows = [{'site': site, 'date': date, 'prod': prod}
+                        for date, prod in zip(rollup_df['Date'].tolist(), rollup_df['Production (kWh)'].tolist())]
+                if rows:
+                    conn.execute(text(f'''INSERT INTO "{table_name}" VALUES (:site, :date, :prod)'''), rows)
+                if fleet_start[interval] is None or period_start < fleet_start[interval]:
+                    fleet_start[interval] = period_start
+
+        for interval, table_name in ROLLUP_TABLES.items():
+            if fleet_start[interval] is None:
+                continue
+            params = {'fleet': FLEET_SITE, 'start': fleet_start[interval]}
+            conn.execute(text(f'''DELETE FROM "{table_name}" WHERE site = :fleet AND Date >= :start'''), params)
+            conn.execute(text(
+                f'''INSERT INTO "{table_name}"
+                SELECT :fleet, Date, SUM("Production (kWh)") FROM "{table_name}"
+                WHERE site != :fleet AND Date >= :start GROUP BY Date'''
+            ), params)
+
+        changed_dates = list(changed_sites.values())
+        update_fleet_daily(conn, None if None in changed_dates else min(changed_dates))
+
+
+def update_fleet_daily(conn, start=None):
+    """Re-sums the fleet-wide daily rows from the start date on (every day when None)"""
+    start = None if start is None else pd.Timestamp(start).strftime('%Y-%m-%d')
+    combined = pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    for site, value in iter_production(conn, start=start):
         value = value.dropna()
-        value['Date'] = pd.to_datetime(value['Date'])
-
-        if interval == 'daily':
-            pass
-        elif interval == 'monthly':
-            value.set_index('Date', inplace=True)
-            value = value.resample('M').sum()
-        elif interval == 'yearly':
-            value.set_index('Date', inplace=True)
-            value = value.resample('Y').sum()
-        else:
-            raise KeyError('Only accepts daily, monthly, or yearly')
+        value['Date'] = pd.to_datetime(value['Date']).dt.normalize()
+        combined = combined.add(value.groupby('Date')['Production (kWh)'].sum(), fill_value=0)
 
-        value = value.reset_index()
-        value['Date'] = value['Date'].dt.strftime('%Y-%m-%d')
-        data[key] = value.to_dict(orient='records')
-        combined_df = pd.concat([combined_df, value], axis=0, ignore_index=True)
+    conn.execute(text(f'''DELETE FROM "{FLEET_DAILY_TABLE}" WHERE Date >= :start'''), {'start': start or ''})
+    rows = [{'date': date, 'prod': prod}
+            for date, prod in zip(combined.index.strftime('%Y-%m-%d').tolist(), combined.tolist())]
+    if rows:
+        conn.execute(text(f'''INSERT INTO "{FLEET_DAILY_TABLE}" VALUES (:date, :prod)'''), rows)
 
-    if 'index' in combined_df.columns:
-        combined_df.drop(columns=['index'], inplace=True)
 
-    combined_df = combined_df.groupby('Date').sum()
-    combined_df = combined_df.reset_index()
-    combined_df = combined_df.sort_values(by='Date')
-    combined_df = combined_df.dropna()
-    data['combined'] = combined_df.to_dict(orient='records')
+def read_fleet_daily(engine, start=None, end=None):
+    if not inspect(engine).has_table(FLEET_DAILY_TABLE):
+        print(f'{FLEET_DAILY_TABLE} does not exist yet. Building it from the site tables...')
+        update_rollups(engine, {})
 
-    return data
+    conditions, params = ['1 = 1'], {}
+    if start is not None:
+        conditions.append('Date >= :start')
+        params['start'] = start.strftime('%Y-%m-%d')
+    if end is not None:
+        conditions.append('Date <= :end')
+        params['end'] = end.strftime('%Y-%m-%d')
+    query = text(f'''SELECT Date, "Production (kWh)" FROM "{FLEET_DAILY_TABLE}"
+                 WHERE {' AND '.join(conditions)} ORDER BY Date''')
+    fleet_df = pd.read_sql(query, engine, params=params)
+    fleet_df['Date'] = pd.to_datetime(fleet_df['Date'])
+    return fleet_df
+
+
+def trailing_zero_days(values):
+    """Number of zeros at the end of values"""
+    nonzero = np.flatnonzero(np.asarray(values, dtype=float) != 0)
+    return len(values) if len(nonzero) == 0 else len(values) - 1 - int(nonzero[-1])
+
+
+def advance_zero_streak(streak, new_df):
+    """Extends a (ZeroDayCount, last_date) streak with the rows of new_df dated after last_date"""
+    count, last_date = streak
+    if last_date is not None:
+        new_df = new_df[new_df['Date'] > last_date]
+    if len(new_df) == 0:
+        return streak
+    new_zeros = trailing_zero_days(new_df['Production (kWh)'])
+    if new_zeros == len(new_df):
+        new_zeros += count
+    return new_zeros, new_df['Date'].iloc[-1]
+
+
+def write_zero_streaks(conn, streaks):
+    conn.execute(text(
+        f'''CREATE TABLE IF NOT EXISTS "{ZERO_STREAK_TABLE}" (
+            site TEXT PRIMARY KEY,
+            ZeroDayCount INTEGER NOT NULL,
+            last_date TEXT
+        )'''
+    ))
+    rows = [{'site': site, 'count': count, 'last_date': None if last_date is None else last_date.strftime(DATE_FORMAT)}
+            for site, (count, last_date) in streaks.items()]
+    if rows:
+        conn.execute(text(f'''INSERT OR REPLACE INTO "{ZERO_STREAK_TABLE}" VALUES (:site, :count, :last_date)'''),
+                     rows)
+
+
+def read_zero_streaks(connectable):
+    """{site: (ZeroDayCount, last_date)} in site order, the fleet-wide streak last"""
+    if not inspect(connectable).has_table(ZERO_STREAK_TABLE):
+        return {}
+    streak_df = pd.read_sql(f'''SELECT site, ZeroDayCount, last_date FROM "{ZERO_STREAK_TABLE}"''', connectable)
+    streaks = {site: (int(count), None if last_date is None else pd.Timestamp(last_date))
+               for site, count, last_date in streak_df.itertuples(index=False)}
+    site_order = list_sites(connectable) + [FLEET_SITE]
+    return {site: streaks[site] for site in site_order if site in streaks}
+
+
+def rebuild_zero_streaks(engine):
+    """Recounts every streak from the full daily history"""
+    streaks = {}
+    for site, value in iter_DB_data_daily(engine, interval='daily'):
+        last_date = value['Date'].iloc[-1] if len(value) > 0 else None
+        streaks[site] = (trailing_zero_days(value['Production (kWh)']), last_date)
+    with engine.begin() as conn:
+        # Emptied rather than dropped, a concurrent reader would otherwise find no table between the statements
+        write_zero_streaks(conn, {})
+        conn.execute(text(f'''DELETE FROM "{ZERO_STREAK_TABLE}"'''))
+        write_zero_streaks(conn, streaks)
+    return streaks
 
 
-def read_db(engine, table_name):
-    query = f"SELECT DISTINCT * FROM '{table_name}' ORDER BY Date DESC"
-    df = pd.read_sql(query, engine)
-    return df
+def update_zero_streaks(engine, changed_sites):
+    """Advances the streaks of changed_sites ({site: earliest appended date}) and the fleet-wide one by reading only
+    the days from the earliest appended date on. New sites, or a fleet streak that cannot be extended from those
+    days alone, fall back to rebuild_zero_streaks."""
+    streaks = read_zero_streaks(engine)
+    if not changed_sites:
+        return streaks
+    if any(changed_date is None or site not in streaks for site, changed_date in changed_sites.items()) \
+            or FLEET_SITE not in streaks:
+        return rebuild_zero_streaks(engine)
 
+    window_start = min(changed_sites.values())
+    for site, value in iter_DB_data_daily(engine, interval='daily', start=window_start):
+        if site in changed_sites:
+            streaks[site] = advance_zero_streak(streaks[site], value)
+        elif site == FLEET_SITE:
+            fleet_last_date = streaks[FLEET_SITE][1]
+            window_zeros = trailing_zero_days(value['Production (kWh)'])
+            if window_zeros < len(value):
+                streaks[FLEET_SITE] = (window_zeros, value['Date'].iloc[-1])
+            elif len(value) == 0 or fleet_last_date is None or value['Date'].iloc[0] > fleet_last_date:
+                streaks[FLEET_SITE] = advance_zero_streak(streaks[FLEET_SITE], value)
+            else:
+                # Every fleet day since the window start is zero, so the run may reach back past the window
+                return rebuild_zero_streaks(engine)
 
-def get_Production_Data_From_DB(engine):
-    query = "SELECT name FROM sqlite_master WHERE type='table';"
-    df = pd.read_sql(query, engine)
-    sites = df['name'].tolist()
+    with engine.begin() as conn:
+        write_zero_streaks(conn, streaks)
+    return streaks
+
+
+def iter_rollup_data(engine, interval, sites=None, start=None, end=None):
+    table_name = ROLLUP_TABLES[interval]
+    if not inspect(engine).has_table(table_name):
+        print(f'{table_name} does not exist yet. Building it from the site tables...')
+        update_rollups(engine, {})
+
+    # Rollup rows are labelled with their period's end date, the range applies to that label
+    conditions, params = ['1 = 1'], {}
+    if sites is not None:
+        conditions.append('site IN :sites')
+        params['sites'] = list(sites)
+    if start is not None:
+        conditions.append('Date >= :start')
+        params['start'] = start.strftime('%Y-%m-%d')
+    if end is not None:
+        conditions.append('Date <= :end')
+        params['end'] = end.strftime('%Y-%m-%d')
+    query = text(f'''SELECT site, Date, "Production (kWh)" FROM "{table_name}"
+                 WHERE {' AND '.join(conditions)} ORDER BY site, Date''')
+    if sites is not None:
+        query = query.bindparams(bindparam('sites', expanding=True))
+    rollup_df = pd.read_sql(query, engine, params=params)
+    rollup_df['Date'] = pd.to_datetime(rollup_df['Date'])
+    site_groups = dict(tuple(rollup_df.groupby('site', sort=False)))
+
+    for site in (list_sites(engine) + [FLEET_SITE] if sites is None else sites):
+        if site in site_groups:
+            yield site, site_groups[site].drop(columns='site').reset_index(drop=True)
+        else:
+            yield site, rollup_df.iloc[0:0].drop(columns='site')
+
+
+def iter_DB_data_daily(engine, interval='yearly', sites=None, start=None, end=None):
+    """Yields (site, DataFrame[Date, Production (kWh)]) one site at a time for the requested sites (every site plus
+    the fleet-wide 'combined' series by default) whose dates fall in the inclusive [start, end] date range.
+    Dates are kept as datetimes, only the callers format them. Daily site frames start with the 'index' column their
+    records have always carried, the row's position among the site's rows read newest first. With a start or end
+    date it counts the rows of the range only."""
+    start, end = day_bounds(start, end)
+    if interval in ROLLUP_TABLES:
+        yield from iter_rollup_data(engine, interval, sites, start, end)
+        return
+    elif interval != 'daily':
+        raise KeyError('Only accepts daily, monthly, or yearly')
+
+    # combined is read from its own table rather than summed from the site series
+    include_combined = sites is None or FLEET_SITE in sites
+    requested_sites = None if sites is None else [site for site in sites if site != FLEET_SITE]
+
+    yielded_sites = set()
+    for site, value in get_Production_Data_From_DB(engine, requested_sites, start, end, lazy=True):
+        value = value.sort_values(by='Date')
+        value.insert(0, 'index', range(len(value) - 1, -1, -1))
+        value = value.dropna()
+        value['Date'] = pd.to_datetime(value['Date']).dt.normalize()
+        yielded_sites.add(site)
+        yield site, value.reset_index(drop=True)
+
+    for site in requested_sites or []:
+        if site not in yielded_sites:  # not in the database
+            yield site, pd.DataFrame({'index': pd.Series(dtype='int64'), 'Date': pd.Series(dtype='datetime64[ns]'),
+                                      'Production (kWh)': []})
+    if include_combined:
+        yield FLEET_SITE, read_fleet_daily(engine, start, end)
+
+
+def download_DB_data_daily(engine, interval='yearly', sites=None, start=None, end=None):
+    data = {}
+    for site, value in iter_DB_data_daily(engine, interval, sites, start, end):
+        value['Date'] = value['Date'].dt.strftime(DATE_FORMAT)
+        data[site] = value.to_dict(orient='records')
+    return data
 
-    prod_data = {}
-    for site in sites:
-        df_temp = read_db(engine, site)
-        prod_data[site] = df_temp
 
-    return prod_data
+def get_Production_Data_From_DB(engine, sites=None, start=None, end=None, lazy=False):
+    if lazy:
+        return iter_production(engine, sites, start, end)
+    return read_production(engine, sites, start, end)
 
 
 if __name__ == "__main__":
@@ -1,73 +1,92 @@
 import pandas as pd
 import sqlalchemy
+from Database.production_store import get_max_dates, write_sites_data, read_production, day_bounds, \
+    iter_production, is_long_format, pending_setup_steps, create_setup_progress_table, mark_setup_step, \
+    get_write_lock
 from API.SolarEdge.solar_data import get_aggr_data_15min
 from API.Fronius.solar_data import fronius_15min_data
 
+# Format of the dates served by the endpoints
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+# Vendors providing 15 minute production, see fetch_15min_data. Their full histories are the initial setup steps.
+VENDORS = ('SolarEdge', 'Fronius')
+
+
+def storage_frame(prod_engine, df):
+    """Frames indexed by Timestamps get their dates formatted as DATE_FORMAT strings for the one table per site
+    layout, which stores them as text"""
+    if isinstance(df.index, pd.DatetimeIndex) and not is_long_format(prod_engine):
+        df = df.set_axis(df.index.strftime(DATE_FORMAT))
+    return df
 
-def initial_db_setup_15min(prod_engine):
-    """We can only use Solaredge or Fronius for 15 minute data"""
-    print("Database engine does not exist. Creating...")
 
-    print('Solaredge 15min Data')
-    sites_data = get_aggr_data_15min(fetch_everything=True)
-    sites = list(sites_data.keys())
+def fetch_15min_data(vendor, fetch_everything=True):
+    """15 minute production of the vendor's sites, {site: DataFrame}, the last two months or only the recent days"""
+    if vendor == 'SolarEdge':
+        return get_aggr_data_15min(fetch_everything=fetch_everything)
+    if vendor == 'Fronius':
+        return fronius_15min_data(fetch_everything=fetch_everything)
+    raise KeyError(f'Unknown vendor {vendor}')
 
-    for site in sites:
-        df = sites_data[site]
-        df = df[~df.index.duplicated()]
-        df.to_sql(site, prod_engine)
 
-    print('Fronius 15min Data')
-    sites_data = fronius_15min_data(fetch_everything=True)
-    sites = list(sites_data.keys())
+def store_initial_15min_vendor_data(prod_engine, vendor, sites_data):
+    """Writes a vendor's full history and records its setup step in the same transaction"""
+    with get_write_lock(prod_engine), prod_engine.begin() as conn:
+        write_sites_data(conn, {site: storage_frame(conn, df[~df.index.duplicated()])
+                                for site, df in sites_data.items()})
+        mark_setup_step(conn, vendor)
 
-    for site in sites:
-        df = sites_data[site]
-        df = df[~df.index.duplicated()]
-        df.to_sql(site, prod_engine)
+
+def initial_db_setup_15min(prod_engine):
+    """We can only use Solaredge or Fronius for 15 minute data. Sets up the vendors missing from the database."""
+    steps = pending_setup_steps(prod_engine, VENDORS)
+    if not steps:
+        print('15 minute Database already set up')
+        return
+    print("Setting up the 15 minute database: " + ", ".join(steps))
+    create_setup_progress_table(prod_engine)
+
+    for vendor in steps:
+        print(f'{vendor} 15min Data')
+        store_initial_15min_vendor_data(prod_engine, vendor, fetch_15min_data(vendor))
 
     print("Database setup complete.")
 
     return
 
 
-def update_15min_prod_db(prod_engine):
-    # Update Solaredge Data
-    sites_data = get_aggr_data_15min(fetch_everything=False)
-    sites = list(sites_data.keys())
-    for site in sites:
-        df = sites_data[site]
-        max_date_query = f"select max(Date) from '{site}'"
-        max_date = pd.read_sql(max_date_query, prod_engine).iloc[0, 0]
-        append_df = df[df.index > max_date]
-        # _query = f"select * from '{site}' order by Date DESC LIMIT {len(df)}"
-        # sql_df = pd.read_sql(_query, prod_engine)
-        # append_df = df[~df.index.isin(sql_df['Date'])]
-        print(f"Just appended {len(append_df)} new rows to {site} table")
-        append_df.to_sql(site, prod_engine, if_exists='append')
-
-    # Update Fronius Data
-    sites_data = fronius_15min_data(fetch_everything=False)
-    sites = list(sites_data.keys())
-    for site in sites:
-        df = sites_data[site]
-        max_date_query = f"select max(Date) from '{site}'"
-        max_date = pd.read_sql(max_date_query, prod_engine).iloc[0, 0]
-        append_df = df[df.index > max_date]
-        # _query = f"select * from '{site}' order by Date DESC LIMIT {len(df)}"
-        # sql_df = pd.read_sql(_query, prod_engine)
-        # append_df = df[~df.index.isin(sql_df['Date'])]
+def append_15min_sites_data(prod_engine, sites_data):
+    """Upserts the rows newer than each site's latest stored Date, every site in one transaction, and returns them
+    as {site: DataFrame}"""
+    appended = {}
+    max_dates = get_max_dates(prod_engine, sites_data.keys())
+    for site, df in sites_data.items():
+        max_date = max_dates.get(site)
+        append_df = df if max_date is None else df[pd.to_datetime(df.index) > max_date]
         print(f"Just appended {len(append_df)} new rows to {site} table")
-        append_df.to_sql(site, prod_engine, if_exists='append')
+        appended[site] = append_df
+    write_sites_data(prod_engine, {site: storage_frame(prod_engine, df) for site, df in appended.items()})
+    return {site: df for site, df in appended.items() if len(df) > 0}
 
-    print("Database update complete.")
-    return
 
+def update_15min_prod_db(prod_engine):
+    """Returns the newly appended rows of each site, {site: DataFrame[Date, Production (kWh)]}"""
+    sites_data = {}
+    for vendor in VENDORS:
+        sites_data.update(fetch_15min_data(vendor, fetch_everything=False))
+
+    appended = append_15min_sites_data(prod_engine, sites_data)
+
+    print("Database update complete.")
+    return {site: pd.DataFrame({'Date': pd.to_datetime(df.index), 'Production (kWh)': df['Production (kWh)'].values})
+            for site, df in appended.items()}
 
-def download_DB_data_15min(engine, interval=None):
-    data = get_Production_Data_From_DB(engine)
 
-    for key, value in data.items():
+def iter_DB_data_15min(engine, interval=None, sites=None, start=None, end=None):
+    """Yields (site, DataFrame[Date, Production (kWh)]) one site at a time for the requested sites (all by default)
+    between the start and end dates, the last 7 days by default. Dates are kept as datetimes, only the callers
+    format them."""
+    for key, value in get_Production_Data_From_DB(engine, sites, start, end, lazy=True):
         value = value.sort_values(by='Date')
         value = value.dropna()
         value['Date'] = pd.to_datetime(value['Date'])
@@ -83,24 +102,29 @@ def download_DB_data_15min(engine, interval=None):
             KeyError('Only accepts daily, monthly, or yearly')
 
         value = value.reset_index()
-        value['Date'] = value['Date'].dt.strftime('%Y-%m-%d %H:%M:%S')
-        data[key] = value.to_dict(orient='records')
+        yield key, value
 
-    return data
 
+def download_DB_data_15min(engine, interval=None, sites=None, start=None, end=None):
+    data = {}
+    for key, value in iter_DB_data_15min(engine, interval, sites, start, end):
+        value['Date'] = value['Date'].dt.strftime(DATE_FORMAT)
+        data[key] = value.to_dict(orient='records')
+    return data
 
-def get_Production_Data_From_DB(engine):
-    query = "SELECT name FROM sqlite_master WHERE type='table';"
-    df = pd.read_sql(query, engine)
-    sites = df['name'].tolist()
 
-    prod_data = {}
-    for site in sites:
-        query_site = f"""SELECT DISTINCT * FROM "{site}" WHERE Date BETWEEN DATE(DATE('now'), '-7 days') AND DATE('now', '+1 day') ORDER BY Date DESC;"""
-        df_temp = pd.read_sql(query_site, engine)
-        prod_data[site] = df_temp
+def get_Production_Data_From_DB(engine, sites=None, start=None, end=None, lazy=False):
+    if start is None and end is None:
+        # Last 7 days (UTC dates, as SQLite's DATE('now')) up to the end of today
+        today = pd.Timestamp.utcnow().tz_localize(None).normalize()
+        start = (today - pd.Timedelta(days=7)).strftime('%Y-%m-%d')
+        end = (today + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+    else:
+        start, end = day_bounds(start, end)
 
-    return prod_data
+    if lazy:
+        return iter_production(engine, sites, start, end)
+    return read_production(engine, sites, start, end)
 
 
 if __name__ == "__main__":
@@ -1,6 +1,9 @@
 import pandas as pd
 import sqlalchemy
 
+# Site details table of every vendor
+SITE_DETAILS_TABLES = {'Enphase': 'Enphase_SD', 'SolarEdge': 'Solaredge_SD', 'Fronius': 'Fronius_SD'}
+
 
 def read_db(engine, table_name):
     query = f"SELECT * FROM '{table_name}'"
@@ -11,14 +14,8 @@ def read_db(engine, table_name):
 def read_site_db(engine):
     site_detials_dict = {}
 
-    Enphase = read_db(engine, 'Enphase_SD')
-    site_detials_dict['Enphase'] = Enphase
-
-    Solaredge = read_db(engine, 'Solaredge_SD')
-    site_detials_dict['SolarEdge'] = Solaredge
-
-    Fronius = read_db(engine, 'Fronius_SD')
-    site_detials_dict['Fronius'] = Fronius
+    for vendor, table_name in SITE_DETAILS_TABLES.items():
+        site_detials_dict[vendor] = read_db(engine, table_name)
 
     return site_detials_dict
 
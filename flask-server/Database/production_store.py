@@ -0,0 +1,347 @@
+import argparse
+import threading
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import inspect, text
+
+# Long format layout: every site's rows live in one table keyed by (site_id, epoch seconds).
+# Databases without the Production table keep the original layout of one table per site, named after the site.
+SITES_TABLE = 'Sites'
+PRODUCTION_TABLE = 'Production'
+# Initial setup steps committed so far, so that an interrupted setup only redoes the missing ones
+SETUP_PROGRESS_TABLE = 'Setup_Progress'
+# Tables of either layout that do not hold a single site's production
+NON_SITE_TABLES = {SITES_TABLE, PRODUCTION_TABLE, 'Rollup_Monthly', 'Rollup_Yearly', 'Fleet_Daily',
+                   'Zero_Day_Streaks', SETUP_PROGRESS_TABLE}
+# SQLite takes one writer at a time and gives up on the others after a few seconds, so the stages writing to the
+# same database take turns through its lock
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def get_write_lock(engine):
+    with _write_locks_lock:
+        return _write_locks.setdefault(engine.url.database, threading.Lock())
+
+
+def is_long_format(connectable):
+    return inspect(connectable).has_table(PRODUCTION_TABLE)
+
+
+def create_long_format_tables(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{SITES_TABLE}" (site_id INTEGER PRIMARY KEY, '
+                          f'name TEXT NOT NULL UNIQUE)'))
+        conn.execute(text(
+            f'''CREATE TABLE IF NOT EXISTS "{PRODUCTION_TABLE}" (
+                site_id INTEGER NOT NULL REFERENCES "{SITES_TABLE}" (site_id),
+                ts INTEGER NOT NULL,
+                "Production (kWh)" FLOAT,
+                PRIMARY KEY (site_id, ts)
+            ) WITHOUT ROWID'''
+        ))
+
+
+def pending_setup_steps(engine, steps):
+    """The steps of the initial setup not committed to the database yet. Databases set up before the progress was
+    recorded are complete if they hold any site."""
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(SETUP_PROGRESS_TABLE):
+            return [] if list_sites(conn) else list(steps)
+        done = set(pd.read_sql(f'SELECT step FROM "{SETUP_PROGRESS_TABLE}"', conn)['step'])
+    return [step for step in steps if step not in done]
+
+
+def create_setup_progress_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE IF NOT EXISTS "{SETUP_PROGRESS_TABLE}" (step TEXT PRIMARY KEY, '
+                          f'completed_at TEXT NOT NULL)'))
+
+
+def mark_setup_step(conn, step):
+    """Records a step of the initial setup, in the transaction that commits its data"""
+    conn.execute(text(f'INSERT OR REPLACE INTO "{SETUP_PROGRESS_TABLE}" VALUES (:step, :completed_at)'),
+                 {'step': step, 'completed_at': pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')})
+
+
+def to_epoch(dates):
+    dates = pd.to_datetime(pd.Series(dates))
+    return ((dates - pd.Timestamp(0)) // pd.Timedelta(seconds=1)).astype('int64')
+
+
+def from_epoch(ts):
+    return pd.to_datetime(ts, unit='s')
+
+
+def list_site_tables(connectable):
+    query = "SELECT name FROM sqlite_master WHERE type='table';"
+    df = pd.read_sql(query, connectable)
+    return [name for name in df['name'].tolist() if name not in NON_SITE_TABLES]
+
+
+def list_sites(connectable):
+    if is_long_format(connectable):
+        return pd.read_sql(f'SELECT name FROM "{SITES_TABLE}" ORDER BY site_id', connectable)['name'].tolist()
+    return list_site_tables(connectable)
+
+
+def get_site_ids(conn, sites, create=False):
+    site_ids = pd.read_sql(f'SELECT name, site_id FROM "{SITES_TABLE}"', conn).set_index('name')['site_id'].to_dict()
+    if create:
+        for site in sites:
+            if site not in site_ids:
+                result = conn.execute(text(f'INSERT INTO "{SITES_TABLE}" (name) VALUES (:name)'), {'name': site})
+                site_ids[site] = result.lastrowid
+    return {site: site_ids[site] for site in sites if site in site_ids}
+
+
+def has_site(connectable, site):
+    if is_long_format(connectable):
+        return site in list_sites(connectable)
+    return inspect(connectable).has_table(site)
+
+
+def get_max_date(connectable, site):
+    """Latest stored Date of a site as a Timestamp, None if the site has no rows"""
+    if is_long_format(connectable):
+        query = f'''SELECT max(ts) FROM "{PRODUCTION_TABLE}" WHERE site_id =
+                    (SELECT site_id FROM "{SITES_TABLE}" WHERE name = :site)'''
+        max_ts = pd.read_sql(text(query), connectable, params={'site': site}).iloc[0, 0]
+        return None if pd.isna(max_ts) else from_epoch(int(max_ts))
+
+    max_date_query = f"select max(Date) from '{site}'"
+    max_date = pd.read_sql(max_date_query, connectable).iloc[0, 0]
+    return None if max_date is None else pd.Timestamp(max_date)
+
+
+def get_max_dates(connectable, sites):
+    """{site: latest stored Date as a Timestamp, None if the site has no rows} of the stored sites among sites.
+    In the long format this is one query for every site."""
+    if isinstance(connectable, sqlalchemy.engine.Engine):
+        with connectable.connect() as conn:
+            return get_max_dates(conn, sites)
+
+    if not is_long_format(connectable):
+        site_tables = set(list_site_tables(connectable))
+        return {site: get_max_date(connectable, site) for site in sites if site in site_tables}
+
+    query = f'''SELECT name, (SELECT max(ts) FROM "{PRODUCTION_TABLE}" p WHERE p.site_id = s.site_id) AS max_ts
+                FROM "{SITES_TABLE}" s'''
+    max_ts = pd.read_sql(text(query), connectable).set_index('name')['max_ts'].to_dict()
+    return {site: None if pd.isna(max_ts[site]) else from_epoch(int(max_ts[site])) for site in sites if site in max_ts}
+
+
+def get_date_ranges(connectable):
+    """{site: (first stored Date, latest stored Date) as Timestamps} of every stored site with rows"""
+    if isinstance(connectable, sqlalchemy.engine.Engine):
+        with connectable.connect() as conn:
+            return get_date_ranges(conn)
+
+    if not is_long_format(connectable):
+        date_ranges = {}
+        for site in list_site_tables(connectable):
+            first_date, last_date = pd.read_sql(f"select min(Date), max(Date) from '{site}'", connectable).iloc[0]
+            if first_date is not None:
+                date_ranges[site] = (pd.Timestamp(first_date), pd.Timestamp(last_date))
+        return date_ranges
+
+    query = f'''SELECT name, min(ts) AS first_ts, max(ts) AS last_ts FROM "{PRODUCTION_TABLE}" p
+                JOIN "{SITES_TABLE}" s ON s.site_id = p.site_id GROUP BY p.site_id'''
+    return {site: (from_epoch(int(first_ts)), from_epoch(int(last_ts)))
+            for site, first_ts, last_ts in pd.read_sql(text(query), connectable).itertuples(index=False)}
+
+
+def ensure_unique_dates(conn, site):
+    """Gives a per-site table its unique Date index. Tables written before it existed may hold the same Date
+    several times, only the most recently written row of each is kept."""
+    index_name = f'ux_{site}_Date'
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = :name"
+    if conn.execute(text(query), {'name': index_name}).first() is not None:
+        return
+    conn.execute(text(f'''DELETE FROM "{site}" WHERE rowid NOT IN (SELECT max(rowid) FROM "{site}" GROUP BY Date)'''))
+    conn.execute(text(f'''CREATE UNIQUE INDEX "{index_name}" ON "{site}" (Date)'''))
+
+
+def ensure_unique_keys(engine):
+    """Adds the unique Date index to every per-site table missing it, a no-op in the long format whose primary key
+    already is (site_id, ts)"""
+    with engine.begin() as conn:
+        if is_long_format(conn):
+            return
+        for site in list_site_tables(conn):
+            ensure_unique_dates(conn, site)
+
+
+def insert_or_replace(pd_table, conn, keys, data_iter):
+    """to_sql insertion method replacing the stored rows with the same unique key, in a single executemany"""
+    conn.execute(pd_table.table.insert().prefix_with('OR REPLACE'), [dict(zip(keys, row)) for row in data_iter])
+
+
+def write_site_data(connectable, site, df):
+    """Upserts a site's rows (Date index, Production (kWh) column) in whichever layout the database uses"""
+    write_sites_data(connectable, {site: df})
+
+
+def write_sites_data(connectable, sites_data):
+    """Upserts the rows of every site in {site: DataFrame} in one transaction. Rows are keyed by (site, Date), so
+    writing the same rows again leaves the database unchanged."""
+    if isinstance(connectable, sqlalchemy.engine.Engine):
+        with get_write_lock(connectable), connectable.begin() as conn:
+            return write_sites_data(conn, sites_data)
+
+    if not is_long_format(connectable):
+        for site, df in sites_data.items():
+            df = df[~df.index.duplicated(keep='last')]
+            # New tables are created by to_sql and only get their index once written
+            table_exists = inspect(connectable).has_table(site)
+            if table_exists:
+                ensure_unique_dates(connectable, site)
+            df.to_sql(site, connectable, if_exists='append', method=insert_or_replace)
+            if not table_exists:
+                ensure_unique_dates(connectable, site)
+        return
+
+    site_ids = get_site_ids(connectable, list(sites_data), create=True)
+    rows = [{'site_id': site_ids[site], 'ts': ts, 'prod': prod}
+            for site, df in sites_data.items()
+            for ts, prod in zip(to_epoch(df.index).tolist(), df['Production (kWh)'].tolist())]
+    if rows:
+        connectable.execute(text(f'INSERT OR REPLACE INTO "{PRODUCTION_TABLE}" VALUES (:site_id, :ts, :prod)'), rows)
+
+
+def day_bounds(start=None, end=None):
+    """Turns inclusive start / end dates into Timestamps, the end one covering the whole end day"""
+    if start is not None:
+        start = pd.Timestamp(start).tz_localize(None).normalize()
+    if end is not None:
+        end = pd.Timestamp(end).tz_localize(None).normalize() + pd.Timedelta(days=1) - pd.Timedelta(seconds=1)
+    return start, end
+
+
+def to_bound(value, long_format, upper=False):
+    """A start (or with upper an end) bound comparable to the stored Dates. Per-site tables hold their dates as text
+    in several formats ('2024-01-02' for Fronius daily rows, '2024-01-02 00:00:00.000000' for the other vendors,
+    '2024-01-02 00:15:00' for 15 minute rows), so the bound is formatted to sort on the right side of all of them."""
+    if value is None:
+        return None
+    if long_format:
+        return int(to_epoch([value]).iloc[0])
+    if isinstance(value, str):
+        return value
+    value = pd.Timestamp(value)
+    if upper:
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+    if value == value.normalize():
+        return value.strftime('%Y-%m-%d')
+    return value.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def read_production(connectable, sites=None, start=None, end=None):
+    """Returns {site: DataFrame[Date, Production (kWh)]} sorted by Date, for the requested sites (all by default)
+    and the inclusive [start, end] range. Unknown sites get an empty frame.
+    In the long format this is one indexed query for every site."""
+    if not is_long_format(connectable):
+        return dict(iter_production(connectable, sites, start, end))
+
+    if sites is None:
+        sites = list_sites(connectable)
+    start, end = to_bound(start, True), to_bound(end, True, upper=True)
+    site_ids = get_site_ids(connectable, sites)
+    conditions = ['site_id IN (' + ', '.join(str(site_id) for site_id in site_ids.values()) + ')']
+    if start is not None:
+        conditions.append('ts >= :start')
+    if end is not None:
+        conditions.append('ts <= :end')
+    query = f'''SELECT site_id, ts, "Production (kWh)" FROM "{PRODUCTION_TABLE}"
+                WHERE {' AND '.join(conditions)} ORDER BY site_id, ts'''
+    prod_df = pd.read_sql(text(query), connectable, params={'start': start, 'end': end})
+    prod_df['Date'] = from_epoch(prod_df['ts'])
+    prod_df = prod_df.drop(columns='ts')
+    site_groups = dict(tuple(prod_df.groupby('site_id', sort=False)))
+
+    prod_data = {}
+    for site in sites:
+        if site in site_ids and site_ids[site] in site_groups:
+            site_df = site_groups[site_ids[site]]
+        else:
+            site_df = prod_df.iloc[0:0]
+        prod_data[site] = site_df[['Date', 'Production (kWh)']].reset_index(drop=True)
+    return prod_data
+
+
+def iter_production(connectable, sites=None, start=None, end=None):
+    """Yields the same (site, DataFrame) pairs as read_production, reading one site at a time so that callers only
+    hold a single site's rows in memory"""
+    long_format = is_long_format(connectable)
+    if sites is None:
+        sites = list_sites(connectable)
+    start, end = to_bound(start, long_format), to_bound(end, long_format, upper=True)
+
+    if long_format:
+        site_ids = get_site_ids(connectable, sites)
+        for site in sites:
+            yield site, read_long_format_site(connectable, site_ids.get(site), start, end)
+    else:
+        site_tables = set(list_site_tables(connectable))
+        for site in sites:
+            if site in site_tables:
+                yield site, read_site_table(connectable, site, start, end)
+            else:
+                yield site, pd.DataFrame(columns=['Date', 'Production (kWh)'])
+
+
+def read_long_format_site(connectable, site_id, start=None, end=None):
+    conditions = ['site_id = :site_id']
+    if start is not None:
+        conditions.append('ts >= :start')
+    if end is not None:
+        conditions.append('ts <= :end')
+    query = f'''SELECT ts, "Production (kWh)" FROM "{PRODUCTION_TABLE}" WHERE {' AND '.join(conditions)} ORDER BY ts'''
+    site_df = pd.read_sql(text(query), connectable, params={'site_id': site_id, 'start': start, 'end': end})
+    site_df.insert(0, 'Date', from_epoch(site_df.pop('ts')))
+    return site_df
+
+
+def read_site_production(connectable, site, start=None, end=None):
+    if is_long_format(connectable):
+        return read_production(connectable, [site], start, end)[site]
+    return read_site_table(connectable, site, to_bound(start, False), to_bound(end, False, upper=True))
+
+
+def read_site_table(connectable, site, start=None, end=None):
+    conditions = []
+    if start is not None:
+        conditions.append('Date >= :start')
+    if end is not None:
+        conditions.append('Date <= :end')
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f'''SELECT Date, "Production (kWh)" FROM "{site}" {where} ORDER BY Date'''
+    return pd.read_sql(text(query), connectable, params={'start': start, 'end': end})
+
+
+def migrate_to_long_format(engine):
+    """Moves every per-site table into the long format tables and drops it. Each site is moved in its own
+    transaction, so an interrupted migration can simply be run again."""
+    create_long_format_tables(engine)
+    for site in list_site_tables(engine):
+        with engine.begin() as conn:
+            df = pd.read_sql(f'''SELECT Date, "Production (kWh)" FROM "{site}"''', conn).set_index('Date')
+            write_site_data(conn, site, df)
+            conn.execute(text(f'DROP TABLE "{site}"'))
+        print(f'Migrated {len(df)} rows of {site}')
+
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+
+
+if __name__ == "__main__":
+    # Run from flask-server: python -m Database.production_store Prod_DB.db Prod_15min_DB.db
+    parser = argparse.ArgumentParser(description='Convert production databases to the long format layout')
+    parser.add_argument('databases', nargs='*', default=['Prod_DB.db', 'Prod_15min_DB.db'])
+    args = parser.parse_args()
+
+    for database in args.databases:
+        print(f'Migrating {database}...')
+        engine = sqlalchemy.create_engine(f'sqlite:///{database}')
+        migrate_to_long_format(engine)
+        engine.dispose()
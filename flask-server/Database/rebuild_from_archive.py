@@ -0,0 +1,170 @@
+import os
+import time
+import argparse
+import concurrent.futures
+import pandas as pd
+import sqlalchemy
+from API import response_archive
+from API.Enphase.solar_data import parse_archived_record as parse_enphase_record
+from API.SolarEdge.solar_data import parse_archived_record as parse_solaredge_record
+from API.Fronius.solar_data import parse_archived_record as parse_fronius_record, merge_archived_hist
+from Database.production_store import create_long_format_tables, create_setup_progress_table, ensure_unique_keys, \
+    is_long_format, get_date_ranges
+from Database.Prod_DB.setup_update_read_db import store_initial_vendor_data, finish_initial_daily_setup, \
+    VENDORS as DAILY_VENDORS
+from Database.Prod_DB_15_min.setup_update_read import store_initial_15min_vendor_data, \
+    VENDORS as FIFTEEN_MIN_VENDORS
+
+# Regenerates Prod_DB.db and Prod_15min_DB.db from the response archive without calling any API. The archive
+# files are parsed on a process pool, then each site's values are merged, a value fetched several times keeping its
+# latest version, and written to new databases that replace the old ones once complete. A database is only replaced
+# when the archive covers the whole stored history of each of its sites, so that nothing fetched before the archive
+# started is lost. Stop the server first.
+PARSERS = {
+    'Enphase': parse_enphase_record,
+    'SolarEdge': parse_solaredge_record,
+    'Fronius': parse_fronius_record,
+}
+# How the pieces of a site are merged when they are not frames of finished values
+MERGERS = {
+    ('Fronius', '15min'): merge_archived_hist,
+}
+
+
+def parse_partition(vendor, partition_path):
+    """[(table, site, data), ...] of every record of an archive file, in the order they were archived"""
+    parse = PARSERS[vendor]
+    parsed = []
+    for record in response_archive.read_partition(partition_path):
+        parsed.extend(parse(record))
+    return parsed
+
+
+def latest_values(frames):
+    """One frame out of frames in fetch order, each Date keeping its value in the latest frame holding it"""
+    site_df = pd.concat(frames)
+    return site_df[~site_df.index.duplicated(keep='last')].sort_index()
+
+
+def read_archive(archive_dir=response_archive.ARCHIVE_DIR, max_workers=None):
+    """{(vendor, table): {site name: DataFrame}} out of every archived response"""
+    partitions = response_archive.list_partitions(archive_dir)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        parsed_partitions = list(executor.map(parse_partition, *zip(*partitions))) if partitions else []
+
+    site_names = {vendor: dict() for vendor in PARSERS}
+    pieces = dict()
+    for (vendor, partition_path), parsed in zip(partitions, parsed_partitions):
+        for table, site, data in parsed:
+            if table == 'sites':
+                site_names[vendor].update(data)
+            else:
+                pieces.setdefault((vendor, table), dict()).setdefault(site, []).append(data)
+
+    tables = dict()
+    for (vendor, table), site_pieces in pieces.items():
+        merge = MERGERS.get((vendor, table), latest_values)
+        tables[(vendor, table)] = dict()
+        for site, data in site_pieces.items():
+            if site not in site_names[vendor]:
+                print(f'Skipping {vendor} site {site}, it is in no archived site list')
+                continue
+            tables[(vendor, table)][site_names[vendor][site]] = merge(data)
+    return tables
+
+
+def find_uncovered_sites(database, vendors):
+    """The sites stored in database whose history, from their first to their latest stored Date, the rebuilt data of
+    vendors does not cover. A database that does not exist yet has no history to lose."""
+    if not os.path.exists(database):
+        return []
+    engine = sqlalchemy.create_engine(f'sqlite:///{database}')
+    stored_ranges = get_date_ranges(engine)
+    engine.dispose()
+
+    rebuilt_ranges = dict()
+    for sites_data in vendors.values():
+        for site, df in sites_data.items():
+            dates = pd.to_datetime(df.index)
+            if len(dates) > 0:
+                rebuilt_ranges[site] = (dates.min(), dates.max())
+    uncovered_sites = []
+    for site, (first_date, last_date) in stored_ranges.items():
+        if site not in rebuilt_ranges or rebuilt_ranges[site][0] > first_date or rebuilt_ranges[site][1] < last_date:
+            uncovered_sites.append(site)
+    return uncovered_sites
+
+
+def build_database(database, long_format, vendors, store_vendor_data, finish_setup=None):
+    """Writes the vendors' tables to a new database replacing database once complete, and returns whether it did.
+    The vendors are only stored, and marked as set up, once the archive is known to cover every site of database.
+    Vendors missing from the archive are left as pending setup steps, the server's initial setup fetches them."""
+    uncovered_sites = find_uncovered_sites(database, vendors)
+    if uncovered_sites:
+        print(f'Keeping {database}, the archive does not cover the stored history of {len(uncovered_sites)} sites: '
+              f'{", ".join(uncovered_sites)}')
+        return False
+
+    rebuild_path = database + '.rebuild'
+    if os.path.exists(rebuild_path):
+        os.remove(rebuild_path)
+    engine = sqlalchemy.create_engine(f'sqlite:///{rebuild_path}')
+    if long_format:
+        create_long_format_tables(engine)
+    create_setup_progress_table(engine)
+
+    for vendor, sites_data in vendors.items():
+        print(f'{database}: {len(sites_data)} {vendor} sites')
+        store_vendor_data(engine, vendor, sites_data)
+    if finish_setup is not None:
+        finish_setup(engine)
+    ensure_unique_keys(engine)
+    engine.dispose()
+    os.replace(rebuild_path, database)
+    return True
+
+
+def rebuild(prod_database='Prod_DB.db', prod_15min_database='Prod_15min_DB.db',
+            archive_dir=response_archive.ARCHIVE_DIR, max_workers=None, long_format=None):
+    """Rebuilds both production databases from the archive. Without long_format each keeps its current layout, new
+    ones get the original layout. Returns the databases kept because the archive does not cover their history."""
+    start = time.perf_counter()
+    tables = read_archive(archive_dir, max_workers)
+    print(f'Read the archive in {time.perf_counter() - start:.1f}s')
+
+    kept_databases = []
+    for database, table, vendors, store_vendor_data, finish_setup in (
+            (prod_database, 'daily', DAILY_VENDORS, store_initial_vendor_data, finish_initial_daily_setup),
+            (prod_15min_database, '15min', FIFTEEN_MIN_VENDORS, store_initial_15min_vendor_data, None)):
+        database_long_format = long_format
+        if database_long_format is None:
+            database_long_format = False
+            if os.path.exists(database):
+                engine = sqlalchemy.create_engine(f'sqlite:///{database}')
+                database_long_format = is_long_format(engine)
+                engine.dispose()
+        if not build_database(database, database_long_format,
+                              {vendor: tables[(vendor, table)] for vendor in vendors if (vendor, table) in tables},
+                              store_vendor_data, finish_setup):
+            kept_databases.append(database)
+
+    rebuilt_databases = [database for database in (prod_database, prod_15min_database)
+                         if database not in kept_databases]
+    print(f'Rebuilt {" and ".join(rebuilt_databases) or "no database"} in {time.perf_counter() - start:.1f}s. '
+          f'The Metrics and Alerts tabs are refreshed by the next daily update.')
+    return kept_databases
+
+
+if __name__ == "__main__":
+    # Run from flask-server: python -m Database.rebuild_from_archive
+    parser = argparse.ArgumentParser(description='Rebuild the production databases from the response archive')
+    parser.add_argument('--archive', default=response_archive.ARCHIVE_DIR)
+    parser.add_argument('--daily-database', default='Prod_DB.db')
+    parser.add_argument('--15min-database', dest='fifteen_min_database', default='Prod_15min_DB.db')
+    parser.add_argument('--workers', type=int, default=None, help='parsing processes, one per CPU by default')
+    parser.add_argument('--long-format', action='store_true', default=None,
+                        help='write the long format layout instead of keeping the current one')
+    args = parser.parse_args()
+
+    if rebuild(args.daily_database, args.fifteen_min_database, args.archive, args.workers, args.long_format):
+        raise SystemExit(1)
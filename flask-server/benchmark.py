@@ -0,0 +1,357 @@
+import os
+import io
+import sys
+import json
+import math
+import time
+import zlib
+import shutil
+import platform
+import argparse
+import tempfile
+import contextlib
+import subprocess
+import statistics
+import importlib.metadata
+import tracemalloc
+from datetime import datetime, date, timedelta
+import numpy as np
+import pandas as pd
+import sqlalchemy
+from Database.production_store import create_long_format_tables, create_setup_progress_table, mark_setup_step, \
+    write_sites_data, ensure_unique_keys
+from Database.Prod_DB.setup_update_read_db import download_DB_data_daily, finish_initial_daily_setup, \
+    VENDORS as DAILY_VENDORS
+from Database.Prod_DB_15_min.setup_update_read import download_DB_data_15min, storage_frame, \
+    VENDORS as FIFTEEN_MIN_VENDORS
+from Database.Site_Details_DB.setup_update_read import SITE_DETAILS_TABLES
+from fake_vendor import build_fleet, DEFAULT_SITES, DAYLIGHT_START, DAYLIGHT_HOURS
+import response_cache
+import server
+
+# Times the read paths of the server on synthetic Prod_DB.db, Prod_15min_DB.db and Site_Details_DB.db built at
+# every combination of --sites and --years, and writes the latency and peak memory of each benchmark as JSON.
+# Run from flask-server, for instance the full grid into a kept directory, then compared against an earlier run:
+#   python benchmark.py --sites 50 500 5000 --years 1 15 --directory Benchmark_DB --output after.json
+#   python benchmark.py --sites 50 500 5000 --years 1 15 --directory Benchmark_DB --compare before.json
+# The fleet is split between the vendors like the fake vendor's and generated the same way, every run with the same
+# options building the same databases. Built databases are kept under --directory and reused by later runs, without
+# it they go to a temporary directory removed at the end.
+# Latencies are wall clock seconds over --repeats calls, each one with the response cache invalidated. The peak
+# memory is that of the Python allocations (tracemalloc) of one more call, SQLite's own memory is not included.
+DEFAULT_SCALES = {'sites': (50, 500), 'years': (1, 15)}
+DEFAULT_REPEATS = 3
+# The 15 minute database only holds what the jobs appended since it was set up
+DEFAULT_15MIN_DAYS = 60
+INTERVALS_PER_DAY = 96
+# Sites written per transaction while building, which bounds the memory the build needs
+WRITE_BATCH_SITES = 100
+# A regression is reported when a median latency or peak memory grows by more than this factor
+DEFAULT_THRESHOLD = 1.2
+# The Alerts table of Site_Details_DB.db has a column per site plus the index and fleet-wide ones, so fleets beyond
+# SQLite's default limit of 2000 columns cannot be written. Their alerts benchmarks are skipped.
+MAX_ALERTS_SITES = 2000 - 2
+ALERTS_BENCHMARKS = ('put_zeroProductionDaily_sites_on_DB', 'GET /alerts')
+DAILY_TIMEFRAMES = ('daily', 'monthly', 'yearly')
+FIFTEEN_MIN_TIMEFRAMES = ('15T', 'H', '12H')
+
+
+def fleet_sites(sites):
+    """{vendor: number of sites} of a fleet of sites split between the vendors like DEFAULT_SITES"""
+    total = sum(DEFAULT_SITES.values())
+    counts = {vendor: sites * count // total for vendor, count in DEFAULT_SITES.items()}
+    counts['SolarEdge'] += sites - sum(counts.values())
+    return counts
+
+
+def day_factors(site, days):
+    """Share of its clear sky production a site makes on each of days, seasonal with cloudy days and the odd outage
+    like fake_vendor.day_factor, drawn at once from the site's own random generator"""
+    rng = np.random.default_rng(zlib.crc32(site['key'].encode()))
+    season = 0.55 + 0.45 * np.cos(2 * np.pi * (days.dayofyear.to_numpy() - 172) / 365)
+    factors = season * (0.3 + 0.7 * rng.random(len(days)))
+    factors[rng.random(len(days)) < 0.02] = 0.0
+    return factors
+
+
+def daily_frame(site, first_day, last_day):
+    """A site's daily production from when it started, as stored by the daily jobs"""
+    days = pd.date_range(max(first_day, site['start']), last_day, freq='D', name='Date')
+    clear_sky_kwh = site['peak_w'] * DAYLIGHT_HOURS * 2 / math.pi / 1000
+    return pd.DataFrame({'Production (kWh)': np.round(clear_sky_kwh * day_factors(site, days), 3)}, index=days)
+
+
+def fifteen_min_frame(site, first_day, last_day):
+    """A site's production per 15 minutes from when it started, as stored by the 15 minute jobs"""
+    days = pd.date_range(max(first_day, site['start']), last_day, freq='D')
+    intervals = pd.date_range(days[0], periods=len(days) * INTERVALS_PER_DAY, freq='15min', name='Date') \
+        if len(days) else pd.DatetimeIndex([], name='Date')
+    hours = np.arange(INTERVALS_PER_DAY + 1) / 4
+    angles = np.clip(np.pi * (hours - DAYLIGHT_START) / DAYLIGHT_HOURS, 0, np.pi)
+    clear_sky_kwh = site['peak_w'] * DAYLIGHT_HOURS / math.pi / 1000 * -np.diff(np.cos(angles))
+    production = np.outer(day_factors(site, days), clear_sky_kwh).ravel()
+    return pd.DataFrame({'Production (kWh)': np.round(production, 4)}, index=intervals)
+
+
+def site_details_frames(fleet):
+    """{table: DataFrame} of the site details tables, with the columns the vendor updates write and the server reads"""
+    enphase_df = pd.DataFrame([{'system_id': site['id'], 'name': site['name'], 'public_name': 'Residential System',
+                                'status': 'System Normal', 'timezone': 'America/Edmonton', 'size_w': site['peak_w']}
+                               for site in fleet['Enphase'].values()]).set_index('system_id')
+    solaredge_df = pd.DataFrame([{'site name': site['name'], 'status': 'Active', 'Peak Power': site['peak_w'] / 1000,
+                                  'start_date': f'{site["start"]:%Y-%m-%d}'}
+                                 for site in fleet['SolarEdge'].values()]).set_index('site name')
+    fronius_df = pd.DataFrame([{'site name': site['name'], 'Peak Power': site['peak_w'] / 1000,
+                                'startdate': f'{site["start"]:%Y-%m-%d}'}
+                               for site in fleet['Fronius'].values()]).set_index('site name')
+    return {SITE_DETAILS_TABLES['Enphase']: enphase_df, SITE_DETAILS_TABLES['SolarEdge']: solaredge_df,
+            SITE_DETAILS_TABLES['Fronius']: fronius_df}
+
+
+def write_vendor_frames(engine, vendors, fleet, make_frame, first_day, last_day, to_storage=None):
+    """Writes the production of the vendors' sites WRITE_BATCH_SITES at a time, recording each vendor's setup step.
+    to_storage(conn, df) formats the frames the way the jobs store them."""
+    for vendor in vendors:
+        sites = list(fleet[vendor].values())
+        for batch_start in range(0, len(sites), WRITE_BATCH_SITES):
+            batch = sites[batch_start:batch_start + WRITE_BATCH_SITES]
+            with engine.begin() as conn:
+                sites_data = {site['name']: make_frame(site, first_day, last_day) for site in batch}
+                if to_storage is not None:
+                    sites_data = {site: to_storage(conn, df) for site, df in sites_data.items()}
+                write_sites_data(conn, sites_data)
+        with engine.begin() as conn:
+            mark_setup_step(conn, vendor)
+
+
+def build_databases(directory, sites, years, fifteen_min_days=DEFAULT_15MIN_DAYS, long_format=False):
+    """Builds the three databases of a fleet of sites with years of daily history in directory"""
+    os.makedirs(directory, exist_ok=True)
+    fleet = build_fleet(fleet_sites(sites), years * 365)
+    today = date.today()
+    yesterday = today - timedelta(days=1)
+
+    sites_engine = sqlalchemy.create_engine(f'sqlite:///{os.path.join(directory, "Site_Details_DB.db")}')
+    for table_name, site_df in site_details_frames(fleet).items():
+        site_df.to_sql(table_name, sites_engine, if_exists='replace')
+    sites_engine.dispose()
+
+    for database, vendors, make_frame, first_day, last_day, to_storage in (
+            ('Prod_DB.db', DAILY_VENDORS, daily_frame, today - timedelta(days=years * 365), yesterday, None),
+            ('Prod_15min_DB.db', FIFTEEN_MIN_VENDORS, fifteen_min_frame,
+             today - timedelta(days=min(years * 365, fifteen_min_days)), yesterday, storage_frame)):
+        engine = sqlalchemy.create_engine(f'sqlite:///{os.path.join(directory, database)}')
+        if long_format:
+            create_long_format_tables(engine)
+        create_setup_progress_table(engine)
+        write_vendor_frames(engine, vendors, fleet, make_frame, first_day, last_day, to_storage)
+        if database == 'Prod_DB.db':
+            finish_initial_daily_setup(engine)
+        ensure_unique_keys(engine)
+        engine.dispose()
+
+
+def measure(run, repeats, before=None):
+    """Wall clock seconds of repeats calls of run and the peak Python memory of one more, before() being called
+    ahead of every one of them. A call raising is recorded as the benchmark's error."""
+    seconds = []
+    try:
+        for _ in range(repeats + 1):
+            if before is not None:
+                before()
+            tracing = len(seconds) == repeats
+            if tracing:
+                tracemalloc.start()
+            start = time.perf_counter()
+            outcome = run()
+            elapsed = time.perf_counter() - start
+            if tracing:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            else:
+                seconds.append(elapsed)
+    except Exception as error:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        # SQLAlchemy errors carry the whole statement, the first line is enough to tell them apart
+        return {'error': f'{type(error).__name__}: {str(error).splitlines()[0]}'}
+
+    result = {'median_s': statistics.median(seconds), 'min_s': min(seconds), 'max_s': max(seconds),
+              'repeats': repeats, 'peak_memory_bytes': peak_memory}
+    if outcome is not None:
+        result.update(outcome)
+    return result
+
+
+def invalidate_response_cache():
+    response_cache.clear()
+
+
+def route_call(client, method, path, body=None):
+    """Requests a route through the test client, reading the whole (possibly streamed) body"""
+    def run():
+        response = client.open(path, method=method, json=body)
+        payload = response.get_data()
+        if response.status_code != 200:
+            raise RuntimeError(f'{method} {path} answered {response.status_code}')
+        return {'response_bytes': len(payload)}
+    return run
+
+
+def benchmark_scale(repeats, sites):
+    """{benchmark: result} of every benchmark, run on the databases of the working directory holding sites sites"""
+    def timed(name, run, before=invalidate_response_cache):
+        print(f'  {name}', file=sys.__stdout__, flush=True)
+        if name in ALERTS_BENCHMARKS and sites > MAX_ALERTS_SITES:
+            results[name] = {'skipped': f'the Alerts table holds at most {MAX_ALERTS_SITES} sites'}
+            return
+        # The progress the server prints and the tracebacks of failing routes Flask logs are left out of the output
+        with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+            results[name] = measure(run, repeats, before)
+
+    results = {}
+    sites_engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
+    timed('put_aggregated_production_on_DB', lambda: server.put_aggregated_production_on_DB(sites_engine))
+    timed('put_zeroProductionDaily_sites_on_DB', lambda: server.put_zeroProductionDaily_sites_on_DB(sites_engine))
+    sites_engine.dispose()
+
+    prod_engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    for timeframe in DAILY_TIMEFRAMES:
+        timed(f'download_DB_data_daily[{timeframe}]', lambda: download_DB_data_daily(prod_engine, interval=timeframe))
+    prod_engine.dispose()
+    prod_15min_engine = sqlalchemy.create_engine('sqlite:///Prod_15min_DB.db')
+    for timeframe in FIFTEEN_MIN_TIMEFRAMES:
+        timed(f'download_DB_data_15min[{timeframe}]',
+              lambda: download_DB_data_15min(prod_15min_engine, interval=timeframe))
+    prod_15min_engine.dispose()
+
+    client = server.app.test_client()
+    for path in ('/api/site_filter/daily', '/api/site_filter/fifteen', '/api/aggregated-production', '/alerts'):
+        timed(f'GET {path}', route_call(client, 'GET', path))
+    for timeframe in DAILY_TIMEFRAMES:
+        timed(f'POST /api/data[{timeframe}]', route_call(client, 'POST', '/api/data', {'selection': timeframe}))
+    for timeframe in FIFTEEN_MIN_TIMEFRAMES:
+        timed(f'POST /api/15min/data[{timeframe}]',
+              route_call(client, 'POST', '/api/15min/data', {'selection': timeframe}))
+    # Served from the response cache, as every request after the first of a data update is
+    timed('POST /api/data[daily] cached', route_call(client, 'POST', '/api/data', {'selection': 'daily'}), None)
+    return results
+
+
+def get_version():
+    """Commit of the tree being benchmarked, with '-dirty' when it has uncommitted changes"""
+    repo_dir = os.path.dirname(os.path.realpath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain'], cwd=repo_dir, capture_output=True, text=True,
+                               check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def run_benchmarks(sites_scales, years_scales, directory=None, repeats=DEFAULT_REPEATS,
+                   fifteen_min_days=DEFAULT_15MIN_DAYS, long_format=False):
+    """Builds (or reuses) the databases of every scale and benchmarks them, returning the JSON report"""
+    report = {
+        'version': get_version(),
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'packages': {'pandas': pd.__version__, 'numpy': np.__version__, 'sqlalchemy': sqlalchemy.__version__,
+                     'flask': importlib.metadata.version('flask')},
+        'parameters': {'repeats': repeats, 'fifteen_min_days': fifteen_min_days, 'long_format': long_format},
+        'scales': [],
+    }
+    base_dir = directory or tempfile.mkdtemp(prefix='solar_benchmark_')
+    working_dir = os.getcwd()
+    try:
+        for sites in sites_scales:
+            for years in years_scales:
+                scale_dir = os.path.realpath(os.path.join(
+                    base_dir, f'{sites}_sites_{years}_years{"_long" if long_format else ""}'))
+                if not all(os.path.exists(os.path.join(scale_dir, database))
+                           for database in ('Prod_DB.db', 'Prod_15min_DB.db', 'Site_Details_DB.db')):
+                    print(f'Building {sites} sites with {years} years of history in {scale_dir}')
+                    start = time.perf_counter()
+                    shutil.rmtree(scale_dir, ignore_errors=True)
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        build_databases(scale_dir, sites, years, fifteen_min_days, long_format)
+                    print(f'Built in {time.perf_counter() - start:.1f}s')
+
+                print(f'Benchmarking {sites} sites with {years} years of history')
+                os.chdir(scale_dir)
+                try:
+                    results = benchmark_scale(repeats, sites)
+                finally:
+                    os.chdir(working_dir)
+                report['scales'].append({'sites': sites, 'years': years, 'results': results})
+    finally:
+        if directory is None:
+            shutil.rmtree(base_dir, ignore_errors=True)
+    return report
+
+
+def compare_reports(baseline, report, threshold=DEFAULT_THRESHOLD):
+    """Lines describing every benchmark whose median latency or peak memory grew by more than threshold times from
+    the baseline report, the scales and benchmarks missing from either one being skipped"""
+    baseline_scales = {(scale['sites'], scale['years']): scale['results'] for scale in baseline['scales']}
+    regressions = []
+    for scale in report['scales']:
+        baseline_results = baseline_scales.get((scale['sites'], scale['years']), {})
+        for name, result in scale['results'].items():
+            before = baseline_results.get(name)
+            if before is None:
+                continue
+            if 'error' in result and 'error' not in before:
+                regressions.append(f'{scale["sites"]} sites, {scale["years"]} years, {name}: {result["error"]}')
+                continue
+            for metric in ('median_s', 'peak_memory_bytes'):
+                if metric in result and before.get(metric) and result[metric] > before[metric] * threshold:
+                    regressions.append(f'{scale["sites"]} sites, {scale["years"]} years, {name}: {metric} '
+                                       f'{before[metric]:.4g} -> {result[metric]:.4g} '
+                                       f'({result[metric] / before[metric]:.2f}x)')
+    return regressions
+
+
+def print_report(report):
+    for scale in report['scales']:
+        print(f'\n{scale["sites"]} sites, {scale["years"]} years')
+        for name, result in scale['results'].items():
+            if 'error' in result or 'skipped' in result:
+                print(f'  {name:45} {result.get("error") or result["skipped"]}')
+            else:
+                print(f'  {name:45} {result["median_s"] * 1000:10.1f} ms '
+                      f'{result["peak_memory_bytes"] / 2 ** 20:9.1f} MiB')
+
+
+if __name__ == "__main__":
+    # Run from flask-server: python benchmark.py
+    parser = argparse.ArgumentParser(description='Benchmark the read endpoints on synthetic databases')
+    parser.add_argument('--sites', type=int, nargs='+', default=DEFAULT_SCALES['sites'], help='fleet sizes')
+    parser.add_argument('--years', type=int, nargs='+', default=DEFAULT_SCALES['years'],
+                        help='years of daily history')
+    parser.add_argument('--15min-days', dest='fifteen_min_days', type=int, default=DEFAULT_15MIN_DAYS,
+                        help='days of 15 minute history, at most the daily history')
+    parser.add_argument('--long-format', action='store_true', help='build the databases in the long format layout')
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='timed calls of every benchmark')
+    parser.add_argument('--directory', help='where the databases are built and kept for later runs')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON results of an earlier run to report regressions against')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='growth factor of a latency or peak memory reported as a regression')
+    args = parser.parse_args()
+
+    benchmark_report = run_benchmarks(args.sites, args.years, args.directory, args.repeats, args.fifteen_min_days,
+                                      args.long_format)
+    print_report(benchmark_report)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(benchmark_report, output_file, indent=2)
+        print(f'\nResults written to {args.output}')
+    if args.compare:
+        with open(args.compare, 'r') as baseline_file:
+            found = compare_reports(json.load(baseline_file), benchmark_report, args.threshold)
+        print(f'\n{len(found)} regressions against {args.compare}' + ''.join(f'\n  {line}' for line in found))
+        if found:
+            sys.exit(1)
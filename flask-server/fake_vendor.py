@@ -0,0 +1,453 @@
+import os
+import json
+import math
+import time
+import uuid
+import zlib
+import random
+import logging
+import argparse
+import threading
+from datetime import datetime, timedelta, date
+from flask import Flask, request, jsonify
+
+# Local stand-in for the Enphase, SolarEdge and Fronius APIs serving a generated fleet, so that ingestion can be load
+# tested and profiled without spending API quota. Run from flask-server, for instance with ten times the default
+# fleet and 200 ms of latency:
+#   python fake_vendor.py --scale 10 --latency 0.2 --config-dir /tmp/fake_vendor_configs
+# --config-dir writes SolarEdge/config.json, Fronius/config.json and Enphase/run_params_*.json pointing at the fake in
+# that directory. The server reads them instead of the real configs when run with
+# SOLAR_API_CONFIG_DIR=/tmp/fake_vendor_configs, see API/config_paths.py.
+# Production follows the daylight and the seasons and is generated from each site's ID and the time, so every run
+# with the same options serves the same data. GET /_stats returns the requests served so far, GET /_reset clears them.
+DEFAULT_SITES = {'Enphase': 10, 'SolarEdge': 20, 'Fronius': 10}
+DEFAULT_HISTORY_DAYS = 3 * 365
+DEFAULT_PORT = 8765
+# Limits of the real APIs: sites per SolarEdge call, days per SolarEdge energy call and entries per page
+SOLAREDGE_MAX_SITES = 100
+SOLAREDGE_MAX_DAYS = {'DAY': 366, 'QUARTER_OF_AN_HOUR': 31}
+ENPHASE_MAX_PAGE_SIZE = 100
+FRONIUS_MAX_PAGE_LIMIT = 1000
+SOLAREDGE_ACCOUNT_ID = 62361
+# Production starts at DAYLIGHT_START and follows a half sine over DAYLIGHT_HOURS
+DAYLIGHT_START = 6
+DAYLIGHT_HOURS = 14
+FRONIUS_UTC_OFFSET = '-07:00'
+
+ENPHASE_PARAMS_FILES = [f'run_params_{api}.json' for api in (1, 2, 3, 4)]
+
+app = Flask(__name__)
+_lock = threading.Lock()
+_random = random.Random()
+_options = {'latency': 0.0, 'error_rate': 0.0, 'throttle_rate': 0.0}
+_fleet = {}
+_stats = {'requests': {}, 'injected_errors': 0, 'injected_throttles': 0, 'in_flight': 0, 'max_in_flight': 0}
+
+
+def build_fleet(sites, history_days):
+    """{vendor: {site ID: site}} of sites installed over the first quarter of the history"""
+    today = date.today()
+    fleet = {}
+    for vendor, count in sites.items():
+        fleet[vendor] = {}
+        for i in range(count):
+            key = f'{vendor}-{i}'
+            seed = zlib.crc32(key.encode())
+            if vendor == 'Enphase':
+                site_id = 2000000 + i
+            elif vendor == 'SolarEdge':
+                site_id = 100000 + i
+            else:
+                site_id = str(uuid.uuid5(uuid.NAMESPACE_URL, key))
+            fleet[vendor][site_id] = {
+                'id': site_id,
+                'key': key,
+                'name': f'{"CoC " if vendor == "SolarEdge" else ""}Fake {vendor} Site {i + 1}',
+                'peak_w': 5000 + seed % 95000,
+                'start': today - timedelta(days=history_days - seed % max(1, history_days // 4)),
+            }
+    return fleet
+
+
+def day_factor(site, day):
+    """Share of its clear sky production a site makes on a day, seasonal with cloudy days and the odd outage"""
+    seed = zlib.crc32(f'{site["key"]}|{day:%Y-%m-%d}'.encode())
+    if seed % 50 == 0:
+        return 0.0
+    season = 0.55 + 0.45 * math.cos(2 * math.pi * (day.timetuple().tm_yday - 172) / 365)
+    return season * (0.3 + 0.7 * (seed % 1000) / 999)
+
+
+def energy(site, start, end):
+    """Wh produced between start and end, both within the same day (end may be the next midnight), nothing before
+    the site started or after now"""
+    end = min(end, datetime.now())
+    if end <= start or start.date() < site['start']:
+        return 0.0
+    midnight = datetime.combine(start.date(), datetime.min.time())
+    angles = [min(max(math.pi * ((moment - midnight).total_seconds() / 3600 - DAYLIGHT_START) / DAYLIGHT_HOURS, 0),
+                  math.pi) for moment in (start, end)]
+    clear_sky = site['peak_w'] * DAYLIGHT_HOURS / math.pi * (math.cos(angles[0]) - math.cos(angles[1]))
+    return round(clear_sky * day_factor(site, start.date()), 1)
+
+
+def day_energy(site, day):
+    midnight = datetime.combine(day, datetime.min.time())
+    return energy(site, midnight, midnight + timedelta(days=1))
+
+
+def get_site(vendor, site_id):
+    return _fleet[vendor].get(int(site_id) if vendor != 'Fronius' else site_id)
+
+
+def error(status, message):
+    return jsonify({'error': message}), status
+
+
+@app.before_request
+def before_request():
+    with _lock:
+        _stats['requests'][request.endpoint] = _stats['requests'].get(request.endpoint, 0) + 1
+        _stats['in_flight'] += 1
+        _stats['max_in_flight'] = max(_stats['max_in_flight'], _stats['in_flight'])
+    if request.path.startswith('/_'):
+        return None
+    if _options['latency']:
+        time.sleep(_options['latency'])
+    with _lock:
+        roll = _random.random()
+    if roll < _options['error_rate']:
+        with _lock:
+            _stats['injected_errors'] += 1
+        return error(500, 'Injected server error')
+    if roll < _options['error_rate'] + _options['throttle_rate']:
+        with _lock:
+            _stats['injected_throttles'] += 1
+        response, status = error(429, 'Injected rate limit')
+        response.headers['Retry-After'] = '1'
+        return response, status
+    return None
+
+
+@app.teardown_request
+def teardown_request(exception):
+    with _lock:
+        _stats['in_flight'] -= 1
+
+
+@app.route('/_stats')
+def get_stats():
+    with _lock:
+        return jsonify({**_stats, 'sites': {vendor: len(sites) for vendor, sites in _fleet.items()}})
+
+
+@app.route('/_reset')
+def reset_stats():
+    with _lock:
+        _stats.update({'requests': {}, 'injected_errors': 0, 'injected_throttles': 0, 'max_in_flight': 0})
+    return jsonify({'reset': True})
+
+
+# SolarEdge
+@app.route('/solaredge/sites/list')
+def solaredge_site_list():
+    sites = [{
+        'id': site['id'],
+        'name': site['name'],
+        'accountId': SOLAREDGE_ACCOUNT_ID,
+        'status': 'Active',
+        'peakPower': site['peak_w'] / 1000,
+        'installationDate': site['start'].strftime('%Y-%m-%d'),
+        'location': {'country': 'Canada', 'state': 'Alberta', 'city': 'Calgary',
+                     'address': f'{i + 1} Fake Street', 'zip': 'T2P 2M5'},
+    } for i, site in enumerate(_fleet['SolarEdge'].values())]
+    size = min(int(request.args.get('size', SOLAREDGE_MAX_SITES)), SOLAREDGE_MAX_SITES)
+    start_index = int(request.args.get('startIndex', 0))
+    return jsonify({'sites': {'count': len(sites), 'site': sites[start_index:start_index + size]}})
+
+
+def get_solaredge_sites(site_ids):
+    sites = [get_site('SolarEdge', site_id) for site_id in site_ids.split(',')]
+    if len(sites) > SOLAREDGE_MAX_SITES or None in sites:
+        return None
+    return sites
+
+
+@app.route('/solaredge/sites/<site_ids>/dataPeriod')
+def solaredge_site_date_range(site_ids):
+    sites = get_solaredge_sites(site_ids)
+    if sites is None:
+        return error(403, 'Unknown site or more than 100 sites')
+    return jsonify({'datePeriodList': {'count': len(sites), 'siteEnergyList': [{
+        'siteId': site['id'],
+        'dataPeriod': {'startDate': site['start'].strftime('%Y-%m-%d'), 'endDate': date.today().strftime('%Y-%m-%d')},
+    } for site in sites]}})
+
+
+def solaredge_energy_values(site, start_date, end_date, time_unit):
+    """Values of every day or quarter hour from start_date to end_date, None for the ones to come"""
+    values = []
+    day = max(start_date, site['start'])
+    now = datetime.now()
+    while day <= end_date:
+        midnight = datetime.combine(day, datetime.min.time())
+        if time_unit == 'DAY':
+            values.append({'date': midnight.strftime('%Y-%m-%d %H:%M:%S'),
+                           'value': day_energy(site, day) if midnight <= now else None})
+        else:
+            for quarter in range(96):
+                start = midnight + timedelta(minutes=15 * quarter)
+                values.append({'date': start.strftime('%Y-%m-%d %H:%M:%S'),
+                               'value': energy(site, start, start + timedelta(minutes=15)) if start <= now else None})
+        day += timedelta(days=1)
+    return values
+
+
+def solaredge_energy_request(site_ids):
+    sites = get_solaredge_sites(site_ids)
+    time_unit = request.args.get('timeUnit', 'DAY')
+    start_date = datetime.strptime(request.args['startDate'], '%Y-%m-%d').date()
+    end_date = datetime.strptime(request.args['endDate'], '%Y-%m-%d').date()
+    if sites is None:
+        return None, error(403, 'Unknown site or more than 100 sites')
+    if time_unit not in SOLAREDGE_MAX_DAYS or (end_date - start_date).days > SOLAREDGE_MAX_DAYS[time_unit]:
+        return None, error(403, f'Unsupported time unit or period too long for {time_unit}')
+    return [(site, solaredge_energy_values(site, start_date, end_date, time_unit)) for site in sites], None
+
+
+@app.route('/solaredge/site/<site_id>/energy')
+def solaredge_site_energy(site_id):
+    site_values, failure = solaredge_energy_request(site_id)
+    if failure is not None:
+        return failure
+    return jsonify({'energy': {'timeUnit': request.args.get('timeUnit', 'DAY'), 'unit': 'Wh',
+                               'measuredBy': 'INVERTER', 'values': site_values[0][1]}})
+
+
+@app.route('/solaredge/sites/<site_ids>/energy')
+def solaredge_sites_energy(site_ids):
+    site_values, failure = solaredge_energy_request(site_ids)
+    if failure is not None:
+        return failure
+    return jsonify({'sitesEnergy': {'timeUnit': request.args.get('timeUnit', 'DAY'), 'unit': 'Wh',
+                                    'count': len(site_values), 'siteEnergyList': [{
+                                        'siteId': site['id'],
+                                        'energyValues': {'measuredBy': 'INVERTER', 'values': values},
+                                    } for site, values in site_values]}})
+
+
+# Fronius
+def fronius_page(entries):
+    """The page of entries the offset and limit arguments ask for, with a next link to the following one"""
+    limit = min(int(request.args.get('limit', FRONIUS_MAX_PAGE_LIMIT)), FRONIUS_MAX_PAGE_LIMIT)
+    offset = int(request.args.get('offset', 0))
+    links = {'totalItemsCount': len(entries), 'next': None}
+    if offset + limit < len(entries):
+        arguments = {**request.args.to_dict(), 'offset': offset + limit}
+        links['next'] = request.path + '?' + '&'.join(f'{key}={value}' for key, value in arguments.items())
+    return jsonify({'data': entries[offset:offset + limit] or None, 'links': links})
+
+
+@app.route('/fronius/swqapi/pvsystems')
+def fronius_site_details():
+    return jsonify({'pvSystems': [{
+        'pvSystemId': site['id'],
+        'name': site['name'],
+        'peakPower': site['peak_w'],
+        'installationDate': site['start'].strftime('%Y-%m-%dT00:00:00Z'),
+        'address': {'country': 'Canada', 'state': 'Alberta', 'city': 'Calgary',
+                    'street': f'{i + 1} Fake Avenue', 'zipCode': 'T2P 2M5'},
+    } for i, site in enumerate(_fleet['Fronius'].values())]})
+
+
+@app.route('/fronius/swqapi/pvsystems/<site_id>/devices')
+def fronius_site_devices(site_id):
+    site = get_site('Fronius', site_id)
+    if site is None:
+        return error(404, 'Unknown PV system')
+    return jsonify({'devices': [{
+        'deviceId': str(uuid.uuid5(uuid.NAMESPACE_URL, f'{site["key"]}-inverter')),
+        'deviceType': 'Inverter',
+        'deviceName': 'Fake Inverter',
+        'activationDate': site['start'].strftime('%Y-%m-%dT00:00:00Z'),
+        'isActive': True,
+    }]})
+
+
+@app.route('/fronius/swqapi/pvsystems/<site_id>/aggrdata')
+def fronius_aggr_data(site_id):
+    site = get_site('Fronius', site_id)
+    if site is None:
+        return error(404, 'Unknown PV system')
+    day = max(datetime.strptime(request.args['from'][:10], '%Y-%m-%d').date(), site['start'])
+    end_date = min(datetime.strptime(request.args['to'][:10], '%Y-%m-%d').date(), date.today())
+    entries = []
+    while day <= end_date:
+        entries.append({'logDateTime': day.strftime('%Y-%m-%d'),
+                        'channels': [{'channelName': 'EnergyOutput', 'unit': 'Wh', 'value': day_energy(site, day)}]})
+        day += timedelta(days=1)
+    return fronius_page(entries)
+
+
+@app.route('/fronius/swqapi/pvsystems/<site_id>/histdata')
+def fronius_hist_data(site_id):
+    site = get_site('Fronius', site_id)
+    if site is None:
+        return error(404, 'Unknown PV system')
+    # Entries are logged every 5 minutes, each one with the energy of the 5 minutes it ends
+    end = min(datetime.strptime(request.args['to'][:19], '%Y-%m-%dT%H:%M:%S'), datetime.now())
+    log_time = datetime.strptime(request.args['from'][:19], '%Y-%m-%dT%H:%M:%S').replace(second=0)
+    log_time += timedelta(minutes=5 - log_time.minute % 5)
+    log_time = max(log_time, datetime.combine(site['start'], datetime.min.time()) + timedelta(minutes=5))
+    entries = []
+    while log_time <= end:
+        entries.append({'logDateTime': log_time.strftime('%Y-%m-%dT%H:%M:%S') + FRONIUS_UTC_OFFSET,
+                        'channels': [{'channelName': 'EnergyProductionTotal', 'unit': 'Wh',
+                                      'value': energy(site, log_time - timedelta(minutes=5), log_time)}]})
+        log_time += timedelta(minutes=5)
+    return fronius_page(entries)
+
+
+# Enphase
+@app.route('/enphase/api/v4/systems')
+def enphase_systems():
+    systems = [{
+        'system_id': site['id'],
+        'name': site['name'],
+        'public_name': 'Residential System',
+        'timezone': 'America/Edmonton',
+        'address': {'city': 'Calgary', 'state': 'AB', 'country': 'CA', 'postal_code': 'T2P'},
+        'connection_type': 'ethernet',
+        'status': 'normal',
+        'last_report_at': int(time.time()),
+        'last_energy_at': int(time.time()),
+        'operational_at': int(datetime.combine(site['start'], datetime.min.time()).timestamp()),
+        'attachment_type': 'rack_mount',
+        'interconnect_date': site['start'].strftime('%Y-%m-%d'),
+        'other_references': [],
+        'energy_lifetime': 0,
+        'energy_today': 0,
+        'system_size': site['peak_w'],
+    } for site in _fleet['Enphase'].values()]
+    size = min(int(request.args.get('size', ENPHASE_MAX_PAGE_SIZE)), ENPHASE_MAX_PAGE_SIZE)
+    page = int(request.args.get('page', 1))
+    page_systems = systems[(page - 1) * size:page * size]
+    return jsonify({'total': len(systems), 'current_page': page, 'size': size, 'count': len(page_systems),
+                    'items': 'systems', 'systems': page_systems})
+
+
+@app.route('/enphase/api/v4/systems/<int:system_id>/energy_lifetime')
+def enphase_energy_lifetime(system_id):
+    site = get_site('Enphase', system_id)
+    if site is None:
+        return error(404, 'Unknown system')
+    # Production is reported up to yesterday
+    start_date = max(datetime.strptime(request.args.get('start_date', '1970-01-01'), '%Y-%m-%d').date(), site['start'])
+    end_date = date.today() - timedelta(days=1)
+    if 'end_date' in request.args:
+        end_date = min(end_date, datetime.strptime(request.args['end_date'], '%Y-%m-%d').date())
+    production = [round(day_energy(site, start_date + timedelta(days=i)))
+                  for i in range((end_date - start_date).days + 1)]
+    return jsonify({'system_id': system_id, 'start_date': start_date.strftime('%Y-%m-%d'), 'production': production,
+                    'micro_production': production, 'meter_production': [], 'meter_start_date': None,
+                    'meta': {'status': 'normal'}})
+
+
+@app.route('/enphase/api/v4/systems/<int:system_id>/summary')
+def enphase_summary(system_id):
+    site = get_site('Enphase', system_id)
+    if site is None:
+        return error(404, 'Unknown system')
+    return jsonify({'system_id': system_id, 'current_power': 0, 'energy_lifetime': 0,
+                    'energy_today': round(day_energy(site, date.today())), 'size_w': site['peak_w'],
+                    'status': 'normal', 'modules': 1, 'source': 'microinverters',
+                    'last_report_at': int(time.time()), 'summary_date': date.today().strftime('%Y-%m-%d')})
+
+
+@app.route('/enphase/oauth/token', methods=['POST'])
+def enphase_token():
+    token = uuid.uuid4().hex
+    return jsonify({'access_token': f'access-{token}', 'refresh_token': f'refresh-{token}', 'token_type': 'bearer',
+                    'expires_in': 86400})
+
+
+def get_fake_configs(base_url):
+    """{(vendor, config file name): contents} pointing every vendor at the fake served at base_url"""
+    configs = {
+        ('SolarEdge', 'config.json'): {
+            'api_endpoints': {
+                'site_list': f'{base_url}/solaredge/sites/list?',
+                'site_date_range': f'{base_url}/solaredge/sites/{{site}}/dataPeriod?',
+                'site_aggr_data': f'{base_url}/solaredge/site/{{site}}/energy?',
+                'sites_aggr_data': f'{base_url}/solaredge/sites/{{site}}/energy?',
+            },
+            'api_key': 'FAKE_API_KEY',
+        },
+        ('Fronius', 'config.json'): {
+            'api_key': {'AccessKeyId': 'FAKE_ACCESS_KEY_ID', 'AccessKeyValue': 'FAKE_ACCESS_KEY_VALUE'},
+            'api_endpoints': {
+                'site_details': f'{base_url}/fronius/swqapi/pvsystems',
+                'site_devices': f'{base_url}/fronius/swqapi/pvsystems/{{site}}/devices',
+                'aggr_data': f'{base_url}/fronius/swqapi/pvsystems/{{site}}/aggrdata',
+                'hist_data': f'{base_url}/fronius/swqapi/pvsystems/{{site}}/histdata',
+            },
+        },
+    }
+    for params_file in ENPHASE_PARAMS_FILES:
+        configs[('Enphase', params_file)] = {
+            'API_Count': 0,
+            'Operational': True,
+            'Consecutive_Failures': 0,
+            'access_token': 'FAKE_ACCESS_TOKEN',
+            'refresh_token': 'FAKE_REFRESH_TOKEN',
+            'api_key': 'FAKE_API_KEY',
+            'api_endpoint': f'{base_url}/enphase/api/v4/systems',
+            'token_endpoint': f'{base_url}/enphase/oauth/token',
+            'client_id': 'FAKE_CLIENT_ID',
+            'client_secret': 'FAKE_CLIENT_SECRET',
+        }
+    return configs
+
+
+def write_configs(config_dir, base_url):
+    """Writes the fake's configs to config_dir/<vendor>/, leaving the real ones in API/ untouched"""
+    for (vendor, file_name), config in get_fake_configs(base_url).items():
+        os.makedirs(os.path.join(config_dir, vendor), exist_ok=True)
+        with open(os.path.join(config_dir, vendor, file_name), 'w') as config_file:
+            json.dump(config, config_file, indent=4)
+    print(f'Wrote the configs pointing at {base_url} to {config_dir}, run the server with '
+          f'SOLAR_API_CONFIG_DIR={os.path.abspath(config_dir)} to use them')
+
+
+def configure(sites=None, history_days=DEFAULT_HISTORY_DAYS, latency=0.0, error_rate=0.0, throttle_rate=0.0,
+              seed=0):
+    """Generates the fleet and sets the injected latency, server error and 429 rates"""
+    global _fleet
+    _fleet = build_fleet(sites or DEFAULT_SITES, history_days)
+    _options.update({'latency': latency, 'error_rate': error_rate, 'throttle_rate': throttle_rate})
+    _random.seed(seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a generated fleet through fake vendor APIs')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--scale', type=float, default=1, help='multiplies the number of sites of every vendor')
+    for vendor, count in DEFAULT_SITES.items():
+        parser.add_argument(f'--{vendor.lower()}-sites', type=int, help=f'number of {vendor} sites, {count} by default')
+    parser.add_argument('--history-days', type=int, default=DEFAULT_HISTORY_DAYS,
+                        help='days of history of the oldest sites')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with a 500')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='share of requests answered with a 429')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the injected errors and 429s')
+    parser.add_argument('--config-dir', help='directory to write vendor configs pointing at this server to')
+    args = parser.parse_args()
+
+    fleet_sites = {vendor: getattr(args, f'{vendor.lower()}_sites') or round(count * args.scale)
+                   for vendor, count in DEFAULT_SITES.items()}
+    configure(fleet_sites, args.history_days, args.latency, args.error_rate, args.throttle_rate, args.seed)
+    if args.config_dir:
+        write_configs(args.config_dir, f'http://127.0.0.1:{args.port}')
+    print(f'Serving {fleet_sites} on port {args.port}')
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.run(host='127.0.0.1', port=args.port, threaded=True)
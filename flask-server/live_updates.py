@@ -0,0 +1,49 @@
+import queue
+import threading
+
+# In-process publish / subscribe used to push newly stored data to the open Server-Sent Events streams.
+# Every subscriber gets its own bounded queue, a client too slow to drain it misses updates rather than growing it.
+MAX_PENDING = 32
+# Seconds between the comments sent on idle streams to keep proxies from closing them
+KEEPALIVE_SECONDS = 30
+
+_lock = threading.Lock()
+_subscribers = set()
+
+
+def subscribe():
+    subscriber = queue.Queue(maxsize=MAX_PENDING)
+    with _lock:
+        _subscribers.add(subscriber)
+    return subscriber
+
+
+def unsubscribe(subscriber):
+    with _lock:
+        _subscribers.discard(subscriber)
+
+
+def publish(message):
+    with _lock:
+        subscribers = list(_subscribers)
+    for subscriber in subscribers:
+        try:
+            subscriber.put_nowait(message)
+        except queue.Full:
+            print('Live updates: dropping an update for a subscriber that is not keeping up')
+    return len(subscribers)
+
+
+def iter_messages(subscriber):
+    """Yields published messages as they arrive, None after KEEPALIVE_SECONDS without any"""
+    while True:
+        try:
+            yield subscriber.get(timeout=KEEPALIVE_SECONDS)
+        except queue.Empty:
+            yield None
+
+
+def format_sse(data, event=None):
+    lines = [] if event is None else [f'event: {event}']
+    lines.extend(f'data: {line}' for line in data.splitlines())
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,47 @@
+import time
+import traceback
+import concurrent.futures
+
+# Stages of the database jobs run on a thread pool, the vendor stages being mostly waiting on their APIs
+MAX_WORKERS = 6
+
+
+def run_pipeline(name, stages, max_workers=MAX_WORKERS):
+    """Runs stages, {stage name: (function, [names of the stages it runs after])}, each one as soon as the stages
+    it runs after have finished. function is called with {stage name: result} of the stages that succeeded so far.
+    A failing stage is reported and leaves the others running. The stages after it still run without its result,
+    so that the store stages keep the other vendors' data, which is reported too.
+    Returns (results, failures), both keyed by stage name."""
+    results = {}
+    failures = {}
+    pending = dict(stages)
+    running = {}
+    start = time.perf_counter()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for stage_name, (function, after) in list(pending.items()):
+                if all(stage in results or stage in failures for stage in after):
+                    del pending[stage_name]
+                    failed = [stage for stage in after if stage in failures]
+                    if failed:
+                        print(f'{name}: {stage_name} runs without the results of the failed stages: '
+                              f'{", ".join(failed)}')
+                    running[executor.submit(function, dict(results))] = (stage_name, time.perf_counter())
+            if not running:
+                raise ValueError(f'{name}: stages {list(pending)} run after stages that do not exist or each other')
+
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                stage_name, stage_start = running.pop(future)
+                try:
+                    results[stage_name] = future.result()
+                    print(f'{name}: {stage_name} finished in {time.perf_counter() - stage_start:.1f}s')
+                except Exception as error:
+                    failures[stage_name] = error
+                    print(f'{name}: {stage_name} failed after {time.perf_counter() - stage_start:.1f}s')
+                    traceback.print_exception(error)
+
+    print(f'{name}: finished in {time.perf_counter() - start:.1f}s'
+          + (f', failed stages: {", ".join(failures)}' if failures else ''))
+    return results, failures
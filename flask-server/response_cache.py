@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+
+# Payloads are kept per (domain, key) and are only valid for the generation of their domain they were computed in.
+# The scheduled jobs bump the generation of a domain once they commit new data, which invalidates every cached
+# payload of that domain at once.
+MAX_ENTRIES = 128
+# Total length of the cached payloads. Keys hold the filters requested by clients, so the cache is bounded by the
+# size of what it keeps, not only by its number of entries.
+MAX_CACHED_CHARS = 50_000_000
+# Streamed responses longer than this are sent without being cached, which bounds what streaming one keeps in memory
+MAX_STREAMED_CHARS = 2_000_000
+
+_lock = threading.Lock()
+_generations = {}
+_entries = OrderedDict()
+_cached_chars = 0
+
+
+def current_generation(domain):
+    with _lock:
+        return _generations.get(domain, 0)
+
+
+def bump_generation(*domains):
+    with _lock:
+        for domain in domains:
+            _generations[domain] = _generations.get(domain, 0) + 1
+            print(f'Response cache: {domain} data is now at generation {_generations[domain]}')
+
+
+def lookup(domain, key):
+    """Returns (generation, payload), payload being None unless it was cached in the domain's current generation"""
+    cache_key = (domain, key)
+    with _lock:
+        generation = _generations.get(domain, 0)
+        entry = _entries.get(cache_key)
+        if entry is not None and entry[0] == generation:
+            _entries.move_to_end(cache_key)
+            return generation, entry[1]
+    return generation, None
+
+
+def store(domain, key, generation, payload):
+    """Caches a payload computed in the given generation. The least recently used entries are evicted past
+    MAX_ENTRIES or MAX_CACHED_CHARS, payloads longer than MAX_CACHED_CHARS are not cached."""
+    global _cached_chars
+    if len(payload) > MAX_CACHED_CHARS:
+        return
+    cache_key = (domain, key)
+    with _lock:
+        if cache_key in _entries:
+            _cached_chars -= len(_entries[cache_key][1])
+        _entries[cache_key] = (generation, payload)
+        _entries.move_to_end(cache_key)
+        _cached_chars += len(payload)
+        while len(_entries) > MAX_ENTRIES or _cached_chars > MAX_CACHED_CHARS:
+            _cached_chars -= len(_entries.popitem(last=False)[1][1])
+
+
+def get_or_compute(domain, key, compute):
+    """Returns the cached payload for (domain, key) if it was computed in the domain's current generation,
+    otherwise calls compute() and caches its result"""
+    generation, payload = lookup(domain, key)
+    if payload is not None:
+        return payload
+
+    # Computed outside the lock so slow queries do not block other endpoints. The generation read above is stored
+    # with the payload, so a job committing while we compute leaves this entry already stale.
+    payload = compute()
+    store(domain, key, generation, payload)
+    return payload
+
+
+def clear():
+    global _cached_chars
+    with _lock:
+        _entries.clear()
+        _cached_chars = 0
@@ -0,0 +1,71 @@
+import json
+import math
+
+# Rows written per chunk of a streamed response
+CHUNK_ROWS = 5000
+RESPONSE_FORMATS = ('records', 'columnar')
+
+
+def encode_value(value):
+    return repr(value) if math.isfinite(value) else 'null'
+
+
+def iter_array_json(encoded_items):
+    """Yields a JSON array of already encoded items in chunks of CHUNK_ROWS items"""
+    yield '['
+    for chunk_start in range(0, len(encoded_items), CHUNK_ROWS):
+        yield (',' if chunk_start > 0 else '') + ','.join(encoded_items[chunk_start:chunk_start + CHUNK_ROWS])
+    yield ']'
+
+
+def iter_records_json(dates, values, value_key='Production (kWh)', indexes=None):
+    """[{"Date": ..., value_key: ...}, ...] straight from the date strings and values of one site, each record
+    starting with its "index" when indexes are given"""
+    row_start = '{"Date":'
+    row_middle = ',' + json.dumps(value_key) + ':'
+    rows = [row_start + json.dumps(date) + row_middle + encode_value(value) + '}' for date, value in zip(dates, values)]
+    if indexes is not None:
+        rows = ['{"index":' + str(index) + ',' + row[1:] for index, row in zip(indexes, rows)]
+    yield from iter_array_json(rows)
+
+
+def regular_step(site_df):
+    """Seconds between consecutive dates if they are all evenly spaced, otherwise None"""
+    if len(site_df) < 2:
+        return None
+    steps = site_df['Date'].diff().iloc[1:]
+    if (steps == steps.iloc[0]).all() and steps.iloc[0].total_seconds() > 0:
+        return int(steps.iloc[0].total_seconds())
+    return None
+
+
+def iter_columnar_json(site_df, date_format, use_step=False):
+    """{"dates": [...], "values": [...]}, or {"start": ..., "step": seconds, "values": [...]} for evenly spaced
+    series when use_step is set"""
+    values = [encode_value(value) for value in site_df['Production (kWh)'].astype(float).tolist()]
+    step = regular_step(site_df) if use_step else None
+    if step is not None:
+        yield '{"start":' + json.dumps(site_df['Date'].iloc[0].strftime(date_format)) + ',"step":' + str(step) + \
+              ',"values":'
+    else:
+        yield '{"dates":'
+        yield from iter_array_json([json.dumps(date) for date in site_df['Date'].dt.strftime(date_format).tolist()])
+        yield ',"values":'
+    yield from iter_array_json(values)
+    yield '}'
+
+
+def iter_sites_json(site_frames, date_format, response_format='records', use_step=False):
+    """Streams {site: series, ...} from (site, DataFrame[Date, Production (kWh)]) pairs, one site at a time.
+    Each series is a list of records or, with response_format='columnar', parallel date and value arrays. Records of
+    frames holding an 'index' column carry it too."""
+    yield '{'
+    for site_number, (site, site_df) in enumerate(site_frames):
+        yield (',' if site_number > 0 else '') + json.dumps(site) + ':'
+        if response_format == 'columnar':
+            yield from iter_columnar_json(site_df, date_format, use_step)
+        else:
+            yield from iter_records_json(site_df['Date'].dt.strftime(date_format).tolist(),
+                                         site_df['Production (kWh)'].astype(float).tolist(),
+                                         indexes=site_df['index'].tolist() if 'index' in site_df else None)
+    yield '}'
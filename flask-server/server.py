@@ -1,67 +1,148 @@
-import os
-import time
 import calendar
 from datetime import datetime
+import numpy as np
 import pandas as pd
 import sqlalchemy
-from flask import Flask, jsonify, request
-from API.Enphase.solar_data import update_or_initialize_site_db_setup
+from flask import Flask, request
+from API.Enphase.solar_data import SITE_DETAILS_UPDATES
 from API.Enphase.api_setup import reset_api_count
-from Database.Prod_DB.setup_update_read_db import initial_db_setup_daily, update_prod_db, download_DB_data_daily
-from Database.Site_Details_DB.setup_update_read import read_site_db
-from Database.Prod_DB_15_min.setup_update_read import initial_db_setup_15min, download_DB_data_15min, \
-    update_15min_prod_db
+from Database.Prod_DB.setup_update_read_db import fetch_daily_data, store_initial_vendor_data, \
+    finish_initial_daily_setup, store_daily_updates, download_DB_data_daily, iter_DB_data_daily, read_zero_streaks, \
+    rebuild_zero_streaks, VENDORS, SETUP_STEPS as DAILY_SETUP_STEPS, DATE_FORMAT as DAILY_DATE_FORMAT
+from Database.Site_Details_DB.setup_update_read import read_site_db, SITE_DETAILS_TABLES
+from Database.production_store import create_long_format_tables, day_bounds, ensure_unique_keys, pending_setup_steps, \
+    create_setup_progress_table, get_write_lock
+from Database.Prod_DB_15_min.setup_update_read import fetch_15min_data, store_initial_15min_vendor_data, \
+    download_DB_data_15min, update_15min_prod_db, iter_DB_data_15min, VENDORS as FIFTEEN_MIN_VENDORS, \
+    DATE_FORMAT as FIFTEEN_MIN_DATE_FORMAT
 from apscheduler.schedulers.background import BackgroundScheduler
 from flask_cors import CORS
+import response_cache
+import live_updates
+from pipeline import run_pipeline
+from response_stream import iter_sites_json, RESPONSE_FORMATS
 
 app = Flask(__name__)
 CORS(app)
 
+# Build new production databases in the single-table (site_id, timestamp) layout instead of one table per site.
+# Existing databases can be converted with: python -m Database.production_store Prod_DB.db Prod_15min_DB.db
+LONG_FORMAT_DB = False
+
 
 # Scheduling Function
 def update_15min_database():
     print('Updating 15 minute database...')
     prod_15min_engine = sqlalchemy.create_engine('sqlite:///Prod_15min_DB.db')
-    update_15min_prod_db(prod_15min_engine)
-    prod_15min_engine.dispose()
+    appended = {}
+    try:
+        appended = update_15min_prod_db(prod_15min_engine)
+    finally:
+        prod_15min_engine.dispose()
+        response_cache.bump_generation('15min')
+    if appended:
+        # Pushed to the open /api/15min/stream connections only once the rows are committed
+        live_updates.publish(appended)
+
+
+def daily_production_stages(prod_engine, sites_engine):
+    """Pipeline stages writing every vendor's site details and daily production. The vendors run alongside each
+    other, each one's production being fetched once its site details are written, and all of it is stored
+    together by 'store daily production'."""
+    stages = {}
+    for vendor in VENDORS:
+        stages[f'{vendor} site details'] = (
+            lambda results, vendor=vendor: SITE_DETAILS_UPDATES[vendor](sites_engine), [])
+        stages[f'{vendor} daily production'] = (
+            lambda results, vendor=vendor: fetch_daily_data(vendor, sites_engine, prod_engine=prod_engine),
+            [f'{vendor} site details'])
+
+    fetch_stages = [f'{vendor} daily production' for vendor in VENDORS]
+    stages['store daily production'] = (
+        lambda results: store_daily_updates(prod_engine, {site: df for stage in fetch_stages
+                                                          for site, df in results.get(stage, {}).items()}),
+        fetch_stages)
+    return stages
 
 
 def daily_update_database():
     print('Updating daily databases...')
     prod_engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
     sites_engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
-    # setting up site data
-    update_or_initialize_site_db_setup(sites_engine)
-    time.sleep(90)  # Waiting 90s so as not to overload the Enphase API
-    # Setting up daily production data
-    update_prod_db(prod_engine, sites_engine)
+    stages = daily_production_stages(prod_engine, sites_engine)
     # Setting up Metrics tab data / aggregated data
-    put_aggregated_production_on_DB(sites_engine)
+    stages['Metrics'] = (lambda results: put_aggregated_production_on_DB(sites_engine), ['store daily production'])
     # Setting up Alerts tab
-    put_zeroProductionDaily_sites_on_DB(sites_engine)
-    prod_engine.dispose()
-    sites_engine.dispose()
+    stages['Alerts'] = (lambda results: put_zeroProductionDaily_sites_on_DB(sites_engine), ['store daily production'])
+    try:
+        run_pipeline('Daily update', stages)
+    finally:
+        prod_engine.dispose()
+        sites_engine.dispose()
+        response_cache.bump_generation('daily')
 
 
 def initial_database_setup():
-    print('Setting up initial database...')
+    """Sets up whatever each database is missing: the site details tables, every vendor's full daily and 15 minute
+    history and the tables built from them. Every vendor's history is committed with its setup step, so a setup
+    interrupted or failing for a vendor only redoes the vendors missing when run again."""
+    print('Checking the databases...')
     prod_engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
     sites_engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
     prod_15min_engine = sqlalchemy.create_engine('sqlite:///Prod_15min_DB.db')
-    # site detials db
-    update_or_initialize_site_db_setup(sites_engine)
-    # daily production db
-    time.sleep(90)  # Waiting 90s so as not to overload the Enphase API
-    initial_db_setup_daily(prod_engine, sites_engine)
-    # 15 min production db
-    initial_db_setup_15min(prod_15min_engine)
-    # Setting up Metrics tab data / aggregated data
-    put_aggregated_production_on_DB(sites_engine)
-    # Setting up Alerts tab
-    put_zeroProductionDaily_sites_on_DB(sites_engine)
+    daily_steps = pending_setup_steps(prod_engine, DAILY_SETUP_STEPS)
+    fifteen_min_steps = pending_setup_steps(prod_15min_engine, FIFTEEN_MIN_VENDORS)
+    sites_tables = sqlalchemy.inspect(sites_engine).get_table_names()
+    missing_site_details = [vendor for vendor, table_name in SITE_DETAILS_TABLES.items()
+                            if table_name not in sites_tables]
+    missing_tabs = 'Metrics' not in sites_tables or 'Alerts' not in sites_tables
+
+    for engine, steps in ((prod_engine, daily_steps), (prod_15min_engine, fifteen_min_steps)):
+        if steps:
+            if LONG_FORMAT_DB and not sqlalchemy.inspect(engine).get_table_names():
+                create_long_format_tables(engine)
+            create_setup_progress_table(engine)
+
+    stages = {}
+    for vendor in VENDORS:
+        # Each vendor's production is fetched once its site details are written, alongside the other vendors
+        after = []
+        if vendor in missing_site_details:
+            stages[f'{vendor} site details'] = (
+                lambda results, vendor=vendor: SITE_DETAILS_UPDATES[vendor](sites_engine), [])
+            after = [f'{vendor} site details']
+        if vendor in daily_steps:
+            stages[f'{vendor} daily production'] = (
+                lambda results, vendor=vendor: store_initial_vendor_data(prod_engine, vendor,
+                                                                         fetch_daily_data(vendor, sites_engine)),
+                after)
+        # 15 min production db
+        if vendor in fifteen_min_steps:
+            stages[f'{vendor} 15 min production'] = (
+                lambda results, vendor=vendor: store_initial_15min_vendor_data(prod_15min_engine, vendor,
+                                                                               fetch_15min_data(vendor)),
+                after)
+
+    if daily_steps:
+        # Monthly / yearly rollups and zero production streaks
+        stages['daily rollups'] = (lambda results: finish_initial_daily_setup(prod_engine),
+                                   [stage for stage in stages if stage.endswith('daily production')])
+    if daily_steps or missing_site_details or missing_tabs:
+        tabs_after = [stage for stage in stages if not stage.endswith('15 min production')]
+        # Setting up Metrics tab data / aggregated data
+        stages['Metrics'] = (lambda results: put_aggregated_production_on_DB(sites_engine), tabs_after)
+        # Setting up Alerts tab
+        stages['Alerts'] = (lambda results: put_zeroProductionDaily_sites_on_DB(sites_engine), tabs_after)
+
+    if stages:
+        print('Setting up initial database...')
+        run_pipeline('Initial setup', stages)
+    else:
+        print('Databases are set up')
     prod_engine.dispose()
     prod_15min_engine.dispose()
     sites_engine.dispose()
+    response_cache.bump_generation('daily', '15min')
 
 
 def get_site_details_data():
@@ -87,30 +168,104 @@ def inverter_corresponding_sites(Enphase=True):
     return manufactured_site_list
 
 
-def get_prod_data_daily(timeframe='daily'):
+def get_prod_data_daily(timeframe='daily', sites=None, start=None, end=None):
     engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
-    data_df = download_DB_data_daily(engine, interval=timeframe)
+    data_df = download_DB_data_daily(engine, interval=timeframe, sites=sites, start=start, end=end)
     engine.dispose()
     return data_df
 
 
-def get_prod_data_15min(timeframe='15T'):
+def get_prod_frames_daily(timeframe='daily'):
+    """{site: DataFrame[Date, Production (kWh)]} of every site plus 'combined', with Date as datetimes"""
+    engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    site_frames = dict(iter_DB_data_daily(engine, interval=timeframe))
+    engine.dispose()
+    return site_frames
+
+
+def get_prod_data_15min(timeframe='15T', sites=None, start=None, end=None):
     engine = sqlalchemy.create_engine('sqlite:///Prod_15min_DB.db')
-    data_df = download_DB_data_15min(engine, interval=timeframe)
+    data_df = download_DB_data_15min(engine, interval=timeframe, sites=sites, start=start, end=end)
     engine.dispose()
     return data_df
 
 
+def stream_prod_data_daily(timeframe='daily', sites=None, start=None, end=None, response_format='records'):
+    engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    try:
+        site_frames = iter_DB_data_daily(engine, interval=timeframe, sites=sites, start=start, end=end)
+        yield from iter_sites_json(site_frames, DAILY_DATE_FORMAT, response_format)
+    finally:
+        engine.dispose()
+
+
+def stream_prod_data_15min(timeframe='15T', sites=None, start=None, end=None, response_format='records'):
+    engine = sqlalchemy.create_engine('sqlite:///Prod_15min_DB.db')
+    try:
+        site_frames = iter_DB_data_15min(engine, interval=timeframe, sites=sites, start=start, end=end)
+        # Evenly spaced intervals are sent as a start date and step instead of every date
+        yield from iter_sites_json(site_frames, FIFTEEN_MIN_DATE_FORMAT, response_format, use_step=True)
+    finally:
+        engine.dispose()
+
+
+def streamed_json_response(domain, key, chunks):
+    """Sends a large JSON body chunk by chunk as it is generated. Bodies up to response_cache.MAX_STREAMED_CHARS
+    are also kept in the response cache, later requests of the same generation are served from there."""
+    generation, body = response_cache.lookup(domain, key)
+    if body is not None:
+        return app.response_class(body, mimetype='application/json')
+
+    def generate():
+        parts, size = [], 0
+        for chunk in chunks:
+            yield chunk
+            if parts is not None:
+                parts.append(chunk)
+                size += len(chunk)
+                if size > response_cache.MAX_STREAMED_CHARS:
+                    parts = None
+        if parts is not None:
+            response_cache.store(domain, key, generation, ''.join(parts))
+
+    return app.response_class(generate(), mimetype='application/json')
+
+
+def cached_json_response(domain, key, compute):
+    """Serves the JSON body from the response cache, computing and serializing it only once per data update"""
+    body = response_cache.get_or_compute(domain, key, lambda: app.json.dumps(compute()))
+    return app.response_class(body, mimetype='application/json')
+
+
 @app.route("/api/site_filter/daily")
 def get_site_name_all():
-    data = inverter_corresponding_sites(Enphase=True)
-    return jsonify(data)
+    return cached_json_response('daily', 'site_filter/daily', lambda: inverter_corresponding_sites(Enphase=True))
 
 
 @app.route("/api/site_filter/fifteen")
 def get_site_name_fronius_solaredge():
-    data = inverter_corresponding_sites(Enphase=False)
-    return jsonify(data)
+    return cached_json_response('daily', 'site_filter/fifteen', lambda: inverter_corresponding_sites(Enphase=False))
+
+
+def sum_production_per_daterange(site_frames, date_ranges):
+    """Production of every site summed over each inclusive date range, computed in one pass as a
+    (days x sites) matrix times a (days x date ranges) mask"""
+    sites = list(site_frames.keys())
+    if not sites:
+        return pd.DataFrame(columns=['site'] + list(date_ranges.keys()))
+    long_df = pd.concat([df.assign(site=site) for site, df in site_frames.items()], ignore_index=True)
+    matrix = long_df.groupby(['Date', 'site'])['Production (kWh)'].sum().unstack('site')
+    matrix = matrix.reindex(columns=sites).fillna(0)
+
+    dates = matrix.index.values
+    mask = np.column_stack([
+        (dates >= np.datetime64(date_dict['start_date'])) & (dates <= np.datetime64(date_dict['end_date']))
+        for date_dict in date_ranges.values()
+    ])
+    sums = matrix.to_numpy().T @ mask.astype(float)
+
+    aggregated_df = pd.DataFrame(sums, index=pd.Index(sites, name='site'), columns=list(date_ranges.keys()))
+    return aggregated_df.reset_index()
 
 
 def put_aggregated_production_on_DB(sites_engine):
@@ -166,45 +321,8 @@ def put_aggregated_production_on_DB(sites_engine):
         'ytd': ytd
     }
 
-    data_json = get_prod_data_daily()
-    sites_list = list(data_json.keys())
-
-    df_dict_sites = {}
-    for site in sites_list:
-        value = pd.DataFrame.from_records(data_json[site])
-        if 'index' in value.columns:
-            value.drop(columns='index', inplace=True)
-        df_dict_sites[site] = value
-
-    aggregated_data = []
-    for site in sites_list:
-        site_data = {}
-        site_df = df_dict_sites[site]
-        site_daterange_list = []
-        for key, date_dict in date_ranges.items():
-            date_filtered_df = site_df[
-                (site_df['Date'] >= date_dict['start_date']) & (site_df['Date'] <= date_dict['end_date'])]
-            daterange_sum_dict = {key: date_filtered_df['Production (kWh)'].sum()}
-            site_daterange_list.append(daterange_sum_dict)
-        site_data['site'] = site
-        site_data['date_range'] = site_daterange_list
-        aggregated_data.append(site_data)
-
-    aggregated_df = pd.DataFrame(aggregated_data)
-
-    all_rows_df = pd.DataFrame()
-    for index, row in aggregated_df.iterrows():
-        site = row['site']
-        row = row['date_range']
-
-        combined_dict = {}
-        for d in row:
-            combined_dict.update(d)
-
-        row_df = pd.DataFrame(combined_dict, index=[site])
-        all_rows_df = pd.concat([all_rows_df, row_df], axis=0)
-
-    aggregated_df = aggregated_df.drop(columns='date_range').join(all_rows_df, on='site')
+    site_frames = get_prod_frames_daily()
+    aggregated_df = sum_production_per_daterange(site_frames, date_ranges)
 
     site_details_data = get_site_details_data()
     enphase_df = site_details_data['Enphase'].filter(items=['name', 'size_w'], axis=1).rename(columns={'name': 'site'})
@@ -219,24 +337,27 @@ def put_aggregated_production_on_DB(sites_engine):
     aggregated_df = aggregated_df.join(total_size_df.set_index('site'), on='site')
     aggregated_df['Last_Year_Prod_Over_Site_Size_KW'] = aggregated_df['last_year'] / aggregated_df['size_kw']
 
-    numerical_cols = aggregated_df.select_dtypes(include='number')
-    # numerical_cols = [col for col in numerical_cols if col != 'size_kw']
-    for col in numerical_cols:
-        aggregated_df[col] = aggregated_df[col].apply(lambda x: format(round(x, 2), ','))
-
-    aggregated_df.to_sql('Metrics', sites_engine, if_exists='replace')
+    # Stored as plain numbers, the units and thousands separators are only added when serving them
+    metric_cols = aggregated_df.columns.drop('site')
+    aggregated_df[metric_cols] = aggregated_df[metric_cols].astype(float)
+    with get_write_lock(sites_engine):
+        aggregated_df.to_sql('Metrics', sites_engine, if_exists='replace', index=False)
     print('Finished Updating Metrics on DB')
     return
 
 
 @app.route("/api/aggregated-production", methods=['GET'])
 def get_aggregated_production():
+    return cached_json_response('daily', 'aggregated-production', read_aggregated_production)
+
+
+def read_aggregated_production():
     engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
     table_name = 'Metrics'
     query = f"SELECT * FROM '{table_name}'"
     df = pd.read_sql(query, engine)
     engine.dispose()
-    df = df.drop(columns='index')
+    df = df.drop(columns='index', errors='ignore')
     unit_per_daterange = {
         'last_7_days': 'kWh',
         'month_to_date': 'kWh',
@@ -249,48 +370,37 @@ def get_aggregated_production():
         'Last_Year_Prod_Over_Site_Size_KW': 'kWh/kW'
     }
     metric_cols_list = df.columns.drop('site').tolist()
-    aggregated_data = []
-    for idx, row in df.iterrows():
-        site_dict = {'site': row['site'], 'date_range': []}
-        for time_frame in metric_cols_list:
-            site_dict['date_range'].append({time_frame: row[time_frame] + ' ' + unit_per_daterange[time_frame]})
-        aggregated_data.append(site_dict)
+    labelled_cols = []
+    for time_frame in metric_cols_list:
+        values = df[time_frame]
+        if pd.api.types.is_numeric_dtype(values):  # tables written before the Metrics were kept as numbers are text
+            values = values.astype(float).round(2).map('{:,}'.format)
+        labelled_cols.append([{time_frame: label} for label in (values + ' ' + unit_per_daterange[time_frame])])
 
-    return jsonify(aggregated_data)
+    return [{'site': site, 'date_range': list(date_range)} for site, date_range in zip(df['site'], zip(*labelled_cols))]
 
 
 def put_zeroProductionDaily_sites_on_DB(sites_engine):
     print('Updating Alerts data')
-    data_json = get_prod_data_daily()
-    sites_list = list(data_json.keys())
-
-    df_dict_sites = {}
-    for site in sites_list:
-        value = pd.DataFrame.from_records(data_json[site])
-        if 'index' in value.columns:
-            value.drop(columns='index', inplace=True)
-        df_dict_sites[site] = value
-
-    site_zeroDays = {}
-    for site, df in df_dict_sites.items():
-        zero_mask = df['Production (kWh)'] == 0
-        reversed_zero_mask = zero_mask[::-1]
-        consecutive_zeros = 0
-        for value in reversed_zero_mask:
-            if value is True:
-                consecutive_zeros += 1
-            else:
-                break
-        site_zeroDays[site] = consecutive_zeros
+    # The streaks are advanced by update_prod_db, they are only counted from the full history the first time
+    prod_engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    streaks = read_zero_streaks(prod_engine) or rebuild_zero_streaks(prod_engine)
+    prod_engine.dispose()
+    site_zeroDays = {site: count for site, (count, last_date) in streaks.items()}
 
     ZeroDayDf = pd.DataFrame(site_zeroDays, index=['ZeroDayCount'])
-    ZeroDayDf.to_sql('Alerts', sites_engine, if_exists='replace')
+    with get_write_lock(sites_engine):
+        ZeroDayDf.to_sql('Alerts', sites_engine, if_exists='replace')
     print('Finished Updating Alerts on DB')
     return
 
 
 @app.route("/alerts", methods=['GET'])
 def get_zeroProductionDaily_sites():
+    return cached_json_response('daily', 'alerts', read_zeroProductionDaily_sites)
+
+
+def read_zeroProductionDaily_sites():
     engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
     table_name = 'Alerts'
     query = f"SELECT * FROM '{table_name}'"
@@ -300,50 +410,82 @@ def get_zeroProductionDaily_sites():
     for site in [col for col in df.columns if col != 'index']:
         site_zeroDays[site] = df[site].item()
 
-    return jsonify(site_zeroDays)
+    return site_zeroDays
+
+
+def get_request_filters():
+    """Optional 'sites' (list of site names), inclusive 'start' / 'end' dates and response 'format'
+    ('records' by default or 'columnar') of a chart data request"""
+    sites = request.json.get('sites')
+    start = request.json.get('start')
+    end = request.json.get('end')
+    response_format = request.json.get('format', 'records')
+    if sites is not None:
+        if not isinstance(sites, list):
+            raise KeyError('sites has to be a list of site names')
+        sites = tuple(sites)
+    if response_format not in RESPONSE_FORMATS:
+        raise KeyError(f'Only accepted formats are: {", ".join(RESPONSE_FORMATS)}')
+    day_bounds(start, end)  # invalid dates fail here rather than halfway through a streamed response
+    return sites, start, end, response_format
 
 
 @app.route('/api/data', methods=['POST'])
 def handle_daily_data():
     selection = request.json.get('selection')
+    sites, start, end, response_format = get_request_filters()
 
-    if selection == 'daily':
-        data_df = get_prod_data_daily(timeframe='daily')
-    elif selection == 'monthly':
-        data_df = get_prod_data_daily(timeframe='monthly')
-    elif selection == 'yearly':
-        data_df = get_prod_data_daily(timeframe='yearly')
-    else:
+    if selection not in ('daily', 'monthly', 'yearly'):
         raise KeyError('Only accepted values are: daily, monthly, yearly')
-    return jsonify(data_df)
+    return streamed_json_response('daily', ('api/data', selection, sites, start, end, response_format),
+                                  stream_prod_data_daily(selection, sites, start, end, response_format))
+
+
+@app.route('/api/15min/stream')
+def stream_15min_updates():
+    """Server-Sent Events stream with an 'intervals' event for every 15 minute update, holding only the newly
+    appended rows of each site in the records format. Optional 'sites' query arguments limit it to those sites, an
+    empty one ('?sites=') selects none."""
+    sites = [site for site in request.args.getlist('sites') if site] if 'sites' in request.args else None
+    subscriber = live_updates.subscribe()
+
+    def generate():
+        try:
+            yield ': connected\n\n'
+            for appended in live_updates.iter_messages(subscriber):
+                if appended is None:
+                    yield ': keepalive\n\n'
+                    continue
+                site_frames = [(site, df) for site, df in appended.items() if sites is None or site in sites]
+                if site_frames:
+                    data = ''.join(iter_sites_json(site_frames, FIFTEEN_MIN_DATE_FORMAT))
+                    yield live_updates.format_sse(data, event='intervals')
+        finally:
+            live_updates.unsubscribe(subscriber)
+
+    return app.response_class(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
 
 
 @app.route('/api/15min/data', methods=['POST'])
 def handle_15min_data():
     selection = request.json.get('selection')
+    sites, start, end, response_format = get_request_filters()
 
-    if selection == '15T':
-        data_df = get_prod_data_15min(timeframe='15T')
-    elif selection == 'H':
-        data_df = get_prod_data_15min(timeframe='H')
-    elif selection == '12H':
-        data_df = get_prod_data_15min(timeframe='12H')
-    else:
+    if selection not in ('15T', 'H', '12H'):
         raise KeyError('Only accepted values are: 15T, H, 12H')
-    return jsonify(data_df)
+    return streamed_json_response('15min', ('api/15min/data', selection, sites, start, end, response_format),
+                                  stream_prod_data_15min(selection, sites, start, end, response_format))
 
 
 if __name__ == '__main__':
-    if not os.path.exists('Prod_DB.db') or not os.path.exists('Site_Details_DB.db') or not os.path.exists(
-            'Prod_15min_DB.db'):
-        if os.path.exists('Prod_DB.db'):
-            os.remove('Prod_DB.db')
-        if os.path.exists('Site_Details_DB.db'):
-            os.remove('Site_Details_DB.db')
-        if os.path.exists('Prod_15min_DB.db'):
-            os.remove('Prod_15min_DB.db')
-
-        initial_database_setup()
+    # Each database is checked separately, only the pieces missing from it are set up
+    initial_database_setup()
+
+    # Per-site tables written before rows were keyed by Date get their unique index once, keeping the latest rows
+    for database in ('Prod_DB.db', 'Prod_15min_DB.db'):
+        prod_engine = sqlalchemy.create_engine(f'sqlite:///{database}')
+        ensure_unique_keys(prod_engine)
+        prod_engine.dispose()
 
     scheduler = BackgroundScheduler()
     scheduler.add_job(daily_update_database, 'cron', hour='13',
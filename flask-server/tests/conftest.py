@@ -0,0 +1,14 @@
+import os
+import sys
+import pytest
+import sqlalchemy
+
+# The server's modules import each other from flask-server, as when it is run from there
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = sqlalchemy.create_engine(f'sqlite:///{tmp_path / "test.db"}')
+    yield engine
+    engine.dispose()
@@ -0,0 +1,35 @@
+import pytest
+from API import backfill_checkpoint
+from API.backfill_checkpoint import load_checkpoint, record_checkpoint, clear_checkpoint
+
+
+@pytest.fixture(autouse=True)
+def checkpoint_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill_checkpoint, 'get_checkpoint_path',
+                        lambda vendor, name: str(tmp_path / f'{vendor}_backfill_{name}.jsonl'))
+    return tmp_path
+
+
+def test_recorded_pieces_are_loaded_back():
+    assert load_checkpoint('Vendor', 'DAY') == {}
+    record_checkpoint('Vendor', 'DAY', [((1, '2024-01-01', '2024-12-31'), [{'value': 1.0}])])
+    record_checkpoint('Vendor', 'DAY', [((2, '2024-01-01', '2024-12-31'), []), (('site',), {'a': None})])
+    assert load_checkpoint('Vendor', 'DAY') == {(1, '2024-01-01', '2024-12-31'): [{'value': 1.0}],
+                                                (2, '2024-01-01', '2024-12-31'): [],
+                                                ('site',): {'a': None}}
+    # Checkpoints are kept per vendor and name
+    assert load_checkpoint('Vendor', 'QUARTER_OF_AN_HOUR') == {}
+
+
+def test_a_line_cut_short_is_skipped(checkpoint_dir):
+    record_checkpoint('Vendor', 'DAY', [((1,), [1]), ((2,), [2])])
+    checkpoint_path = checkpoint_dir / 'Vendor_backfill_DAY.jsonl'
+    checkpoint_path.write_text(checkpoint_path.read_text()[:-5])
+    assert load_checkpoint('Vendor', 'DAY') == {(1,): [1]}
+
+
+def test_clear_checkpoint():
+    record_checkpoint('Vendor', 'DAY', [((1,), [1])])
+    clear_checkpoint('Vendor', 'DAY')
+    assert load_checkpoint('Vendor', 'DAY') == {}
+    clear_checkpoint('Vendor', 'DAY')
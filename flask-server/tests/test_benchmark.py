@@ -0,0 +1,58 @@
+import os
+import benchmark
+
+
+def test_fleet_sites_add_up():
+    for sites in (1, 8, 50, 501):
+        assert sum(benchmark.fleet_sites(sites).values()) == sites
+
+
+def test_measure():
+    calls = []
+    result = benchmark.measure(lambda: calls.append(1) or {'response_bytes': 3}, repeats=2,
+                               before=lambda: calls.append(0))
+    assert calls == [0, 1, 0, 1, 0, 1]
+    assert result['repeats'] == 2 and result['response_bytes'] == 3
+    assert result['min_s'] <= result['median_s'] <= result['max_s']
+
+    def fail():
+        raise RuntimeError('too many columns\nSELECT ...')
+
+    assert benchmark.measure(fail, repeats=2) == {'error': 'RuntimeError: too many columns'}
+
+
+def scale_report(results):
+    return {'scales': [{'sites': 50, 'years': 1, 'results': results}]}
+
+
+def test_compare_reports():
+    baseline = scale_report({'a': {'median_s': 1.0, 'peak_memory_bytes': 100},
+                             'b': {'median_s': 1.0, 'peak_memory_bytes': 100},
+                             'c': {'median_s': 1.0, 'peak_memory_bytes': 100}})
+    report = scale_report({'a': {'median_s': 1.1, 'peak_memory_bytes': 300},
+                           'b': {'error': 'RuntimeError: failed'},
+                           'c': {'median_s': 1.5, 'peak_memory_bytes': 100},
+                           'new': {'median_s': 9.0, 'peak_memory_bytes': 900}})
+    assert benchmark.compare_reports(baseline, report) == [
+        '50 sites, 1 years, a: peak_memory_bytes 100 -> 300 (3.00x)',
+        '50 sites, 1 years, b: RuntimeError: failed',
+        '50 sites, 1 years, c: median_s 1 -> 1.5 (1.50x)',
+    ]
+    assert benchmark.compare_reports(baseline, report, threshold=4) == ['50 sites, 1 years, b: RuntimeError: failed']
+
+
+def test_every_benchmark_runs_on_a_small_fleet(tmp_path, monkeypatch):
+    working_dir = os.getcwd()
+    report = benchmark.run_benchmarks([8], [1], directory=str(tmp_path), repeats=1, fifteen_min_days=2)
+    assert os.getcwd() == working_dir
+    [scale] = report['scales']
+    assert {name: result.get('error') for name, result in scale['results'].items() if 'error' in result} == {}
+    assert scale['results']['POST /api/data[daily]']['response_bytes'] > 0
+    assert benchmark.compare_reports(report, report) == []
+
+    # Fleets too large for the Alerts table skip its benchmarks, the built databases being reused
+    monkeypatch.setattr(benchmark, 'MAX_ALERTS_SITES', 4)
+    [scale] = benchmark.run_benchmarks([8], [1], directory=str(tmp_path), repeats=1, fifteen_min_days=2)['scales']
+    skipped = {name for name, result in scale['results'].items() if 'skipped' in result}
+    assert skipped == set(benchmark.ALERTS_BENCHMARKS)
+    assert all('median_s' in result for name, result in scale['results'].items() if 'skipped' not in result)
@@ -0,0 +1,127 @@
+import json
+import pytest
+from API.Enphase import api_setup
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = json.dumps(self.body)
+        self.headers = headers or {}
+
+    def json(self):
+        return self.body
+
+
+@pytest.fixture
+def params_path(tmp_path, monkeypatch):
+    params = {'client_id': 'id', 'client_secret': 'secret', 'refresh_token': 'refresh 1', 'access_token': 'access 1',
+              'api_key': 'key', 'api_endpoint': 'http://enphase.test', 'API_Count': 5, 'Operational': True,
+              'Consecutive_Failures': 0}
+    for api in api_setup.APIS:
+        (tmp_path / f'run_params_{api}.json').write_text(json.dumps(params))
+    monkeypatch.setattr(api_setup, 'get_params_path', lambda api: tmp_path / f'run_params_{api}.json')
+    return tmp_path / 'run_params_1.json'
+
+
+def test_token_refresh_does_not_hold_the_scheduler_lock(params_path, monkeypatch):
+    def post(url, data, headers):
+        assert not api_setup._lock.locked()
+        # Another thread makes a call with the same credential set during the refresh
+        api, credentials = api_setup.acquire_credentials()
+        assert api == 1 and credentials['API_Count'] == 6
+        return FakeResponse(200, {'access_token': 'access 2', 'refresh_token': f'{data["refresh_token"]} rotated'})
+
+    monkeypatch.setattr(api_setup.requests, 'post', post)
+    api_setup.Generate_New_Access_Token_From_Refresh_Token(api=1)
+
+    params = json.loads(params_path.read_text())
+    assert params['access_token'] == 'access 2'
+    assert params['refresh_token'] == 'refresh 1 rotated'
+    assert params['API_Count'] == 7
+
+
+def test_refreshes_of_a_set_use_the_latest_refresh_token(params_path, monkeypatch):
+    used_tokens = []
+
+    def post(url, data, headers):
+        used_tokens.append(data['refresh_token'])
+        return FakeResponse(200, {'access_token': 'access', 'refresh_token': f'refresh {len(used_tokens) + 1}'})
+
+    monkeypatch.setattr(api_setup.requests, 'post', post)
+    api_setup.Generate_New_Access_Token_From_Refresh_Token(api=1)
+    api_setup.Generate_New_Access_Token_From_Refresh_Token(api=1)
+    assert used_tokens == ['refresh 1', 'refresh 2']
+
+
+def test_failed_refresh_marks_the_set_not_operational(params_path, monkeypatch):
+    monkeypatch.setattr(api_setup.requests, 'post', lambda url, data, headers: FakeResponse(400))
+    api_setup.Generate_New_Access_Token_From_Refresh_Token(api=1)
+    assert json.loads(params_path.read_text())['Operational'] is False
+
+
+@pytest.fixture(autouse=True)
+def scheduler_state(monkeypatch):
+    monkeypatch.setattr(api_setup, '_tokens', {})
+    monkeypatch.setattr(api_setup, '_refill_times', {})
+    monkeypatch.setattr(api_setup, '_backoff', {})
+
+
+def set_params(params_path, api, **values):
+    json_path = params_path.with_name(f'run_params_{api}.json')
+    params = json.loads(json_path.read_text())
+    params.update(values)
+    json_path.write_text(json.dumps(params))
+
+
+def test_calls_go_to_the_set_with_the_most_quota_left(params_path):
+    set_params(params_path, 1, API_Count=50)
+    set_params(params_path, 2, API_Count=10)
+    set_params(params_path, 3, API_Count=1, Operational=False)
+    set_params(params_path, 4, API_Count=api_setup.REQUESTS_PER_MONTH + 1)
+    assert [api_setup.acquire_credentials()[0] for _ in range(3)] == [2, 2, 2]
+    assert json.loads(params_path.with_name('run_params_2.json').read_text())['API_Count'] == 13
+
+
+def test_no_usable_set_left(params_path):
+    for api in api_setup.APIS:
+        set_params(params_path, api, Consecutive_Failures=api_setup.MAX_CONSECUTIVE_FAILURES + 1)
+    with pytest.raises(RuntimeError):
+        api_setup.acquire_credentials()
+
+
+def test_per_minute_quota_refills_over_time():
+    for _ in range(api_setup.REQUESTS_PER_MINUTE):
+        assert api_setup.seconds_until_available(1, now=0) == 0
+        api_setup._tokens[1] -= 1
+    assert api_setup.seconds_until_available(1, now=0) == 60 / api_setup.REQUESTS_PER_MINUTE
+    assert api_setup.seconds_until_available(1, now=60 / api_setup.REQUESTS_PER_MINUTE) == 0
+
+
+def test_rate_limited_set_is_backed_off_alone(params_path, monkeypatch):
+    responses = [FakeResponse(429), FakeResponse(200, {'systems': []})]
+    calls = []
+
+    def get(vendor, url, headers, params):
+        calls.append(headers['Authorization'])
+        return responses.pop(0)
+
+    set_params(params_path, 1, access_token='access set 1')
+    set_params(params_path, 2, access_token='access set 2', API_Count=6)
+    for api in (3, 4):
+        set_params(params_path, api, API_Count=7)
+    monkeypatch.setattr(api_setup.http_client, 'get', get)
+    assert api_setup.enphase_get().status_code == 200
+    assert calls == ['Bearer access set 1', 'Bearer access set 2']
+    assert api_setup._backoff[1][1] == api_setup.BACKOFF_SECONDS
+    assert json.loads(params_path.read_text())['Operational'] is True
+
+
+def test_retry_after_sets_the_backoff(params_path):
+    api_setup.record_response(1, FakeResponse(429, headers={'Retry-After': '120'}))
+    assert api_setup._backoff[1][1] == 120
+    api_setup.record_response(1, FakeResponse(429))
+    assert api_setup._backoff[1][1] == 240
+    api_setup.record_response(1, FakeResponse(200))
+    assert 1 not in api_setup._backoff
@@ -0,0 +1,93 @@
+import json
+from types import SimpleNamespace
+import pytest
+import pandas as pd
+from API import response_archive, backfill_checkpoint
+from API.Enphase import solar_data
+from Database.production_store import write_sites_data
+
+SYSTEMS = pd.DataFrame({'system_id': [1, 2, 3], 'name': ['Stored site', 'New site', 'Up to date site']})
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body or {}
+        self.text = json.dumps(self.body)
+
+    def json(self):
+        return self.body
+
+
+def daily_frame(start, values):
+    return pd.DataFrame({'Production (kWh)': values}, index=pd.date_range(start, periods=len(values), name='Date'))
+
+
+def test_only_the_days_after_the_stored_ones_are_requested(engine, monkeypatch):
+    yesterday = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    write_sites_data(engine, {'Stored site': daily_frame('2024-01-09', [1.0, 2.0]),
+                              'Up to date site': daily_frame(yesterday, [3.0])})
+    requests = []
+
+    def enphase_get(path='', params=None):
+        requests.append((path, params))
+        start_date = (params or {}).get('start_date', '2020-01-01')
+        return FakeResponse(200, {'start_date': start_date, 'production': [1000, 2000]})
+
+    monkeypatch.setattr(solar_data, 'enphase_get', enphase_get)
+    monkeypatch.setattr(solar_data, 'read_db', lambda engine, table_name: SYSTEMS)
+    monkeypatch.setattr(response_archive, 'archive_response', lambda *args, **kwargs: None)
+    system_prod_data = solar_data.production_for_site(engine='Site_Details_DB', prod_engine=engine)
+
+    assert requests == [('/1/energy_lifetime', {'start_date': '2024-01-11'}), ('/2/energy_lifetime', None)]
+    assert list(system_prod_data) == ['Stored site', 'New site', 'Up to date site']
+    stored_df = system_prod_data['Stored site']
+    assert stored_df.index.tolist() == [pd.Timestamp('2024-01-11'), pd.Timestamp('2024-01-12')]
+    assert stored_df['Production (kWh)'].tolist() == [1.0, 2.0]
+    assert len(system_prod_data['Up to date site']) == 0
+
+
+def test_fetch_start_dates(engine):
+    write_sites_data(engine, {'Stored site': daily_frame('2024-01-09', [1.0, 2.0])})
+    assert solar_data.get_fetch_start_dates(SYSTEMS, engine) == {1: '2024-01-11'}
+
+
+def test_full_history_resumes_with_the_systems_not_fetched_yet(tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill_checkpoint, 'get_checkpoint_path',
+                        lambda vendor, name: str(tmp_path / f'backfill_{name}.jsonl'))
+    requests = []
+    status_codes = {1: 200, 2: 500, 3: 200}
+
+    def enphase_get(path='', params=None):
+        system_id = int(path.split('/')[1])
+        requests.append(system_id)
+        return FakeResponse(status_codes[system_id], {'start_date': '2024-01-01', 'production': [system_id * 1000]})
+
+    monkeypatch.setattr(solar_data, 'enphase_get', enphase_get)
+    monkeypatch.setattr(solar_data, 'read_db', lambda engine, table_name: SYSTEMS)
+    monkeypatch.setattr(response_archive, 'archive_response', lambda *args, **kwargs: None)
+    assert solar_data.production_for_site(engine='Site_Details_DB') is None
+
+    status_codes[2] = 200
+    system_prod_data = solar_data.production_for_site(engine='Site_Details_DB')
+    assert requests == [1, 2, 3, 2]
+    assert {name: df['Production (kWh)'].tolist() for name, df in system_prod_data.items()} == \
+        {'Stored site': [1.0], 'New site': [2.0], 'Up to date site': [3.0]}
+    assert not (tmp_path / 'backfill_daily.jsonl').exists()
+
+
+def test_failed_calls_are_retried_with_new_tokens_a_bounded_number_of_times(monkeypatch):
+    regenerated = []
+    sleeps = []
+    results = [None, None, 'systems']
+    monkeypatch.setattr(solar_data, 'Generate_New_Access_Token_From_Refresh_Token', lambda: regenerated.append(1))
+    monkeypatch.setattr(solar_data, 'time', SimpleNamespace(sleep=sleeps.append))
+    monkeypatch.setattr(solar_data, 'list_all_sites', lambda: results.pop(0))
+    assert solar_data.recursive_list_all_sites() == 'systems'
+    assert len(regenerated) == 2
+    assert sleeps == [2, 4]
+
+    monkeypatch.setattr(solar_data, 'list_all_sites', lambda: None)
+    with pytest.raises(RuntimeError):
+        solar_data.recursive_list_all_sites()
+    assert len(regenerated) == 2 + solar_data.MAX_ATTEMPTS - 1
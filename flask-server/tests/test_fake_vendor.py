@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+import pytest
+import fake_vendor
+from API import config_paths
+from API.Enphase import api_setup
+from API.Fronius import solar_data as fronius_solar_data
+from API.SolarEdge import solar_data as solaredge_solar_data
+from API.SolarEdge.solar_data import energy_values
+
+
+@pytest.fixture
+def client():
+    fake_vendor.configure({'Enphase': 2, 'SolarEdge': 3, 'Fronius': 2}, history_days=30)
+    return fake_vendor.app.test_client()
+
+
+def site_ids(vendor):
+    return list(fake_vendor._fleet[vendor])
+
+
+def test_quarter_hours_add_up_to_the_day(client):
+    day = (date.today() - timedelta(days=2)).strftime('%Y-%m-%d')
+    site_id = site_ids('SolarEdge')[0]
+    arguments = {'startDate': day, 'endDate': day}
+    daily = client.get(f'/solaredge/site/{site_id}/energy', query_string={**arguments, 'timeUnit': 'DAY'}).json
+    quarters = client.get(f'/solaredge/site/{site_id}/energy',
+                          query_string={**arguments, 'timeUnit': 'QUARTER_OF_AN_HOUR'}).json
+    assert len(quarters['energy']['values']) == 96
+    assert sum(value['value'] for value in quarters['energy']['values']) == \
+        pytest.approx(daily['energy']['values'][0]['value'], abs=96 * 0.05)
+
+
+def test_solaredge_limits(client):
+    ids = ','.join(str(site_id) for site_id in site_ids('SolarEdge'))
+    response = client.get(f'/solaredge/sites/{ids}/energy',
+                          query_string={'startDate': '2024-01-01', 'endDate': '2024-01-02', 'timeUnit': 'DAY'})
+    assert [site for site, values in energy_values(response.json, [])] == site_ids('SolarEdge')
+
+    response = client.get(f'/solaredge/sites/{ids}/energy', query_string={
+        'startDate': '2024-01-01', 'endDate': '2024-03-01', 'timeUnit': 'QUARTER_OF_AN_HOUR'})
+    assert response.status_code == 403
+    assert client.get('/solaredge/sites/1,2/dataPeriod').status_code == 403
+
+
+def test_fronius_history_is_paged_with_next_links(client):
+    site_id = site_ids('Fronius')[0]
+    day = date.today() - timedelta(days=2)
+    url = f'/fronius/swqapi/pvsystems/{site_id}/histdata'
+    arguments = {'from': f'{day}T00:00:00', 'to': f'{day}T23:59:59', 'limit': 100}
+    entries = []
+    page = client.get(url, query_string=arguments).json
+    while True:
+        entries.extend(page['data'])
+        if page['links']['next'] is None:
+            break
+        page = client.get(page['links']['next']).json
+    assert len(entries) == page['links']['totalItemsCount'] == 287
+    assert len({entry['logDateTime'] for entry in entries}) == len(entries)
+
+    aggr = client.get(f'/fronius/swqapi/pvsystems/{site_id}/aggrdata',
+                      query_string={'from': str(day), 'to': str(day)}).json
+    assert sum(entry['channels'][0]['value'] for entry in entries) == \
+        pytest.approx(aggr['data'][0]['channels'][0]['value'], abs=288 * 0.05)
+
+
+def test_injected_errors_and_throttles(client):
+    fake_vendor.configure({'Enphase': 1, 'SolarEdge': 0, 'Fronius': 0}, history_days=30, error_rate=1.0)
+    assert client.get('/enphase/api/v4/systems').status_code == 500
+    fake_vendor.configure({'Enphase': 1, 'SolarEdge': 0, 'Fronius': 0}, history_days=30, throttle_rate=1.0)
+    response = client.get('/enphase/api/v4/systems')
+    assert response.status_code == 429 and response.headers['Retry-After'] == '1'
+    assert client.get('/_stats').json['injected_throttles'] >= 1
+
+
+def test_clients_read_the_fake_configs_from_the_config_dir(tmp_path, monkeypatch):
+    real_config_path = config_paths.get_config_path('SolarEdge', 'config.json')
+    fake_vendor.write_configs(str(tmp_path), 'http://127.0.0.1:1')
+    monkeypatch.setenv(config_paths.CONFIG_DIR_VARIABLE, str(tmp_path))
+
+    api_endpoints, api_key = solaredge_solar_data.import_config_json()
+    assert api_key == 'FAKE_API_KEY' and api_endpoints['site_list'].startswith('http://127.0.0.1:1/')
+    assert fronius_solar_data.import_config_json()[0]['site_details'].startswith('http://127.0.0.1:1/')
+    params, params_path = api_setup.load_params(1)
+    assert params['api_endpoint'].startswith('http://127.0.0.1:1/')
+    assert params_path == tmp_path / 'Enphase' / 'run_params_1.json'
+    # The real configs are left where they are
+    assert config_paths.get_config_path('SolarEdge', 'config.json') == str(tmp_path / 'SolarEdge' / 'config.json')
+    monkeypatch.delenv(config_paths.CONFIG_DIR_VARIABLE)
+    assert config_paths.get_config_path('SolarEdge', 'config.json') == real_config_path
@@ -0,0 +1,152 @@
+from datetime import datetime, timedelta
+import pandas as pd
+import requests
+from API.Fronius import solar_data
+from Database.production_store import create_long_format_tables
+from Database.Prod_DB_15_min.setup_update_read import storage_frame
+
+
+def entry(log_time, value):
+    return {'logDateTime': log_time, 'channels': [{'value': value}]}
+
+
+def test_days_without_entries_inside_a_window_are_zero():
+    entries = {'2024-01-01T10:03:00+01:00': 5.0, '2024-01-01T10:08:00+01:00': 7.0, '2024-01-03T12:00:00+01:00': 2.0}
+    production = solar_data.bin_hist_entries(entries, [(datetime(2024, 1, 1), datetime(2024, 1, 3, 18))])
+
+    assert production[pd.Timestamp('2024-01-01 10:15')] == 12.0
+    assert production[pd.Timestamp('2024-01-03 12:00')] == 2.0
+    # Days with entries only hold the quarter hours that were logged
+    assert len(production[production.index.normalize() == pd.Timestamp('2024-01-01')]) == 1
+    empty_day = production[production.index.normalize() == pd.Timestamp('2024-01-02')]
+    assert len(empty_day) == 96 and (empty_day == 0).all()
+
+
+def test_windows_without_entries_are_zero():
+    production = solar_data.bin_hist_entries({}, [(datetime(2024, 1, 1), datetime(2024, 1, 1, 1))])
+    assert production.index.tolist() == list(pd.date_range('2024-01-01', '2024-01-01 01:00', freq='15min'))
+    assert (production == 0).all()
+
+
+def test_fetched_history_matches_the_archive_rebuild(monkeypatch):
+    logged_days = {'2024-01-01', '2024-01-04'}
+    pages = []
+
+    def fetch_hist_window(site, api_key, api_endpoint, window_start, window_end):
+        log_times = pd.date_range(window_start, window_end, freq='5min', inclusive='left')
+        window_entries = [entry(f'{log_time:%Y-%m-%dT%H:%M:%S}+01:00', 1.0) for log_time in log_times
+                          if f'{log_time:%Y-%m-%d}' in logged_days]
+        pages.append({'kind': 'hist_data', 'body': {'data': window_entries},
+                      'context': {'site': site, 'first_page': True, 'from': f'{window_start:%Y-%m-%dT%H:%M:%S}',
+                                  'to': f'{window_end:%Y-%m-%dT%H:%M:%S}'}})
+        return window_entries, len(window_entries)
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return datetime(2024, 1, 5, 12)
+
+    monkeypatch.setattr(solar_data, 'fetch_hist_window', fetch_hist_window)
+    monkeypatch.setattr(solar_data, 'datetime', FixedDatetime)
+    site, production, failed_windows = solar_data.fetch_hist_data('site', None, None, '2024-01-01')
+    assert failed_windows == []
+
+    days = production.groupby(production.index.normalize()).agg(['count', 'sum'])
+    assert days['count'].tolist() == [96, 96, 96, 96, 25]
+    # The last two entries of a day are binned on the next midnight
+    assert days['sum'].tolist() == [286.0, 2.0, 0.0, 286.0, 2.0]
+
+    parsed = [piece for page in pages for table, site, piece in solar_data.parse_archived_record(page)]
+    pd.testing.assert_frame_equal(solar_data.merge_archived_hist(parsed), solar_data.build_hist_frame(production))
+
+
+class FakeResponse:
+    def __init__(self, status_code, body=None):
+        self.status_code = status_code
+        self.body = body
+
+    def json(self):
+        if self.body is None:
+            raise ValueError('not JSON')
+        return self.body
+
+
+def test_requests_are_retried_on_server_errors_only(monkeypatch):
+    monkeypatch.setattr(solar_data.time, 'sleep', lambda seconds: None)
+    responses = [requests.ConnectionError('reset'), FakeResponse(503), FakeResponse(429), FakeResponse(200, {'a': 1})]
+
+    def get(vendor, url, **kwargs):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(solar_data.http_client, 'get', get)
+    assert solar_data.get_with_retry('url') == {'a': 1}
+
+    responses.extend([FakeResponse(404), FakeResponse(200, {'a': 1})])
+    assert solar_data.get_with_retry('url') is None
+    assert len(responses) == 1
+
+    responses[:] = [FakeResponse(500)] * solar_data.MAX_ATTEMPTS + [FakeResponse(200, {'a': 1})]
+    assert solar_data.get_with_retry('url') is None
+    assert len(responses) == 1
+
+
+def test_windows_fill_about_a_page_and_failed_ones_are_skipped(monkeypatch):
+    windows = []
+
+    def fetch_hist_window(site, api_key, api_endpoint, window_start, window_end):
+        windows.append((window_start, window_end))
+        if len(windows) == 2:
+            return None
+        # One entry every minute, five times what a window of the API's resolution expects
+        log_times = pd.date_range(window_start, window_end, freq='1min', inclusive='left')
+        return [entry(f'{log_time:%Y-%m-%dT%H:%M:%S}+01:00', 1.0) for log_time in log_times], len(log_times)
+
+    class FixedDatetime(datetime):
+        @classmethod
+        def utcnow(cls):
+            return datetime(2024, 1, 10, 12)
+
+    monkeypatch.setattr(solar_data, 'fetch_hist_window', fetch_hist_window)
+    monkeypatch.setattr(solar_data, 'datetime', FixedDatetime)
+    site, production, failed_windows = solar_data.fetch_hist_data('site', None, None, '2024-01-01')
+
+    spans = [window_end - window_start for window_start, window_end in windows]
+    first_span = timedelta(minutes=solar_data.HIST_RESOLUTION_MINUTES * solar_data.HIST_PAGE_LIMIT)
+    assert spans[:3] == [first_span, first_span / 5, first_span / 5]
+    assert failed_windows == [windows[1]]
+    assert windows[-1][1] == datetime(2024, 1, 10, 6)
+    assert all(earlier[1] == later[0] for earlier, later in zip(windows, windows[1:]))
+    failed_start, failed_end = windows[1]
+    assert production[failed_start + timedelta(minutes=15):failed_end - timedelta(minutes=15)].empty
+
+
+def round_time(log_time):
+    """Quarter hour an entry is binned on, the minute rounded up, counted one field at a time"""
+    quarter = -(-log_time.minute // 15) * 15
+    return log_time.replace(minute=0, second=0) + timedelta(minutes=quarter)
+
+
+def test_entries_are_binned_on_their_local_quarter_hour():
+    log_times = ['2023-12-31T23:45:00+01:00', '2023-12-31T23:46:59+01:00', '2024-01-31T23:59:30+01:00',
+                 '2024-03-31T02:14:00+02:00', '2024-03-31T02:15:00+01:00', '2024-02-29T12:00:01+01:00']
+    entries = {log_time: float(i + 1) for i, log_time in enumerate(log_times)}
+    production = solar_data.bin_hist_entries(entries, [])
+
+    expected = {}
+    for log_time, value in entries.items():
+        quarter = round_time(datetime.strptime(log_time[:19], '%Y-%m-%dT%H:%M:%S'))
+        expected[pd.Timestamp(quarter)] = expected.get(pd.Timestamp(quarter), 0.0) + value
+    assert production.to_dict() == expected
+    assert production[pd.Timestamp('2024-01-01 00:00')] == 2.0
+    assert production[pd.Timestamp('2024-03-31 02:15')] == 9.0
+
+
+def test_binned_rows_keep_their_dates_in_both_layouts(engine):
+    site_df = solar_data.build_hist_frame(solar_data.bin_hist_entries({'2024-01-01T00:05:00+01:00': 500.0}, []))
+    assert storage_frame(engine, site_df).index.tolist() == ['2024-01-01 00:15:00']
+    create_long_format_tables(engine)
+    assert storage_frame(engine, site_df).index.tolist() == [pd.Timestamp('2024-01-01 00:15')]
+    assert site_df['Production (kWh)'].tolist() == [0.5]
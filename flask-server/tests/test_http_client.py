@@ -0,0 +1,78 @@
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from API import http_client
+
+
+@pytest.fixture(autouse=True)
+def vendor_config(monkeypatch):
+    config = {'Vendor': {'max_concurrency': 3, 'connect_timeout': 1, 'read_timeout': 2, 'min_interval': 0}}
+    monkeypatch.setattr(http_client, '_config', config)
+    monkeypatch.setattr(http_client, '_sessions', {})
+    monkeypatch.setattr(http_client, '_semaphores', {})
+    monkeypatch.setattr(http_client, '_next_call_times', {})
+    return config['Vendor']
+
+
+def test_fetch_all_keeps_the_order_and_the_concurrency_limit():
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+
+    def fetch(item):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return item * 2
+
+    assert http_client.fetch_all('Vendor', fetch, range(10)) == [item * 2 for item in range(10)]
+    assert most_running[0] == 3
+
+
+def test_requests_are_spaced_by_the_minimum_interval(vendor_config, monkeypatch):
+    vendor_config['min_interval'] = 0.05
+    sleeps = []
+    monkeypatch.setattr(http_client, 'time', SimpleNamespace(monotonic=lambda: 100.0, sleep=sleeps.append))
+    for _ in range(4):
+        http_client.wait_turn('Vendor')
+    assert sleeps == pytest.approx([0, 0.05, 0.1, 0.15])
+
+
+def test_get_goes_through_the_pooled_session_with_the_vendor_timeouts(monkeypatch):
+    calls = []
+    session = http_client.get_session('Vendor')
+    monkeypatch.setattr(session, 'get', lambda url, **kwargs: calls.append((url, kwargs)))
+    http_client.get('Vendor', 'https://example.com/a')
+    http_client.get('Vendor', 'https://example.com/b', timeout=5)
+
+    assert http_client.get_session('Vendor') is session
+    assert calls == [('https://example.com/a', {'timeout': (1, 2)}), ('https://example.com/b', {'timeout': 5})]
+
+
+def test_concurrent_fetch_all_share_the_limit_on_requests_in_flight(monkeypatch):
+    lock = threading.Lock()
+    running = [0]
+    most_running = [0]
+
+    def session_get(url, **kwargs):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        time.sleep(0.02)
+        with lock:
+            running[0] -= 1
+        return url
+
+    monkeypatch.setattr(http_client.get_session('Vendor'), 'get', session_get)
+    urls = [f'https://example.com/{item}' for item in range(6)]
+    fetch = lambda url: http_client.get('Vendor', url)
+    callers = [threading.Thread(target=http_client.fetch_all, args=('Vendor', fetch, urls)) for _ in range(3)]
+    for caller in callers:
+        caller.start()
+    for caller in callers:
+        caller.join()
+    assert most_running[0] == 3
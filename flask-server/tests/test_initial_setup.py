@@ -0,0 +1,72 @@
+import pandas as pd
+import pytest
+import sqlalchemy
+import server
+from Database.production_store import list_sites, pending_setup_steps
+from Database.Prod_DB.setup_update_read_db import SETUP_STEPS, read_zero_streaks, FLEET_SITE
+from Database.Site_Details_DB.setup_update_read import SITE_DETAILS_TABLES
+
+
+# (what, vendor) of the fetches made to fail
+failing = set()
+
+
+@pytest.fixture
+def calls(tmp_path, monkeypatch):
+    """Runs the initial setup in tmp_path against vendors answering with a few days of production, recording every
+    fetch and update as (what, vendor)"""
+    monkeypatch.chdir(tmp_path)
+    calls = []
+    failing.clear()
+
+    def production(what, vendor, freq):
+        calls.append((what, vendor))
+        if (what, vendor) in failing:
+            raise ConnectionError(f'{vendor} API down')
+        dates = pd.date_range('2024-01-01', periods=3, freq=freq, name='Date')
+        return {f'{vendor} site': pd.DataFrame({'Production (kWh)': [1.0, 0.0, 0.0]}, index=dates)}
+
+    def site_details_update(vendor):
+        def update(sites_engine):
+            calls.append(('site details', vendor))
+            pd.DataFrame({'name': [f'{vendor} site']}).to_sql(SITE_DETAILS_TABLES[vendor], sites_engine)
+        return update
+
+    def tab_update(table_name):
+        def update(sites_engine):
+            calls.append((table_name, None))
+            pd.DataFrame({'site': []}).to_sql(table_name, sites_engine, if_exists='replace')
+        return update
+
+    monkeypatch.setattr(server, 'fetch_daily_data', lambda vendor, sites_engine: production('daily', vendor, 'D'))
+    monkeypatch.setattr(server, 'fetch_15min_data', lambda vendor: production('15min', vendor, '15min'))
+    monkeypatch.setattr(server, 'SITE_DETAILS_UPDATES', {vendor: site_details_update(vendor)
+                                                         for vendor in SITE_DETAILS_TABLES})
+    monkeypatch.setattr(server, 'put_aggregated_production_on_DB', tab_update('Metrics'))
+    monkeypatch.setattr(server, 'put_zeroProductionDaily_sites_on_DB', tab_update('Alerts'))
+    return calls
+
+
+def test_setup_interrupted_for_a_vendor_only_redoes_that_vendor(calls):
+    failing.add(('daily', 'SolarEdge'))
+    server.initial_database_setup()
+    assert sorted(call for call in calls if call[0] in ('daily', '15min')) == \
+        [('15min', 'Fronius'), ('15min', 'SolarEdge'), ('daily', 'Enphase'), ('daily', 'Fronius'),
+         ('daily', 'SolarEdge')]
+
+    prod_engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    assert pending_setup_steps(prod_engine, SETUP_STEPS) == ['SolarEdge', 'rollups']
+    assert sorted(list_sites(prod_engine)) == ['Enphase site', 'Fronius site']
+
+    failing.clear()
+    calls.clear()
+    server.initial_database_setup()
+    # Every streak is counted again with the SolarEdge history, the tabs are rebuilt from it
+    assert calls == [('daily', 'SolarEdge'), ('Metrics', None), ('Alerts', None)]
+    assert pending_setup_steps(prod_engine, SETUP_STEPS) == []
+    assert read_zero_streaks(prod_engine)[FLEET_SITE][0] == 2
+    prod_engine.dispose()
+
+    calls.clear()
+    server.initial_database_setup()
+    assert calls == []
@@ -0,0 +1,87 @@
+import json
+import pandas as pd
+import live_updates
+import server
+from Database.Prod_DB_15_min import setup_update_read
+
+
+def test_messages_reach_every_subscriber():
+    first, second = live_updates.subscribe(), live_updates.subscribe()
+    try:
+        assert live_updates.publish('update') == 2
+        assert next(live_updates.iter_messages(first)) == next(live_updates.iter_messages(second)) == 'update'
+    finally:
+        live_updates.unsubscribe(first)
+        live_updates.unsubscribe(second)
+    assert live_updates.publish('update') == 0
+
+
+def test_slow_subscribers_miss_updates_rather_than_queueing_them(monkeypatch):
+    monkeypatch.setattr(live_updates, 'MAX_PENDING', 2)
+    monkeypatch.setattr(live_updates, 'KEEPALIVE_SECONDS', 0.01)
+    subscriber = live_updates.subscribe()
+    try:
+        for message in range(3):
+            live_updates.publish(message)
+        messages = live_updates.iter_messages(subscriber)
+        assert [next(messages) for _ in range(3)] == [0, 1, None]
+    finally:
+        live_updates.unsubscribe(subscriber)
+
+
+def test_format_sse():
+    assert live_updates.format_sse('{"a":\n1}', event='intervals') == 'event: intervals\ndata: {"a":\ndata: 1}\n\n'
+    assert live_updates.format_sse('{}') == 'data: {}\n\n'
+
+
+def test_stream_sends_the_appended_intervals_of_the_requested_sites():
+    response = server.app.test_client().get('/api/15min/stream?sites=a')
+    events = response.response
+    try:
+        assert next(events) == b': connected\n\n'
+        appended = {site: pd.DataFrame({'Date': pd.to_datetime(['2024-01-01 00:15']), 'Production (kWh)': [0.5]})
+                    for site in ('a', 'b')}
+        live_updates.publish(appended)
+        event = next(events).decode()
+        assert event.startswith('event: intervals\ndata: ')
+        assert json.loads(event.split('data: ', 1)[1]) == {'a': [{'Date': '2024-01-01 00:15:00',
+                                                                  'Production (kWh)': 0.5}]}
+    finally:
+        response.close()
+    assert live_updates.publish('update') == 0
+
+
+def test_stream_with_an_empty_site_selection_sends_no_intervals():
+    response = server.app.test_client().get('/api/15min/stream?sites=')
+    events = response.response
+    try:
+        assert next(events) == b': connected\n\n'
+        live_updates.publish({'a': pd.DataFrame({'Date': pd.to_datetime(['2024-01-01 00:15']),
+                                                 'Production (kWh)': [0.5]})})
+        live_updates.publish(None)
+        assert next(events) == b': keepalive\n\n'
+    finally:
+        response.close()
+
+
+def test_only_the_newly_stored_intervals_are_published(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    dates = pd.date_range('2024-01-01 00:00', periods=4, freq='15min', name='Date')
+    fetched = {'SolarEdge': {'site': pd.DataFrame({'Production (kWh)': [1.0, 2.0]}, index=dates[:2])}, 'Fronius': {}}
+    monkeypatch.setattr(setup_update_read, 'fetch_15min_data',
+                        lambda vendor, fetch_everything=True: fetched[vendor])
+    server.update_15min_database()
+
+    subscriber = live_updates.subscribe()
+    try:
+        fetched['SolarEdge'] = {'site': pd.DataFrame({'Production (kWh)': [2.0, 3.0, 4.0]}, index=dates[1:])}
+        server.update_15min_database()
+        # Nothing new, nothing published
+        server.update_15min_database()
+        published = next(live_updates.iter_messages(subscriber))
+        assert subscriber.empty()
+    finally:
+        live_updates.unsubscribe(subscriber)
+    assert list(published) == ['site']
+    assert published['site']['Date'].tolist() == dates[2:].tolist()
+    assert published['site']['Production (kWh)'].tolist() == [3.0, 4.0]
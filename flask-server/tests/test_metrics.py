@@ -0,0 +1,65 @@
+import pandas as pd
+import sqlalchemy
+from server import sum_production_per_daterange, read_aggregated_production
+
+DATE_RANGES = {
+    'first_week': {'start_date': '2024-01-01', 'end_date': '2024-01-07'},
+    'january': {'start_date': '2024-01-01', 'end_date': '2024-01-31'},
+}
+
+
+def site_frame(dates, values):
+    return pd.DataFrame({'Date': pd.to_datetime(dates), 'Production (kWh)': values})
+
+
+def test_sums_per_date_range():
+    site_frames = {
+        'a': site_frame(['2024-01-01', '2024-01-07', '2024-01-08'], [1.0, 2.0, 4.0]),
+        'b': site_frame(['2024-02-01'], [8.0]),
+    }
+    aggregated_df = sum_production_per_daterange(site_frames, DATE_RANGES)
+    assert aggregated_df.to_dict(orient='records') == [
+        {'site': 'a', 'first_week': 3.0, 'january': 7.0},
+        {'site': 'b', 'first_week': 0.0, 'january': 0.0},
+    ]
+
+
+def test_no_sites():
+    aggregated_df = sum_production_per_daterange({}, DATE_RANGES)
+    assert aggregated_df.empty
+    assert list(aggregated_df.columns) == ['site', 'first_week', 'january']
+
+
+def test_sites_without_rows():
+    aggregated_df = sum_production_per_daterange({'a': site_frame([], [])}, DATE_RANGES)
+    assert aggregated_df.to_dict(orient='records') == [{'site': 'a', 'first_week': 0.0, 'january': 0.0}]
+
+
+def test_matches_summing_each_site_and_range_separately():
+    dates = pd.date_range('2023-12-20', '2024-02-10', freq='D')
+    site_frames = {site: site_frame(dates[offset::3], [float(i % 7) for i in range(len(dates[offset::3]))])
+                   for offset, site in enumerate(['a', 'b', 'c'])}
+    aggregated_df = sum_production_per_daterange(site_frames, DATE_RANGES).set_index('site')
+    for site, df in site_frames.items():
+        for name, date_dict in DATE_RANGES.items():
+            in_range = (df['Date'] >= date_dict['start_date']) & (df['Date'] <= date_dict['end_date'])
+            assert aggregated_df.loc[site, name] == df.loc[in_range, 'Production (kWh)'].sum()
+
+
+def test_metrics_are_labelled_with_their_units_when_served(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
+    pd.DataFrame({'site': ['a'], 'last_7_days': [1234.567], 'size_kw': [5.0],
+                  'Last_Year_Prod_Over_Site_Size_KW': [0.5]}).to_sql('Metrics', engine, index=False)
+    engine.dispose()
+    assert read_aggregated_production() == [{'site': 'a', 'date_range': [
+        {'last_7_days': '1,234.57 kWh'}, {'size_kw': '5.0 kW'}, {'Last_Year_Prod_Over_Site_Size_KW': '0.5 kWh/kW'}]}]
+
+
+def test_metrics_stored_as_text_are_still_served(tmp_path, monkeypatch):
+    # Tables written before the Metrics were kept as numbers hold the formatted values, with the pandas index
+    monkeypatch.chdir(tmp_path)
+    engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
+    pd.DataFrame({'site': ['a'], 'last_7_days': ['1,234.57']}).to_sql('Metrics', engine)
+    engine.dispose()
+    assert read_aggregated_production() == [{'site': 'a', 'date_range': [{'last_7_days': '1,234.57 kWh'}]}]
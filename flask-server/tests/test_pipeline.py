@@ -0,0 +1,36 @@
+import pytest
+from pipeline import run_pipeline
+
+
+def fail(results):
+    raise RuntimeError('vendor API down')
+
+
+def test_stages_run_after_the_stages_they_depend_on():
+    stages = {
+        'fetch a': (lambda results: 1, []),
+        'fetch b': (lambda results: 2, []),
+        'store': (lambda results: results['fetch a'] + results['fetch b'], ['fetch a', 'fetch b']),
+    }
+    results, failures = run_pipeline('Test', stages)
+    assert results == {'fetch a': 1, 'fetch b': 2, 'store': 3}
+    assert failures == {}
+
+
+def test_stages_after_a_failed_one_run_on_the_remaining_results_and_say_so(capsys):
+    stages = {
+        'fetch a': (lambda results: 1, []),
+        'fetch b': (fail, []),
+        'store': (lambda results: sorted(results), ['fetch a', 'fetch b']),
+    }
+    results, failures = run_pipeline('Test', stages)
+    assert results['store'] == ['fetch a']
+    assert list(failures) == ['fetch b']
+    output = capsys.readouterr().out
+    assert 'Test: store runs without the results of the failed stages: fetch b' in output
+    assert 'failed stages: fetch b' in output
+
+
+def test_unknown_dependencies_are_rejected():
+    with pytest.raises(ValueError):
+        run_pipeline('Test', {'store': (lambda results: None, ['missing'])})
@@ -0,0 +1,121 @@
+import pandas as pd
+import pytest
+from sqlalchemy import text
+from Database.production_store import read_production, iter_production, read_site_production, day_bounds, \
+    to_bound, create_long_format_tables, write_sites_data, migrate_to_long_format, is_long_format, list_sites, \
+    list_site_tables, get_max_dates, get_date_ranges, ensure_unique_keys
+
+# Dates as each vendor's daily rows and the 15 minute rows are stored in the one table per site layout
+FRONIUS_DAILY_DATES = ['2024-01-01', '2024-01-02', '2024-01-03', '2024-01-04']
+DATETIME_DAILY_DATES = [f'{day} 00:00:00.000000' for day in FRONIUS_DAILY_DATES]
+FIFTEEN_MIN_DATES = ['2024-01-01 23:45:00', '2024-01-02 00:00:00', '2024-01-02 00:15:00', '2024-01-03 00:00:00']
+
+
+def create_site_table(engine, site, dates):
+    with engine.begin() as conn:
+        conn.execute(text(f'CREATE TABLE "{site}" (Date TEXT, "Production (kWh)" FLOAT)'))
+        conn.execute(text(f'INSERT INTO "{site}" VALUES (:date, :prod)'),
+                     [{'date': date, 'prod': float(i + 1)} for i, date in enumerate(dates)])
+
+
+@pytest.mark.parametrize('dates', [FRONIUS_DAILY_DATES, DATETIME_DAILY_DATES])
+def test_day_bounds_include_both_end_days_whatever_the_stored_format(engine, dates):
+    create_site_table(engine, 'site', dates)
+    start, end = day_bounds('2024-01-02', '2024-01-03')
+    for site_df in (read_production(engine, start=start, end=end)['site'],
+                    dict(iter_production(engine, start=start, end=end))['site'],
+                    read_site_production(engine, 'site', start=start, end=end)):
+        assert site_df['Production (kWh)'].tolist() == [2.0, 3.0]
+
+
+def test_fronius_daily_rows_are_read_from_the_start_day(engine):
+    create_site_table(engine, 'Fronius site', FRONIUS_DAILY_DATES)
+    create_site_table(engine, 'SolarEdge site', DATETIME_DAILY_DATES)
+    start, end = day_bounds('2024-01-02')
+    site_frames = read_production(engine, start=start, end=end)
+    assert len(site_frames['Fronius site']) == len(site_frames['SolarEdge site']) == 3
+
+
+def test_fifteen_minute_bounds(engine):
+    create_site_table(engine, 'site', FIFTEEN_MIN_DATES)
+    start, end = day_bounds('2024-01-02', '2024-01-02')
+    site_df = read_production(engine, start=start, end=end)['site']
+    assert site_df['Date'].tolist() == ['2024-01-02 00:00:00', '2024-01-02 00:15:00']
+
+    site_df = read_production(engine, start=pd.Timestamp('2024-01-02 00:15'))['site']
+    assert site_df['Date'].tolist() == ['2024-01-02 00:15:00', '2024-01-03 00:00:00']
+
+
+def test_string_bounds_are_passed_through():
+    assert to_bound('2024-01-02', False) == '2024-01-02'
+    assert to_bound(None, False) is None
+
+
+def test_long_format_bounds(engine):
+    create_long_format_tables(engine)
+    write_sites_data(engine, {'site': pd.DataFrame({'Production (kWh)': [1.0, 2.0, 3.0, 4.0]},
+                                                   index=pd.DatetimeIndex(FRONIUS_DAILY_DATES, name='Date'))})
+    start, end = day_bounds('2024-01-02', '2024-01-03')
+    site_df = read_production(engine, start=start, end=end)['site']
+    assert site_df['Production (kWh)'].tolist() == [2.0, 3.0]
+    assert site_df['Date'].tolist() == [pd.Timestamp('2024-01-02'), pd.Timestamp('2024-01-03')]
+
+
+def test_migration_keeps_every_site_and_row(engine):
+    create_site_table(engine, 'Fronius site', FRONIUS_DAILY_DATES)
+    create_site_table(engine, 'SolarEdge site', DATETIME_DAILY_DATES)
+    before = read_production(engine)
+    max_dates = get_max_dates(engine, list_sites(engine))
+    date_ranges = get_date_ranges(engine)
+    assert date_ranges['Fronius site'] == (pd.Timestamp('2024-01-01'), pd.Timestamp('2024-01-04'))
+
+    migrate_to_long_format(engine)
+
+    assert is_long_format(engine)
+    assert list_site_tables(engine) == []
+    assert list_sites(engine) == list(before)
+    assert get_max_dates(engine, list_sites(engine)) == max_dates
+    assert get_date_ranges(engine) == date_ranges
+    after = read_production(engine)
+    for site, site_df in before.items():
+        assert pd.to_datetime(after[site]['Date']).tolist() == pd.to_datetime(site_df['Date']).tolist()
+        assert after[site]['Production (kWh)'].tolist() == site_df['Production (kWh)'].tolist()
+
+
+def test_interrupted_migration_can_be_run_again(engine):
+    create_site_table(engine, 'first', FRONIUS_DAILY_DATES)
+    migrate_to_long_format(engine)
+    # A site table left behind by an interrupted run, whose rows are partly migrated already
+    create_site_table(engine, 'second', DATETIME_DAILY_DATES)
+    with engine.begin() as conn:
+        write_sites_data(conn, {'second': pd.DataFrame({'Production (kWh)': [1.0]},
+                                                       index=pd.DatetimeIndex(FRONIUS_DAILY_DATES[:1], name='Date'))})
+    migrate_to_long_format(engine)
+
+    assert list_site_tables(engine) == []
+    site_frames = read_production(engine)
+    assert list(site_frames) == ['first', 'second']
+    assert site_frames['second']['Production (kWh)'].tolist() == [1.0, 2.0, 3.0, 4.0]
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_writing_rows_again_leaves_the_database_unchanged(engine, long_format):
+    if long_format:
+        create_long_format_tables(engine)
+    site_df = pd.DataFrame({'Production (kWh)': [1.0, 2.0, 3.0]},
+                           index=pd.DatetimeIndex(FRONIUS_DAILY_DATES[:3], name='Date'))
+    write_sites_data(engine, {'site': site_df})
+    write_sites_data(engine, {'site': site_df})
+    # Overlapping rows replace the stored ones
+    write_sites_data(engine, {'site': pd.DataFrame({'Production (kWh)': [5.0, 4.0]},
+                                                   index=pd.DatetimeIndex(FRONIUS_DAILY_DATES[2:], name='Date'))})
+    assert read_production(engine)['site']['Production (kWh)'].tolist() == [1.0, 2.0, 5.0, 4.0]
+
+
+def test_duplicate_dates_of_older_tables_keep_the_latest_row(engine):
+    create_site_table(engine, 'site', FRONIUS_DAILY_DATES + FRONIUS_DAILY_DATES[1:2])
+    ensure_unique_keys(engine)
+    ensure_unique_keys(engine)
+    site_df = read_production(engine)['site']
+    assert site_df['Date'].tolist() == FRONIUS_DAILY_DATES
+    assert site_df['Production (kWh)'].tolist() == [1.0, 5.0, 3.0, 4.0]
@@ -0,0 +1,115 @@
+import os
+import pandas as pd
+import pytest
+import sqlalchemy
+from API import response_archive
+from Database.rebuild_from_archive import rebuild
+from Database.production_store import read_production, write_sites_data, pending_setup_steps, is_long_format
+from Database.Prod_DB.setup_update_read_db import SETUP_STEPS, read_zero_streaks, FLEET_SITE
+
+
+@pytest.fixture
+def archive_dir(tmp_path, monkeypatch):
+    archive_dir = str(tmp_path / 'Response_Archive')
+    get_partition_path = response_archive.get_partition_path
+    monkeypatch.setattr(response_archive, 'get_partition_path',
+                        lambda vendor, fetched_at: get_partition_path(vendor, fetched_at, archive_dir))
+    monkeypatch.setattr(response_archive, '_file_tag', None)
+    return archive_dir
+
+
+def archive_vendor_responses():
+    response_archive.archive_response('Enphase', 'systems', {'systems': [{'system_id': 1, 'name': 'Enphase site'}]})
+    response_archive.archive_response('Enphase', 'energy_lifetime', {'start_date': '2024-01-01',
+                                                                     'production': [1000, 2000]}, system_id=1)
+    # Fetched again later, the values of the later response are kept
+    response_archive.archive_response('Enphase', 'energy_lifetime', {'start_date': '2024-01-02',
+                                                                     'production': [5000, 3000]}, system_id=1)
+    # A system missing from every archived systems list
+    response_archive.archive_response('Enphase', 'energy_lifetime', {'start_date': '2024-01-01',
+                                                                     'production': [1000]}, system_id=2)
+
+    response_archive.archive_response('SolarEdge', 'site_list', {'sites': {'count': 1, 'site': [{
+        'id': 7, 'accountId': 62361, 'name': 'CoC SolarEdge site', 'status': 'Active', 'peakPower': 10.0,
+        'location': {'country': 'Canada', 'state': 'Alberta', 'city': 'Calgary', 'address': '', 'zip': ''}}]}})
+    response_archive.archive_response('SolarEdge', 'energy', {'energy': {'values': [
+        {'date': '2024-01-01 00:00:00', 'value': 4000.0}, {'date': '2024-01-02 00:00:00', 'value': None}]}},
+        sites=[7], startDate='2024-01-01', endDate='2024-12-31', timeUnit='DAY')
+
+    response_archive.archive_response('Fronius', 'site_details', {'pvSystems': [{'pvSystemId': 'f1',
+                                                                                 'name': 'Fronius site'}]})
+    response_archive.archive_response('Fronius', 'hist_data', {'data': [
+        {'logDateTime': '2024-01-01T00:05:00+01:00', 'channels': [{'value': 250.0}]},
+        {'logDateTime': '2024-01-01T00:10:00+01:00', 'channels': [{'value': 250.0}]}]},
+        site='f1', first_page=True, **{'from': '2024-01-01T00:00:00', 'to': '2024-01-01T00:30:00'})
+
+
+def test_archived_records_are_read_back_in_order(archive_dir):
+    for value in range(3):
+        response_archive.archive_response('Vendor', 'kind', {'value': value}, site=1)
+    [(vendor, partition_path)] = response_archive.list_partitions(archive_dir)
+    records = list(response_archive.read_partition(partition_path))
+    assert vendor == 'Vendor'
+    assert [record['body'] for record in records] == [{'value': 0}, {'value': 1}, {'value': 2}]
+    assert records[0]['kind'] == 'kind' and records[0]['context'] == {'site': 1}
+
+
+def test_a_record_cut_short_ends_the_partition(archive_dir):
+    for value in range(2):
+        response_archive.archive_response('Vendor', 'kind', {'value': value})
+    [(vendor, partition_path)] = response_archive.list_partitions(archive_dir)
+    with open(partition_path, 'rb+') as partition_file:
+        partition_file.truncate(os.path.getsize(partition_path) - 10)
+    assert [record['body'] for record in response_archive.read_partition(partition_path)] == [{'value': 0}]
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_databases_are_rebuilt_from_the_archive(archive_dir, tmp_path, long_format):
+    archive_vendor_responses()
+    prod_database, prod_15min_database = str(tmp_path / 'Prod_DB.db'), str(tmp_path / 'Prod_15min_DB.db')
+    rebuild(prod_database, prod_15min_database, archive_dir, max_workers=1, long_format=long_format)
+
+    prod_engine = sqlalchemy.create_engine(f'sqlite:///{prod_database}')
+    assert is_long_format(prod_engine) == long_format
+    site_frames = read_production(prod_engine)
+    assert sorted(site_frames) == ['CoC SolarEdge site', 'Enphase site']
+    assert site_frames['Enphase site']['Production (kWh)'].tolist() == [1.0, 5.0, 3.0]
+    assert site_frames['CoC SolarEdge site']['Production (kWh)'].tolist() == [4.0]
+    # Fronius daily data is not in the archive, the server's setup fetches it and then builds the rollups
+    assert pending_setup_steps(prod_engine, SETUP_STEPS) == ['Fronius', 'rollups']
+    assert read_zero_streaks(prod_engine)[FLEET_SITE][0] == 0
+    prod_engine.dispose()
+
+    prod_15min_engine = sqlalchemy.create_engine(f'sqlite:///{prod_15min_database}')
+    fronius_df = read_production(prod_15min_engine)['Fronius site']
+    assert pd.to_datetime(fronius_df['Date']).tolist() == [pd.Timestamp('2024-01-01 00:15')]
+    assert fronius_df['Production (kWh)'].tolist() == [0.5]
+    assert pending_setup_steps(prod_15min_engine, ['SolarEdge', 'Fronius']) == ['SolarEdge']
+    prod_15min_engine.dispose()
+    assert not os.path.exists(prod_database + '.rebuild')
+
+
+def test_databases_holding_history_the_archive_lacks_are_kept(archive_dir, tmp_path):
+    archive_vendor_responses()
+    prod_database, prod_15min_database = str(tmp_path / 'Prod_DB.db'), str(tmp_path / 'Prod_15min_DB.db')
+    prod_engine = sqlalchemy.create_engine(f'sqlite:///{prod_database}')
+    # Enphase days fetched before the archive started
+    write_sites_data(prod_engine, {'Enphase site': pd.DataFrame(
+        {'Production (kWh)': [7.0, 1.0]}, index=pd.DatetimeIndex(['2023-12-31', '2024-01-01'], name='Date'))})
+    prod_engine.dispose()
+    prod_15min_engine = sqlalchemy.create_engine(f'sqlite:///{prod_15min_database}')
+    # Covered by the archived history window
+    write_sites_data(prod_15min_engine, {'Fronius site': pd.DataFrame(
+        {'Production (kWh)': [0.4]}, index=pd.Index(['2024-01-01 00:15:00'], name='Date'))})
+    prod_15min_engine.dispose()
+
+    assert rebuild(prod_database, prod_15min_database, archive_dir, max_workers=1) == [prod_database]
+
+    prod_engine = sqlalchemy.create_engine(f'sqlite:///{prod_database}')
+    assert list(read_production(prod_engine)) == ['Enphase site']
+    assert read_production(prod_engine)['Enphase site']['Production (kWh)'].tolist() == [7.0, 1.0]
+    prod_engine.dispose()
+    prod_15min_engine = sqlalchemy.create_engine(f'sqlite:///{prod_15min_database}')
+    assert read_production(prod_15min_engine)['Fronius site']['Production (kWh)'].tolist() == [0.5]
+    assert pending_setup_steps(prod_15min_engine, ['SolarEdge', 'Fronius']) == ['SolarEdge']
+    prod_15min_engine.dispose()
@@ -0,0 +1,69 @@
+import pytest
+import response_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    response_cache.clear()
+    yield
+    response_cache.clear()
+
+
+def test_payloads_are_only_served_in_their_generation():
+    assert response_cache.get_or_compute('daily', 'key', lambda: 'first') == 'first'
+    assert response_cache.get_or_compute('daily', 'key', lambda: 'second') == 'first'
+    response_cache.bump_generation('daily')
+    assert response_cache.get_or_compute('daily', 'key', lambda: 'second') == 'second'
+
+
+def test_least_recently_used_entries_are_evicted(monkeypatch):
+    monkeypatch.setattr(response_cache, 'MAX_ENTRIES', 2)
+    for key in 'abc':
+        response_cache.get_or_compute('daily', key, lambda: key)
+    assert response_cache.get_or_compute('daily', 'a', lambda: 'recomputed') == 'recomputed'
+    assert response_cache.get_or_compute('daily', 'c', lambda: 'recomputed') == 'c'
+
+
+def test_cache_is_bounded_by_the_size_of_its_payloads(monkeypatch):
+    monkeypatch.setattr(response_cache, 'MAX_CACHED_CHARS', 10)
+    generation = response_cache.current_generation('daily')
+    for key in 'abc':
+        response_cache.store('daily', key, generation, 'x' * 4)
+    # 'a' was evicted to keep the cache at 8 of its 10 characters
+    assert response_cache.lookup('daily', 'a')[1] is None
+    assert response_cache.lookup('daily', 'b')[1] == 'xxxx'
+    assert response_cache.lookup('daily', 'c')[1] == 'xxxx'
+
+    response_cache.store('daily', 'big', generation, 'x' * 11)
+    assert response_cache.lookup('daily', 'big')[1] is None
+    assert response_cache.lookup('daily', 'c')[1] == 'xxxx'
+
+
+def test_replacing_a_payload_frees_its_size(monkeypatch):
+    monkeypatch.setattr(response_cache, 'MAX_CACHED_CHARS', 10)
+    generation = response_cache.current_generation('daily')
+    for _ in range(5):
+        response_cache.store('daily', 'a', generation, 'x' * 6)
+    response_cache.store('daily', 'b', generation, 'x' * 4)
+    assert response_cache.lookup('daily', 'a')[1] == 'x' * 6
+    assert response_cache.lookup('daily', 'b')[1] == 'x' * 4
+
+
+def test_payload_computed_across_a_data_update_is_not_served():
+    def compute():
+        # A job commits new data while the payload is being computed
+        response_cache.bump_generation('daily')
+        return 'stale'
+
+    assert response_cache.get_or_compute('daily', 'key', compute) == 'stale'
+    assert response_cache.lookup('daily', 'key')[1] is None
+    assert response_cache.get_or_compute('daily', 'key', lambda: 'fresh') == 'fresh'
+    assert response_cache.lookup('daily', 'key')[1] == 'fresh'
+
+
+def test_domains_are_invalidated_separately():
+    response_cache.get_or_compute('daily', 'key', lambda: 'daily')
+    response_cache.get_or_compute('15min', 'key', lambda: '15min')
+    response_cache.bump_generation('15min')
+    assert response_cache.lookup('daily', 'key')[1] == 'daily'
+    assert response_cache.lookup('15min', 'key')[1] is None
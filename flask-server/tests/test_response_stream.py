@@ -0,0 +1,55 @@
+import json
+import pandas as pd
+import response_stream
+from response_stream import iter_sites_json
+
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def site_frame(dates, values):
+    return pd.DataFrame({'Date': pd.to_datetime(dates), 'Production (kWh)': values})
+
+
+def test_records_match_the_json_of_every_site(monkeypatch):
+    # Chunks split the arrays of a site, the body still has to be a single JSON document
+    monkeypatch.setattr(response_stream, 'CHUNK_ROWS', 2)
+    site_frames = [('a', site_frame(['2024-01-01', '2024-01-02', '2024-01-03'], [1.5, 0.0, float('nan')])),
+                   ('empty', site_frame([], [])),
+                   ('"quoted"', site_frame(['2024-01-01'], [2]))]
+    chunks = list(iter_sites_json(site_frames, DATE_FORMAT))
+    assert len(chunks) > len(site_frames) + 2
+    assert json.loads(''.join(chunks)) == {
+        'a': [{'Date': '2024-01-01', 'Production (kWh)': 1.5}, {'Date': '2024-01-02', 'Production (kWh)': 0.0},
+              {'Date': '2024-01-03', 'Production (kWh)': None}],
+        'empty': [],
+        '"quoted"': [{'Date': '2024-01-01', 'Production (kWh)': 2.0}],
+    }
+
+
+def test_records_carry_the_index_column_of_their_frame():
+    site_df = site_frame(['2024-01-01', '2024-01-02'], [1.0, 2.0])
+    site_df.insert(0, 'index', [1, 0])
+    records = json.loads(''.join(iter_sites_json([('a', site_df)], DATE_FORMAT)))['a']
+    assert records == [{'index': 1, 'Date': '2024-01-01', 'Production (kWh)': 1.0},
+                       {'index': 0, 'Date': '2024-01-02', 'Production (kWh)': 2.0}]
+
+
+def test_columnar_series():
+    site_frames = [('regular', site_frame(['2024-01-01 00:00', '2024-01-01 00:15', '2024-01-01 00:30'], [1, 2, 3])),
+                   ('half hourly', site_frame(['2024-01-01 00:00', '2024-01-01 00:30'], [1, 2])),
+                   ('irregular', site_frame(['2024-01-01 00:00', '2024-01-01 00:15', '2024-01-01 01:00'], [1, 2, 3])),
+                   ('single', site_frame(['2024-01-01 00:00'], [4]))]
+    data = json.loads(''.join(iter_sites_json(site_frames, '%Y-%m-%d %H:%M', 'columnar', use_step=True)))
+    assert data == {
+        'regular': {'start': '2024-01-01 00:00', 'step': 900, 'values': [1.0, 2.0, 3.0]},
+        'half hourly': {'start': '2024-01-01 00:00', 'step': 1800, 'values': [1.0, 2.0]},
+        'irregular': {'dates': ['2024-01-01 00:00', '2024-01-01 00:15', '2024-01-01 01:00'],
+                      'values': [1.0, 2.0, 3.0]},
+        'single': {'dates': ['2024-01-01 00:00'], 'values': [4.0]},
+    }
+
+
+def test_columnar_series_without_steps_list_every_date():
+    site_df = site_frame(['2024-01-01', '2024-01-02'], [1, 2])
+    data = json.loads(''.join(iter_sites_json([('a', site_df)], DATE_FORMAT, 'columnar')))
+    assert data == {'a': {'dates': ['2024-01-01', '2024-01-02'], 'values': [1.0, 2.0]}}
@@ -0,0 +1,121 @@
+import pandas as pd
+import pytest
+from Database.production_store import create_long_format_tables, write_sites_data, list_sites
+from Database.Prod_DB.setup_update_read_db import update_rollups, store_daily_updates, iter_rollup_data, \
+    read_fleet_daily, iter_DB_data_daily, ROLLUP_TABLES, FLEET_DAILY_TABLE, FLEET_SITE
+
+
+def daily_frame(start, values, fronius=False):
+    """Daily rows as the vendor modules return them, Fronius ones with their dates as 'YYYY-MM-DD' strings"""
+    dates = pd.date_range(start, periods=len(values), freq='D', name='Date')
+    if fronius:
+        dates = pd.Index(dates.strftime('%Y-%m-%d'), name='Date')
+    return pd.DataFrame({'Production (kWh)': [float(value) for value in values]}, index=dates)
+
+
+def read_rollup_tables(engine):
+    tables = {}
+    for table_name in list(ROLLUP_TABLES.values()) + [FLEET_DAILY_TABLE]:
+        df = pd.read_sql(f'SELECT * FROM "{table_name}"', engine)
+        tables[table_name] = df.sort_values(list(df.columns[:-1])).reset_index(drop=True)
+    return tables
+
+
+def rollup_sums(engine, interval):
+    return {site: dict(zip(df['Date'].dt.strftime('%Y-%m-%d'), df['Production (kWh)']))
+            for site, df in iter_rollup_data(engine, interval)}
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_monthly_yearly_and_fleet_totals(engine, long_format):
+    if long_format:
+        create_long_format_tables(engine)
+    write_sites_data(engine, {
+        'Fronius site': daily_frame('2023-12-31', [1, 2, 3], fronius=True),
+        'SolarEdge site': daily_frame('2024-01-31', [10, 20]),
+    })
+    update_rollups(engine, dict.fromkeys(list_sites(engine)))
+
+    assert rollup_sums(engine, 'monthly') == {
+        'Fronius site': {'2023-12-31': 1.0, '2024-01-31': 5.0},
+        'SolarEdge site': {'2024-01-31': 10.0, '2024-02-29': 20.0},
+        FLEET_SITE: {'2023-12-31': 1.0, '2024-01-31': 15.0, '2024-02-29': 20.0},
+    }
+    assert rollup_sums(engine, 'yearly') == {
+        'Fronius site': {'2023-12-31': 1.0, '2024-12-31': 5.0},
+        'SolarEdge site': {'2024-12-31': 30.0},
+        FLEET_SITE: {'2023-12-31': 1.0, '2024-12-31': 35.0},
+    }
+    fleet_df = read_fleet_daily(engine)
+    assert fleet_df['Date'].dt.strftime('%Y-%m-%d').tolist() == ['2023-12-31', '2024-01-01', '2024-01-02',
+                                                                 '2024-01-31', '2024-02-01']
+    assert fleet_df['Production (kWh)'].tolist() == [1.0, 2.0, 3.0, 10.0, 20.0]
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_incremental_update_matches_a_full_build(engine, long_format):
+    if long_format:
+        create_long_format_tables(engine)
+    write_sites_data(engine, {
+        'Fronius site': daily_frame('2023-12-30', [1, 2], fronius=True),
+        'Enphase site': daily_frame('2023-12-30', [4, 4]),
+    })
+    update_rollups(engine, dict.fromkeys(list_sites(engine)))
+
+    # Crosses into a new month and year, and adds a site the rollups have not seen yet
+    store_daily_updates(engine, {
+        'Fronius site': daily_frame('2024-01-01', [3, 5], fronius=True),
+        'Enphase site': daily_frame('2023-12-31', [6, 7]),
+        'New site': daily_frame('2024-01-02', [8]),
+    })
+    incremental = read_rollup_tables(engine)
+    update_rollups(engine, dict.fromkeys(list_sites(engine)))
+    full = read_rollup_tables(engine)
+
+    for table_name, df in full.items():
+        pd.testing.assert_frame_equal(incremental[table_name], df)
+    assert rollup_sums(engine, 'yearly')[FLEET_SITE] == {'2023-12-31': 11.0, '2024-12-31': 23.0}
+
+
+def test_rollups_are_built_on_first_read(engine):
+    write_sites_data(engine, {'site': daily_frame('2024-03-01', [1, 1, 1])})
+    assert rollup_sums(engine, 'monthly') == {'site': {'2024-03-31': 3.0}, FLEET_SITE: {'2024-03-31': 3.0}}
+
+
+def test_first_build_covers_every_site(engine):
+    # A database from before the rollups, first updated for only one of its sites
+    write_sites_data(engine, {'a': daily_frame('2024-01-01', [1, 2]), 'b': daily_frame('2024-01-01', [3])})
+    store_daily_updates(engine, {'a': daily_frame('2024-01-03', [4])})
+    assert rollup_sums(engine, 'monthly') == {'a': {'2024-01-31': 7.0}, 'b': {'2024-01-31': 3.0},
+                                              FLEET_SITE: {'2024-01-31': 10.0}}
+
+
+def test_rollup_reads_filter_sites_and_period_labels(engine):
+    write_sites_data(engine, {
+        'a': daily_frame('2024-01-31', [1, 2]),
+        'b': daily_frame('2024-01-31', [3, 4]),
+    })
+    update_rollups(engine, {})
+
+    rollups = dict(iter_rollup_data(engine, 'monthly', sites=['b', 'missing'], start=pd.Timestamp('2024-02-01')))
+    assert list(rollups) == ['b', 'missing']
+    assert rollups['b']['Production (kWh)'].tolist() == [4.0]
+    assert len(rollups['missing']) == 0
+
+
+def test_combined_daily_series_is_the_sum_of_the_sites(engine):
+    write_sites_data(engine, {
+        'Fronius site': daily_frame('2024-01-01', [1, 2, float('nan'), 4], fronius=True),
+        'SolarEdge site': daily_frame('2024-01-02', [10, 20, 30]),
+    })
+    store_daily_updates(engine, {'SolarEdge site': daily_frame('2024-01-05', [40])})
+
+    site_frames = dict(iter_DB_data_daily(engine, interval='daily'))
+    summed = pd.concat([site_frames[site] for site in ('Fronius site', 'SolarEdge site')]) \
+        .groupby('Date')['Production (kWh)'].sum()
+    combined = site_frames[FLEET_SITE].set_index('Date')['Production (kWh)']
+    assert combined.to_dict() == summed.to_dict()
+
+    start, end = pd.Timestamp('2024-01-02'), pd.Timestamp('2024-01-03')
+    combined = dict(iter_DB_data_daily(engine, interval='daily', sites=[FLEET_SITE], start=start, end=end))
+    assert combined[FLEET_SITE]['Production (kWh)'].tolist() == [12.0, 20.0]
@@ -0,0 +1,192 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+import response_cache
+import server
+from pipeline import run_pipeline
+from Database.Prod_DB.setup_update_read_db import download_DB_data_daily, FLEET_SITE
+
+DAILY_SITES = ('Enphase site', 'SolarEdge site', 'Fronius site')
+FIFTEEN_MIN_SITES = ('SolarEdge site', 'Fronius site')
+
+
+def write_database(path, frames):
+    engine = sqlalchemy.create_engine(f'sqlite:///{path}')
+    for table_name, df in frames.items():
+        df.to_sql(table_name, engine)
+    engine.dispose()
+
+
+@pytest.fixture(scope='module')
+def databases_dir(tmp_path_factory):
+    """The three databases of a small fleet, with a year of daily production and two days of 15 minute production
+    stored the way the vendor jobs store them"""
+    directory = tmp_path_factory.mktemp('databases')
+    yesterday = pd.Timestamp.today().normalize() - pd.Timedelta(days=1)
+    rng = np.random.default_rng(0)
+
+    days = pd.date_range(end=yesterday, periods=400, freq='D', name='Date')
+    daily = {site: pd.DataFrame({'Production (kWh)': np.round(rng.random(len(days)) * 20, 3)}, index=days)
+             for site in DAILY_SITES}
+    daily['Fronius site'].index = daily['Fronius site'].index.strftime('%Y-%m-%d')
+    # The last days without production show up in the Alerts tab
+    daily['SolarEdge site'].iloc[-3:] = 0.0
+    write_database(directory / 'Prod_DB.db', daily)
+
+    intervals = pd.date_range(end=yesterday + pd.Timedelta(hours=23, minutes=45), periods=2 * 96, freq='15min',
+                              name='Date')
+    write_database(directory / 'Prod_15min_DB.db', {
+        site: pd.DataFrame({'Production (kWh)': np.round(rng.random(len(intervals)), 4)},
+                           index=intervals.strftime('%Y-%m-%d %H:%M:%S').rename('Date'))
+        for site in FIFTEEN_MIN_SITES})
+
+    write_database(directory / 'Site_Details_DB.db', {
+        'Enphase_SD': pd.DataFrame({'name': ['Enphase site'], 'public_name': ['Residential System'],
+                                    'size_w': [5000]}, index=pd.Index([1], name='system_id')),
+        'Solaredge_SD': pd.DataFrame({'site name': ['SolarEdge site'], 'Peak Power': [10.0]}),
+        'Fronius_SD': pd.DataFrame({'site name': ['Fronius site'], 'Peak Power': [7.5]}),
+    })
+    return directory
+
+
+@pytest.fixture
+def client(databases_dir, monkeypatch):
+    # The server opens its databases relative to the working directory
+    monkeypatch.chdir(databases_dir)
+    response_cache.clear()
+    yield server.app.test_client()
+    response_cache.clear()
+
+
+def test_daily_records_keep_their_shape(client):
+    response = client.post('/api/data', json={'selection': 'daily'})
+    assert response.status_code == 200
+    data = json.loads(response.get_data())
+
+    engine = sqlalchemy.create_engine('sqlite:///Prod_DB.db')
+    assert data == download_DB_data_daily(engine, interval='daily')
+    engine.dispose()
+    for site, records in data.items():
+        if site == FLEET_SITE:
+            assert set(records[0]) == {'Date', 'Production (kWh)'}
+        else:
+            assert set(records[0]) == {'index', 'Date', 'Production (kWh)'}
+            # Newest first positions, as the site's rows were read
+            assert [record['index'] for record in records] == list(range(len(records) - 1, -1, -1))
+
+
+@pytest.mark.parametrize('selection', ['monthly', 'yearly'])
+def test_rollup_records(client, selection):
+    data = json.loads(client.post('/api/data', json={'selection': selection}).get_data())
+    assert sorted(data) == sorted(DAILY_SITES + (FLEET_SITE,))
+    assert all(set(records[0]) == {'Date', 'Production (kWh)'} for records in data.values() if records)
+
+
+def test_responses_are_read_once_per_data_update(client, monkeypatch):
+    reads = []
+    stream_prod_data_daily = server.stream_prod_data_daily
+
+    def counted_stream(*args, **kwargs):
+        reads.append(args)
+        yield from stream_prod_data_daily(*args, **kwargs)
+
+    monkeypatch.setattr(server, 'stream_prod_data_daily', counted_stream)
+    body = client.post('/api/data', json={'selection': 'yearly'}).get_data(as_text=True)
+    assert client.post('/api/data', json={'selection': 'yearly'}).get_data(as_text=True) == body
+    assert len(reads) == 1
+
+    response_cache.bump_generation('daily')
+    assert client.post('/api/data', json={'selection': 'yearly'}).get_data(as_text=True) == body
+    assert len(reads) == 2
+
+
+def test_streamed_bodies_are_cached_up_to_the_limit(client, monkeypatch):
+    key = ('api/data', 'yearly', None, None, None, 'records')
+    body = client.post('/api/data', json={'selection': 'yearly'}).get_data(as_text=True)
+    assert response_cache.lookup('daily', key)[1] == body
+
+    response_cache.clear()
+    monkeypatch.setattr(response_cache, 'MAX_STREAMED_CHARS', len(body) - 1)
+    assert client.post('/api/data', json={'selection': 'yearly'}).get_data(as_text=True) == body
+    assert response_cache.lookup('daily', key)[1] is None
+
+
+def test_daily_data_of_selected_sites(client):
+    everything = json.loads(client.post('/api/data', json={'selection': 'daily'}).get_data())
+    sites = ['Fronius site', 'Missing site', 'Enphase site']
+    data = json.loads(client.post('/api/data', json={'selection': 'daily', 'sites': sites}).get_data())
+    assert list(data) == sites
+    assert data['Missing site'] == []
+    assert data['Fronius site'] == everything['Fronius site'] and data['Enphase site'] == everything['Enphase site']
+
+
+def test_filtered_daily_data(client):
+    # Every vendor's daily rows, whatever the format their dates are stored in
+    sites = list(DAILY_SITES)
+    everything = json.loads(client.post('/api/data', json={'selection': 'daily', 'sites': sites}).get_data())
+
+    dates = sorted(record['Date'] for record in everything[sites[0]])
+    start, end = dates[10], dates[20]
+    data = json.loads(client.post('/api/data', json={'selection': 'daily', 'sites': sites,
+                                                      'start': start, 'end': end}).get_data())
+    assert list(data) == sites
+    for site in sites:
+        expected = [record for record in everything[site] if start <= record['Date'] <= end]
+        assert len(expected) == 11
+        assert [(record['Date'], record['Production (kWh)']) for record in data[site]] == \
+            [(record['Date'], record['Production (kWh)']) for record in expected]
+
+
+def test_filtered_fifteen_minute_data(client):
+    everything = json.loads(client.post('/api/15min/data', json={'selection': '15T'}).get_data())
+    site = next(site for site, records in everything.items() if records)
+    last_day = max(record['Date'] for record in everything[site])[:10]
+    data = json.loads(client.post('/api/15min/data', json={'selection': '15T', 'sites': [site],
+                                                            'start': last_day}).get_data())
+    assert list(data) == [site]
+    assert data[site] == [record for record in everything[site] if record['Date'] >= last_day]
+
+
+def test_fifteen_minute_data(client):
+    response = client.post('/api/15min/data', json={'selection': 'H'})
+    assert response.status_code == 200
+    assert sorted(json.loads(response.get_data())) == sorted(FIFTEEN_MIN_SITES)
+
+
+def test_columnar_responses_hold_the_records_data(client):
+    records = json.loads(client.post('/api/15min/data', json={'selection': '15T'}).get_data())
+    columnar = json.loads(client.post('/api/15min/data', json={'selection': '15T', 'format': 'columnar'}).get_data())
+    assert list(columnar) == list(records)
+    for site, series in columnar.items():
+        assert series['values'] == [record['Production (kWh)'] for record in records[site]]
+        if 'step' in series:
+            dates = pd.date_range(series['start'], periods=len(series['values']), freq=f"{series['step']}s")
+            assert dates.strftime('%Y-%m-%d %H:%M:%S').tolist() == [record['Date'] for record in records[site]]
+        else:
+            assert series['dates'] == [record['Date'] for record in records[site]]
+
+
+def test_tabs_are_written_alongside_each_other(client):
+    sites_engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
+    stages = {f'{tab} {i}': (lambda results, update=update: update(sites_engine), [])
+              for i in range(3) for tab, update in (('Metrics', server.put_aggregated_production_on_DB),
+                                                    ('Alerts', server.put_zeroProductionDaily_sites_on_DB))}
+    results, failures = run_pipeline('Test', stages)
+    sites_engine.dispose()
+    assert failures == {}
+    assert json.loads(client.get('/alerts').get_data())
+    assert json.loads(client.get('/api/aggregated-production').get_data())
+
+
+def test_metrics_are_stored_as_numbers(client):
+    sites_engine = sqlalchemy.create_engine('sqlite:///Site_Details_DB.db')
+    server.put_aggregated_production_on_DB(sites_engine)
+    metrics_df = pd.read_sql('SELECT * FROM Metrics', sites_engine)
+    sites_engine.dispose()
+    assert all(pd.api.types.is_float_dtype(metrics_df[column]) for column in metrics_df.columns.drop('site'))
+
+    served = json.loads(client.get('/api/aggregated-production').get_data())
+    assert [row['site'] for row in served] == metrics_df['site'].tolist()
+    assert served[0]['date_range'][0]['last_7_days'].endswith(' kWh')
@@ -0,0 +1,63 @@
+import threading
+import time
+import pytest
+from API import site_metadata
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    site_metadata.invalidate()
+    yield
+    site_metadata.invalidate()
+
+
+def counted_load(loads, metadata):
+    def load():
+        loads.append(1)
+        return metadata
+    return load
+
+
+def test_metadata_is_loaded_once_until_refreshed():
+    loads = []
+    load = counted_load(loads, {1: {'site name': 'a'}})
+    assert site_metadata.get_site_metadata('Vendor', load) == {1: {'site name': 'a'}}
+    assert site_metadata.get_site_metadata('Vendor', load) == {1: {'site name': 'a'}}
+    assert len(loads) == 1
+    site_metadata.get_site_metadata('Vendor', load, refresh=True)
+    assert len(loads) == 2
+    site_metadata.invalidate('Vendor')
+    site_metadata.get_site_metadata('Vendor', load)
+    assert len(loads) == 3
+
+
+def test_expired_metadata_is_loaded_again(monkeypatch):
+    loads = []
+    load = counted_load(loads, {})
+    site_metadata.get_site_metadata('Vendor', load)
+    monkeypatch.setattr(site_metadata, 'TTL_SECONDS', 0)
+    site_metadata.get_site_metadata('Vendor', load)
+    assert len(loads) == 2
+
+
+def test_callers_get_their_own_copy():
+    site_metadata.get_site_metadata('Vendor', lambda: {1: {'site name': 'a'}})[2] = {'site name': 'added'}
+    site_metadata.get_site_metadata('Vendor', lambda: {})[1]['site name'] = 'b'
+    assert site_metadata.get_site_metadata('Vendor', lambda: {}) == {1: {'site name': 'a'}}
+
+
+def test_concurrent_callers_wait_for_a_single_load():
+    loads = []
+
+    def slow_load():
+        loads.append(1)
+        time.sleep(0.05)
+        return {}
+
+    threads = [threading.Thread(target=site_metadata.get_site_metadata, args=('Vendor', slow_load))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(loads) == 1
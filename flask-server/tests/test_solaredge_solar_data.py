@@ -0,0 +1,103 @@
+import threading
+import pytest
+from API import response_archive, backfill_checkpoint
+from API.SolarEdge import solar_data
+
+API_ENDPOINT = {'site_aggr_data': 'https://solaredge/site/{site}/energy?',
+                'sites_aggr_data': 'https://solaredge/sites/{site}/energy?'}
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def site_values(site, startdate):
+    return [{'date': f'{startdate} 00:00:00', 'value': float(site)}]
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Answers the energy endpoints with one value per site, dated on the window's start date, and records the
+    (endpoint, sites, startDate) of every call"""
+    calls = []
+    lock = threading.Lock()
+
+    def get(vendor, url, params):
+        endpoint, site_ids = url.split('/')[3], [int(site) for site in url.split('/')[4].split(',')]
+        with lock:
+            calls.append((endpoint, site_ids, params['startDate']))
+        if endpoint == 'site':
+            return FakeResponse({'energy': {'values': site_values(site_ids[0], params['startDate'])}})
+        return FakeResponse({'sitesEnergy': {'siteEnergyList': [
+            {'siteId': site, 'energyValues': {'values': site_values(site, params['startDate'])}}
+            for site in site_ids]}})
+
+    monkeypatch.setattr(solar_data.http_client, 'get', get)
+    monkeypatch.setattr(response_archive, 'archive_response', lambda *args, **kwargs: None)
+    return calls
+
+
+def test_sites_sharing_a_window_are_fetched_together(calls):
+    site_windows = [(site, startdate, f'{startdate[:4]}-12-31')
+                    for startdate in ('2023-01-01', '2024-01-01') for site in range(1, 151)]
+    aggr_data = solar_data.fetch_sites_data('DAY', 'key', API_ENDPOINT, site_windows)
+
+    assert sorted(len(site_ids) for endpoint, site_ids, startdate in calls) == [50, 50, 100, 100]
+    assert {endpoint for endpoint, site_ids, startdate in calls} == {'sites'}
+    assert list(aggr_data) == list(range(1, 151))
+    assert aggr_data[42] == site_values(42, '2023-01-01') + site_values(42, '2024-01-01')
+
+
+def test_every_window_is_its_own_call_without_the_multi_site_endpoint(calls):
+    site_windows = [(1, '2023-01-01', '2023-12-31'), (2, '2023-01-01', '2023-12-31')]
+    aggr_data = solar_data.fetch_sites_data('DAY', 'key', {'site_aggr_data': API_ENDPOINT['site_aggr_data']},
+                                            site_windows)
+    assert sorted(calls) == [('site', [1], '2023-01-01'), ('site', [2], '2023-01-01')]
+    assert aggr_data == {1: site_values(1, '2023-01-01'), 2: site_values(2, '2023-01-01')}
+
+
+def test_build_site_frame():
+    values = [{'date': '2024-01-01 00:00:00', 'value': 1500.0}, {'date': '2024-01-01 00:15:00', 'value': None},
+              {'date': '2024-01-01 00:30:00', 'value': 500.0}]
+    assert solar_data.build_site_frame(values)['Production (kWh)'].tolist() == [1.5, 0.5]
+    assert solar_data.build_site_frame(values, drop_last=True).index.tolist() == ['2024-01-01 00:00:00']
+
+
+def test_interrupted_backfill_resumes_with_the_missing_windows(calls, tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill_checkpoint, 'get_checkpoint_path',
+                        lambda vendor, name: str(tmp_path / f'backfill_{name}.jsonl'))
+    site_windows = [(site, startdate, f'{startdate[:4]}-12-31')
+                    for site in (1, 2) for startdate in ('2023-01-01', '2024-01-01')]
+    get = solar_data.http_client.get
+
+    def get_failing_in_2024(vendor, url, params):
+        if params['startDate'] == '2024-01-01':
+            raise ConnectionError('interrupted')
+        return get(vendor, url, params)
+
+    monkeypatch.setattr(solar_data.http_client, 'get', get_failing_in_2024)
+    with pytest.raises(ConnectionError):
+        solar_data.fetch_sites_data('DAY', 'key', API_ENDPOINT, site_windows, resumable=True)
+    assert calls == [('sites', [1, 2], '2023-01-01')]
+
+    monkeypatch.setattr(solar_data.http_client, 'get', get)
+    aggr_data = solar_data.fetch_sites_data('DAY', 'key', API_ENDPOINT, site_windows, resumable=True)
+    assert calls[1:] == [('sites', [1, 2], '2024-01-01')]
+    assert aggr_data == {site: site_values(site, '2023-01-01') + site_values(site, '2024-01-01') for site in (1, 2)}
+
+
+def test_resumed_backfill_fetches_the_open_window_again(calls, tmp_path, monkeypatch):
+    monkeypatch.setattr(backfill_checkpoint, 'get_checkpoint_path',
+                        lambda vendor, name: str(tmp_path / f'backfill_{name}.jsonl'))
+    site_windows = [(1, '2024-01-01', '2024-01-31'), (1, '2024-02-01', '2024-02-29')]
+    # Interrupted after both windows were fetched, the last one while February was still under way
+    backfill_checkpoint.record_checkpoint('SolarEdge', 'QUARTER_OF_AN_HOUR', [
+        ((1, startdate, enddate), site_values(0, startdate)) for site, startdate, enddate in site_windows])
+
+    aggr_data = solar_data.fetch_sites_data('QUARTER_OF_AN_HOUR', 'key', API_ENDPOINT, site_windows, resumable=True)
+    assert calls == [('sites', [1], '2024-02-01')]
+    assert aggr_data == {1: site_values(0, '2024-01-01') + site_values(1, '2024-02-01')}
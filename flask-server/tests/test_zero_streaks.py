@@ -0,0 +1,56 @@
+import pandas as pd
+import pytest
+from Database.production_store import create_long_format_tables, write_sites_data
+from Database.Prod_DB.setup_update_read_db import store_daily_updates, rebuild_zero_streaks, read_zero_streaks, \
+    trailing_zero_days, advance_zero_streak, FLEET_SITE
+
+
+def daily_frame(start, values, fronius=False):
+    """Daily rows as the vendor modules return them, Fronius ones with their dates as 'YYYY-MM-DD' strings"""
+    dates = pd.date_range(start, periods=len(values), freq='D', name='Date')
+    if fronius:
+        dates = pd.Index(dates.strftime('%Y-%m-%d'), name='Date')
+    return pd.DataFrame({'Production (kWh)': [float(value) for value in values]}, index=dates)
+
+
+@pytest.mark.parametrize('long_format', [False, True])
+def test_incremental_update_matches_a_full_rebuild(engine, long_format):
+    if long_format:
+        create_long_format_tables(engine)
+    write_sites_data(engine, {
+        'Fronius site': daily_frame('2024-01-01', [4, 0, 0], fronius=True),
+        'SolarEdge site': daily_frame('2024-01-01', [0, 3, 0]),
+        'Enphase site': daily_frame('2024-01-01', [2, 2, 2]),
+    })
+    rebuild_zero_streaks(engine)
+
+    # The first appended day of every site breaks or extends its streak
+    store_daily_updates(engine, {
+        'Fronius site': daily_frame('2024-01-04', [5, 0], fronius=True),
+        'SolarEdge site': daily_frame('2024-01-04', [0, 0]),
+        'Enphase site': daily_frame('2024-01-04', [0, 1]),
+    })
+    incremental = read_zero_streaks(engine)
+    assert incremental == rebuild_zero_streaks(engine)
+    assert {site: count for site, (count, last_date) in incremental.items()} == \
+        {'Fronius site': 1, 'SolarEdge site': 3, 'Enphase site': 0, FLEET_SITE: 0}
+
+
+def test_fleet_streak_reaching_back_past_the_appended_days(engine):
+    write_sites_data(engine, {'site': daily_frame('2024-01-01', [1, 0, 0], fronius=True)})
+    rebuild_zero_streaks(engine)
+    store_daily_updates(engine, {'site': daily_frame('2024-01-04', [0], fronius=True)})
+    assert read_zero_streaks(engine) == rebuild_zero_streaks(engine)
+    assert read_zero_streaks(engine)[FLEET_SITE][0] == 3
+
+
+def test_trailing_zero_days():
+    assert trailing_zero_days([]) == 0
+    assert trailing_zero_days([0, 0]) == 2
+    assert trailing_zero_days([0, 1, 0]) == 1
+
+
+def test_advance_zero_streak_ignores_rows_already_counted():
+    new_df = pd.DataFrame({'Date': pd.to_datetime(['2024-01-02', '2024-01-03']), 'Production (kWh)': [0.0, 0.0]})
+    assert advance_zero_streak((2, pd.Timestamp('2024-01-02')), new_df) == (3, pd.Timestamp('2024-01-03'))
+    assert advance_zero_streak((2, pd.Timestamp('2024-01-03')), new_df) == (2, pd.Timestamp('2024-01-03'))